@@ -0,0 +1,499 @@
+import argparse
+import contextlib
+import copy
+import gc
+import glob
+import gzip
+import hashlib
+import html
+import http.client
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+
+import config
+import utils
+import build_manifest
+import columnar_format
+import corpus_db
+import dialogue_index
+import query_server
+import script_cache
+import script_fetcher
+import script_parser
+import script_analyzer
+import sentiment
+import streaming_format
+
+FIXTURES_FILE = config.DIR_BENCHMARK + "fixtures.json.gz"
+EXPECTED_FILE = config.DIR_BENCHMARK + "expected.json"
+BASELINE_FILE = config.DIR_BENCHMARK + "baseline.json"
+
+# A case is reported as a regression when it is this much slower than the baseline
+REGRESSION_THRESHOLD = 1.25
+# Number of times a case is measured again (with --check) when it is slower than that, before it is reported
+REGRESSION_CONFIRMATIONS = 2
+# Number of characters with the most lines of each fixture, whose interactions and statistics are queried
+TOP_CHARACTERS = 10
+# Number of texts of each fixture scored by the sentiment case, as VADER is much slower than the other cases
+SENTIMENT_TEXTS = 300
+# Number of rows of the calibration workload
+CALIBRATION_ROWS = 20000
+
+""" Deterministic stand-in for the sentiment scorer, so that analysis timings and outputs do not depend on the
+    installed VADER lexicon (sentiment scoring itself is measured by the sentiment case). """
+class FixedScorer:
+    def score_batch(self, texts):
+        return [round((zlib.crc32(t.encode("utf-8")) % 20001 - 10000) / 10000, 4) for t in texts]
+
+
+""" Rebuild an IMSDb-like raw HTML script from the entries of an analyzed movie.
+    CHARACTER and LOCATION entries are written in bold, the others as plain text blocks. """
+def synthesize_raw_script(entries):
+    parts = ["<html><pre>"]
+    for e in entries:
+        if e["type"] == script_parser.TYPE_LOCATION:
+            parts.append("<b>" + e["content"] + "</b>\n\n")
+        elif e["type"] == script_parser.TYPE_CHARACTER:
+            parts.append("<b>                    " + e["content"] + "   </b>\n")
+        elif e["type"] == script_parser.TYPE_SPEECH:
+            parts.append("          " + e["content"] + "\n\n")
+        else:
+            parts.append(e["content"] + "\n\n")
+    parts.append("</pre></html>\n")
+    return "".join(parts)
+
+
+""" Build an IMSDb-like script page from the entries of an analyzed movie, with the script in a td.scrtext <pre>. """
+def synthesize_script_page(analyzed):
+    entries = [{"type": e["type"], "content": html.escape(e["content"], quote=False)} for e in analyzed["entries"]]
+    script = synthesize_raw_script(entries)
+    script = script[len("<html><pre>"):-len("</pre></html>\n")]
+    return ("<html><head><title>" + html.escape(analyzed["info"]["title"]) + " Script at IMSDb.</title></head><body>\n"
+        + "<table width=\"100%\"><tr><td class=\"scrtext\">\n<pre>" + script + "</pre>\n</td></tr></table>\n</body></html>\n")
+
+
+""" Load every movie of the analyzed corpus. """
+def load_analyzed():
+    movies = []
+    for path in sorted(glob.glob(os.path.join(config.DIR_ANALYZED, "*.json"))):
+        with open(path) as f:
+            movies.append(json.load(f))
+    return movies
+
+
+""" Get the character names of an analyzed movie in entry order, with scanning mistakes injected
+    into every 7th name (e.g. "HARRY" -> "HABRY"), and the resulting occurrence dict. """
+def make_scan_error_names(analyzed):
+    misreads = {correct: misread for misread, correct in utils.SCAN_ERRORS.items()}
+    names = []
+    for e in analyzed["entries"]:
+        if e["type"] == script_parser.TYPE_CHARACTER:
+            name = e["content"]
+            if len(names) % 7 == 0:
+                positions = [i for i, c in enumerate(name) if c in misreads]
+                if len(positions) > 0:
+                    i = positions[len(names) % len(positions)]
+                    name = name[:i] + misreads[name[i]] + name[i+1:]
+            names.append(name)
+
+    character_dict = dict()
+    for name in names:
+        character_dict[name] = character_dict.get(name, 0) + 1
+    return names, character_dict
+
+
+""" Build an analyzed movie from analyzed data without recomputing sentiment scores. """
+def make_analyzed_movie(analyzed):
+    movie = script_analyzer.AnalyzedMovieScript.__new__(script_analyzer.AnalyzedMovieScript)
+    movie.parsed_script = script_parser.MovieScript(analyzed["info"])
+    movie.character_names = list(analyzed["characters"])
+    movie.entries = script_parser.entries_from_dicts(analyzed["entries"])
+    return movie
+
+
+""" Call a function and return its result and the peak memory allocated during the call, in bytes. """
+def peak_memory(fn, *args):
+    tracemalloc.start()
+    try:
+        result = fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+""" Freeze the fixtures: script pages rebuilt from the analyzed corpus, and character names with scanning mistakes. """
+def freeze_fixtures():
+    fixtures = []
+    for analyzed in load_analyzed():
+        names, _ = make_scan_error_names(analyzed)
+        fixtures.append({"info": analyzed["info"], "page": synthesize_script_page(analyzed), "scan_error_names": names})
+    os.makedirs(config.DIR_BENCHMARK, exist_ok=True)
+    with open(FIXTURES_FILE, "wb") as f:
+        f.write(gzip.compress(json.dumps(fixtures).encode("utf-8"), mtime=0))
+    return fixtures
+
+
+def load_fixtures():
+    with gzip.open(FIXTURES_FILE, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+""" Summarize a parsed script for correctness checks: entry and character counts, and a hash of the entries. """
+def summarize_parsed(movie_script):
+    types = dict()
+    for e in movie_script.entries:
+        types[e["type"]] = types.get(e["type"], 0) + 1
+    return {"entries": len(movie_script.entries), "types": types, "characters": len(movie_script.character_names),
+        "hash": build_manifest.hash_data([e.to_dict() for e in movie_script.entries], movie_script.character_names)}
+
+
+def summarize_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+""" Prepare the inputs of the cases for every fixture, outside of the measurements. Scripts are served from a
+    temporary script cache, so that parse_movie runs offline. The analyzed fixtures are written to the temporary
+    directory in each output format, and served by a query server (returned, to be shut down by the caller). """
+def prepare_fixtures(fixtures, directory):
+    script_fetcher.cache = script_cache.ScriptCache(os.path.join(directory, "scripts"))
+    analyzed_directory = os.path.join(directory, "analyzed")
+    os.makedirs(analyzed_directory)
+    builder = dialogue_index.IndexBuilder()
+    analyzer = sentiment.SentimentScorer().get_analyzer()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for f in fixtures:
+            # Pages are fetched as bytes
+            f["page_data"] = f["page"].encode("utf-8")
+            f["script"] = script_fetcher.extract_script(f["page_data"])
+            f["preprocessed"] = script_parser.preprocess_script(f["script"])
+            script_fetcher.cache.put(f["info"]["script_page"], f["script"])
+            f["unfinalized"] = script_parser.parse_entries(f["info"], f["script"])
+            f["parsed"] = script_parser.parse_raw_script(f["info"], f["script"])
+            f["scan_error_dict"] = dict()
+            for name in f["scan_error_names"]:
+                f["scan_error_dict"][name] = f["scan_error_dict"].get(name, 0) + 1
+            f["sentiment_texts"] = [e.content for e in f["parsed"].entries if e.type in [script_parser.TYPE_SPEECH, script_parser.TYPE_DIRECTION]][:SENTIMENT_TEXTS]
+            f["sentiment_analyzer"] = analyzer
+            f["analyzed"] = script_analyzer.AnalyzedMovieScript(copy.deepcopy(f["parsed"]), scorer=FixedScorer())
+            f["output_path"] = os.path.join(directory, "movie.json")
+            f["columnar_path"] = os.path.join(directory, "movie.columnar.json")
+
+            f["name"] = utils.get_safe_name(f["info"]["title"])
+            f["json_path"] = run_serialize_json(f["analyzed"], os.path.join(analyzed_directory, f["name"] + ".json"))
+            f["analyzed_dict"] = columnar_format.read_analyzed(f["json_path"])
+            f["columnar_gzip_path"] = columnar_format.write_columnar(f["analyzed_dict"], os.path.join(directory, f["name"] + ".columnar.json"), "gzip")
+            characters = f["analyzed_dict"]["characters"]
+            f["top_characters"] = sorted(characters, key=lambda n: characters[n]["line_count"], reverse=True)[:TOP_CHARACTERS]
+            f["index_path"] = os.path.join(directory, f["name"] + ".idx")
+            builder.add_movie(f["info"], f["analyzed_dict"]["entries"])
+
+            # Phrase of the longest line, the most frequent word in the movie, and a word in the lines of its main character
+            longest = max((e.content for e in f["parsed"].entries if e.type == script_parser.TYPE_SPEECH), key=len)
+            f["index_queries"] = [(" ".join(dialogue_index.tokenize(longest)[:3]), {"phrase": True}), ("the", {"title": f["info"]["title"]})]
+            if len(f["top_characters"]) > 0:
+                f["index_queries"].append(("what", {"character": f["top_characters"][0]}))
+
+    builder.write(os.path.join(directory, "dialogue.idx"))
+    index = dialogue_index.DialogueIndex(os.path.join(directory, "dialogue.idx"))
+    db = corpus_db.CorpusDatabase(":memory:")
+    db.ingest([f["json_path"] for f in fixtures])
+    server = query_server.QueryServer(("127.0.0.1", 0), analyzed_directory)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+    for f in fixtures:
+        f["index"], f["db"], f["server"], f["connection"] = index, db, server, connection
+    return server
+
+
+def run_scan_errors(names, character_dict):
+    corrector = utils.ScanErrorCorrector(character_dict)
+    return [corrector.fix(n) for n in names]
+
+""" Look up a movie in a metadata store loaded from the file, by title, normalized title and safe name. """
+def run_metadata(title):
+    store = utils.MetadataStore()
+    return [store.get_by_title(title), store.get_by_normalized_title(title), store.get_by_safe_name(utils.get_safe_name(title))]
+
+""" Score texts with a new scorer (with an empty memo), sharing the VADER lexicon of the given analyzer. """
+def run_sentiment(analyzer, texts):
+    scorer = sentiment.SentimentScorer()
+    scorer.analyzer = analyzer
+    return scorer.score_batch(texts)
+
+def run_cooccurrences(movie):
+    movie.compute_cooccurrences()
+    return movie.cooccurrences_to_dict(sparse=True)
+
+def run_turns(movie):
+    movie.compute_turns()
+    return {"scenes": movie.scenes, "turns": movie.turns, "interactions": movie.interactions}
+
+def make_turns_movie(analyzed):
+    movie = make_analyzed_movie(analyzed)
+    movie.compute_turns()
+    return movie
+
+def run_interactions(movie, names):
+    return [movie.get_interactions(a, b) for a in names for b in names if a != b]
+
+def run_timelines(movie):
+    movie.compute_timelines()
+    return movie.timelines
+
+def run_serialize_json(analyzed, path):
+    streaming_format.write_movie(path, analyzed.parsed_script.info, (e.to_dict() for e in analyzed.entries), analyzed.characters, analyzed.iter_cooccurrence_rows(), analyzed.get_tables())
+    return path
+
+def run_serialize_columnar(analyzed, path):
+    return columnar_format.write_columnar(analyzed.to_dict(sparse_cooccurrences=True), path)
+
+def run_load_json(path):
+    with open(path) as f:
+        return streaming_format.strip_index(json.load(f))
+
+""" Read the co-occurrence row of a character and iterate over all entries of a file written by write_movie. """
+def run_streaming_read(path, name):
+    with streaming_format.StreamingMovieReader(path) as reader:
+        return reader.get_cooccurrence_row(name), sum(1 for _ in reader.iter_entries())
+
+def run_corpus_db_ingest(db, path):
+    with db.connection:
+        db.ingest_file(path)
+    return db
+
+def run_corpus_db_queries(db, title, names):
+    return [db.get_top_characters(10, title), db.get_top_cooccurrences(10, title), db.get_sentiment_timeline(title)] + [db.get_character_stats(n) for n in names]
+
+def run_index_build(info, entries, path):
+    builder = dialogue_index.IndexBuilder()
+    builder.add_movie(info, entries)
+    return builder.write(path)
+
+def run_index_search(index, queries):
+    return [[(h["title"], h["entry"]) for h in index.search(query, **options)] for query, options in queries]
+
+""" Request what the viewer needs for its first chart (movie summary, co-occurrences and direction timeline) from the
+    query server. Returns the status and size of each response. """
+def run_first_chart(connection, name):
+    url = "/api/movies/" + name
+    responses = []
+    for path in [url, url + "/cooccurrences", url + "/timeline?series=direction"]:
+        connection.request("GET", path, headers={"Accept-Encoding": "gzip"})
+        response = connection.getresponse()
+        responses.append((response.status, len(response.read())))
+    return responses
+
+""" Get the inputs of run_first_chart, emptying the cache of the query server so that it loads the movie again. """
+def get_first_chart_inputs(f):
+    f["server"].cache = query_server.MovieCache()
+    return [f["connection"], f["name"]]
+
+
+# Benchmark cases: (name, inputs of a fixture, function, summary of the output for correctness checks).
+# Inputs are built (and copied when the function modifies them) outside of the measurements.
+CASES = [
+    ("extract_script", lambda f: [f["page_data"]], script_fetcher.extract_script, build_manifest.hash_data),
+    ("preprocess", lambda f: [f["script"]], script_parser.preprocess_script, build_manifest.hash_data),
+    ("tokenize", lambda f: [f["preprocessed"]], lambda text: list(script_parser.tokenize_script(text)), build_manifest.hash_data),
+    ("parse_entries", lambda f: [f["info"], f["script"]], script_parser.parse_entries, summarize_parsed),
+    ("parse_movie", lambda f: [f["info"], True], script_parser.parse_movie, summarize_parsed),
+    ("finalize", lambda f: [copy.deepcopy(f["unfinalized"])], script_parser.MovieScript.finalize, None),
+    ("scan_errors", lambda f: [f["scan_error_names"], f["scan_error_dict"]], run_scan_errors, build_manifest.hash_data),
+    ("metadata", lambda f: [f["info"]["title"]], run_metadata, build_manifest.hash_data),
+    ("sentiment", lambda f: [f["sentiment_analyzer"], f["sentiment_texts"]], run_sentiment, build_manifest.hash_data),
+    ("analyze", lambda f: [copy.deepcopy(f["parsed"]), FixedScorer()], script_analyzer.AnalyzedMovieScript, lambda a: build_manifest.hash_data(a.to_dict())),
+    ("cooccurrences", lambda f: [make_analyzed_movie(f["analyzed_dict"])], run_cooccurrences, build_manifest.hash_data),
+    ("turns", lambda f: [make_analyzed_movie(f["analyzed_dict"])], run_turns, build_manifest.hash_data),
+    ("interactions", lambda f: [make_turns_movie(f["analyzed_dict"]), f["top_characters"]], run_interactions, build_manifest.hash_data),
+    ("timelines", lambda f: [make_turns_movie(f["analyzed_dict"])], run_timelines, build_manifest.hash_data),
+    ("entries_from_dicts", lambda f: [f["analyzed_dict"]["entries"]], script_parser.entries_from_dicts, lambda entries: build_manifest.hash_data([e.to_dict() for e in entries])),
+    ("serialize_json", lambda f: [f["analyzed"], f["output_path"]], run_serialize_json, summarize_file),
+    ("serialize_columnar", lambda f: [f["analyzed"], f["columnar_path"]], run_serialize_columnar, summarize_file),
+    ("load_json", lambda f: [f["json_path"]], run_load_json, build_manifest.hash_data),
+    ("load_columnar", lambda f: [f["columnar_gzip_path"]], columnar_format.read_analyzed, build_manifest.hash_data),
+    ("open_columnar", lambda f: [f["columnar_gzip_path"]], columnar_format.open_analyzed, lambda m: build_manifest.hash_data(m["characters"], list(m["entries"]))),
+    ("streaming_read", lambda f: [f["json_path"], next(iter(f["analyzed_dict"]["characters"]), None)], run_streaming_read, build_manifest.hash_data),
+    ("corpus_db_ingest", lambda f: [corpus_db.CorpusDatabase(":memory:"), f["json_path"]], run_corpus_db_ingest, lambda db: build_manifest.hash_data(db.get_top_characters(), db.get_top_cooccurrences())),
+    ("corpus_db_queries", lambda f: [f["db"], f["info"]["title"], f["top_characters"]], run_corpus_db_queries, build_manifest.hash_data),
+    ("index_build", lambda f: [f["info"], f["analyzed_dict"]["entries"], f["index_path"]], run_index_build, summarize_file),
+    ("index_search", lambda f: [f["index"], f["index_queries"]], run_index_search, build_manifest.hash_data),
+    ("query_server", get_first_chart_inputs, run_first_chart, build_manifest.hash_data),
+]
+
+
+""" Run a case once over all fixtures. Returns the total time and the summaries of the outputs, by title.
+    The garbage collector is disabled while measuring, like timeit does. """
+def run_case(case, fixtures):
+    name, get_inputs, fn, summarize = case
+    total, summaries = 0, dict()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for f in fixtures:
+            inputs = get_inputs(f)
+            gc.collect()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                output = fn(*inputs)
+                total += time.perf_counter() - start
+            finally:
+                gc.enable()
+            # finalize works in place
+            if name == "finalize":
+                output = summarize_parsed(inputs[0])
+            elif summarize != None:
+                output = summarize(output)
+            summaries[f["info"]["title"]] = output
+    return total, summaries
+
+
+""" Time a fixed workload of the interpreter (building, sorting and encoding dicts of strings). It is run before each
+    run of a case, so that timings are compared with the baseline relative to the speed of the machine at the time,
+    which varies from one run of the suite to the next on shared machines. """
+def calibrate():
+    gc.collect()
+    start = time.perf_counter()
+    rows = [{"name": "CHARACTER " + str(i % 997), "count": i, "cs": (i % 200 - 100) / 100} for i in range(CALIBRATION_ROWS)]
+    rows.sort(key=lambda r: (r["name"], -r["cs"]))
+    json.loads(json.dumps(rows))
+    return time.perf_counter() - start
+
+
+""" Get the time of a case relative to its baseline. Both are scaled by their calibration time when the baseline
+    has one. """
+def get_baseline_ratio(result, baseline):
+    if "calibration" in baseline:
+        return (result["time"] / result["calibration"]) / (baseline["time"] / baseline["calibration"])
+    return result["time"] / baseline["time"]
+
+
+""" Get the peak memory allocated by a case on any fixture. """
+def measure_memory(case, fixtures):
+    _, get_inputs, fn, _ = case
+    peak = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for f in fixtures:
+            inputs = get_inputs(f)
+            _, memory = peak_memory(fn, *inputs)
+            peak = max(peak, memory)
+    return peak
+
+
+def get_environment():
+    return {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor() or platform.machine(), "cpus": os.cpu_count()}
+
+
+""" Compare the summaries of a case against the expected ones. Returns the list of differences. """
+def check_summaries(name, summaries, expected):
+    if len(expected) == 0:
+        return [name + ": no expected outputs (see --update-expected)"]
+    differences = []
+    for title, summary in summaries.items():
+        if title not in expected:
+            differences.append(name + ": no expected output for '" + title + "'")
+        elif summary != expected[title]:
+            detail = ""
+            if isinstance(summary, dict) and "types" in summary:
+                detail = " (entry types " + json.dumps(expected[title]["types"]) + " -> " + json.dumps(summary["types"]) + ")"
+            differences.append(name + ": output changed for '" + title + "'" + detail)
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reproducible benchmark suite over frozen script fixtures, with correctness checks and a stored baseline.")
+    parser.add_argument("--only", nargs="+", choices=[c[0] for c in CASES], default=[c[0] for c in CASES], help="cases to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs of each case (default: 5)")
+    parser.add_argument("--no-memory", action="store_true", help="do not measure memory peaks")
+    parser.add_argument("--freeze", action="store_true", help="rebuild the fixtures from data/analyzed and store the current outputs as the expected ones")
+    parser.add_argument("--update-expected", action="store_true", help="store the current outputs of the cases run as the expected ones, after an intended change of their outputs")
+    parser.add_argument("--save-baseline", action="store_true", help="store the timings of the cases run in the baseline (the other cases keep their recorded timings)")
+    parser.add_argument("--check", action="store_true", help="exit with an error when a case with a recorded baseline regresses, not only on outputs differing from the expected ones")
+    args = parser.parse_args()
+
+    fixtures = freeze_fixtures() if args.freeze else load_fixtures()
+    cases = [c for c in CASES if c[0] in args.only]
+    expected = dict()
+    if os.path.exists(EXPECTED_FILE) and not args.freeze:
+        with open(EXPECTED_FILE) as f:
+            expected = json.load(f)
+    baseline = None
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+        if baseline["environment"] != get_environment():
+            print("Note: the baseline was recorded on another environment:", baseline["environment"])
+
+    print("Benchmark suite:", len(fixtures), "fixtures, best and median of", args.repeat, "runs")
+    results, differences, regressions = dict(), [], []
+    with tempfile.TemporaryDirectory() as directory:
+        server = prepare_fixtures(fixtures, directory)
+        # The prepared inputs are not traversed again by the collection before each measurement
+        gc.collect()
+        gc.freeze()
+        try:
+            for case in cases:
+                name = case[0]
+                case_baseline = baseline["cases"].get(name) if baseline != None else None
+                times, calibrations = [], []
+                for attempt in range(1 + REGRESSION_CONFIRMATIONS):
+                    for _ in range(args.repeat):
+                        calibrations.append(calibrate())
+                        elapsed, summaries = run_case(case, fixtures)
+                        times.append(elapsed)
+                    results[name] = {"time": min(times), "median": statistics.median(times), "calibration": min(calibrations)}
+                    # A case slower than its baseline is measured again before it is reported as a regression
+                    if not args.check or case_baseline == None or get_baseline_ratio(results[name], case_baseline) <= REGRESSION_THRESHOLD:
+                        break
+                if not args.no_memory:
+                    results[name]["memory_peak"] = measure_memory(case, fixtures)
+
+                if args.freeze or args.update_expected:
+                    expected[name] = summaries
+                else:
+                    differences += check_summaries(name, summaries, expected.get(name, dict()))
+
+                line = "  {:<20} best {:9.2f} ms  median {:9.2f} ms".format(name, results[name]["time"]*1000, results[name]["median"]*1000)
+                if "memory_peak" in results[name]:
+                    line += "  peak {:7.2f} MB".format(results[name]["memory_peak"] / 2**20)
+                if case_baseline != None:
+                    ratio = get_baseline_ratio(results[name], case_baseline)
+                    line += "  {:5.2f}x baseline".format(ratio)
+                    if ratio > REGRESSION_THRESHOLD:
+                        line += "  REGRESSION"
+                        regressions.append(name)
+                else:
+                    line += "  no baseline"
+                print(line)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    if args.freeze or args.update_expected:
+        with open(EXPECTED_FILE, "w") as f:
+            json.dump({c[0]: expected[c[0]] for c in CASES if c[0] in expected}, f, indent=1)
+        print("Expected outputs written to", EXPECTED_FILE)
+    if args.save_baseline:
+        # Only the cases run are recorded again, so that a request re-records the cases it changes
+        cases_baseline = baseline["cases"] if baseline != None else dict()
+        cases_baseline.update(results)
+        with open(BASELINE_FILE, "w") as f:
+            json.dump({"environment": get_environment(), "repeat": args.repeat, "cases": {c[0]: cases_baseline[c[0]] for c in CASES if c[0] in cases_baseline}}, f, indent=1)
+        print("Baseline written to", BASELINE_FILE)
+
+    if len(differences) > 0:
+        print("\nOutputs differ from the expected ones:", *differences, sep="\n  ")
+        sys.exit(1)
+    print("All outputs match the expected ones.")
+    if args.check and len(regressions) > 0:
+        print("Regressions (more than {:.0%} slower than the baseline):".format(REGRESSION_THRESHOLD - 1), ", ".join(regressions))
+        sys.exit(1)
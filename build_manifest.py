@@ -0,0 +1,130 @@
+import ast
+import hashlib
+import json
+import os
+from importlib import metadata
+
+import config
+import utils
+
+# Stages of the analysis of a movie, in order. Each stage is re-executed when the hash of its inputs changes:
+# the output of the previous stage and the version of the code of the stage.
+STAGES = ["fetch", "parse", "sentiment", "analysis", "output"]
+
+# Code of each stage, as (file, functions). Stages only depend on the given functions of a file,
+# or on the whole file when no function is given.
+STAGE_SOURCES = {
+    "parse": [("script_parser.py", None), ("utils.py", None)],
+    "sentiment": [("sentiment.py", None), ("script_analyzer.py", ["AnalyzedMovieScript.compute_sentiment"])],
+    "analysis": [("script_analyzer.py", ["AnalyzedMovieScript.compute_characters", "AnalyzedMovieScript.compute_cooccurrences", "AnalyzedMovieScript.compute_turns",
+        "AnalyzedMovieScript.compute_timelines", "compute_timelines", "make_scene_timeline", "smooth_moving_window", "make_timeline"])],
+    "output": [("script_analyzer.py", ["AnalyzedMovieScript.iter_cooccurrence_rows", "AnalyzedMovieScript.cooccurrences_to_dict", "AnalyzedMovieScript.to_dict",
+        "AnalyzedMovieScript.get_tables", "save_analyzed_movie"]), ("columnar_format.py", None), ("streaming_format.py", None)],
+}
+
+""" Hash JSON-serializable data. """
+def hash_data(*data):
+    return hashlib.sha256(json.dumps(data, separators=(",", ":"), default=str).encode("utf-8")).hexdigest()
+
+""" Hash the source of the given functions of a Python file (e.g. "Class.method"), or of the whole file. """
+def hash_source(path, functions=None):
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    if functions == None:
+        return hash_data(source)
+
+    # Index the top-level functions and the methods of top-level classes
+    definitions = dict()
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.ClassDef):
+            for child in node.body:
+                if isinstance(child, ast.FunctionDef):
+                    definitions[node.name + "." + child.name] = child
+        elif isinstance(node, ast.FunctionDef):
+            definitions[node.name] = node
+    return hash_data([ast.get_source_segment(source, definitions[name]) for name in functions])
+
+
+""" Get the version of the code of each stage, as a hash of its source. """
+def get_stage_versions():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    versions = dict()
+    for stage, sources in STAGE_SOURCES.items():
+        versions[stage] = hash_data([hash_source(os.path.join(directory, path), functions) for path, functions in sources])
+
+    # Sentiment scores also depend on the VADER lexicon shipped with nltk
+    try:
+        nltk_version = metadata.version("nltk")
+    except metadata.PackageNotFoundError:
+        nltk_version = None
+    versions["sentiment"] = hash_data(versions["sentiment"], nltk_version)
+    return versions
+
+
+""" Get the size and modification time of a file, or None if it does not exist. """
+def stat_file(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+""" Record of the stages run for every movie of the corpus, used to only re-execute the stages whose inputs changed.
+    For every movie, the manifest keeps the hash of the raw script, the key (hash of the inputs) of each stage,
+    the hash of the output of the parse and sentiment stages, and the path, size and modification time
+    of the output file. """
+class BuildManifest:
+    def __init__(self, path=None):
+        path = config.BUILD_MANIFEST_FILE if path == None else path
+        self.path = path
+        try:
+            with open(path) as f:
+                self.records = json.load(f)
+        except (OSError, ValueError):
+            self.records = dict()
+
+
+    def get(self, movie):
+        return self.records.get(movie["title"])
+
+
+    def set(self, movie, record):
+        if record == None:
+            self.records.pop(movie["title"], None)
+        else:
+            self.records[movie["title"]] = record
+
+
+    """ Write the manifest to file, atomically. """
+    def save(self):
+        with utils.write_atomic(self.path) as f:
+            json.dump(self.records, f)
+
+
+""" Compute the key of a stage from the output of the previous stage. """
+def stage_key(stage, versions, previous_output, options=None):
+    if stage == "output":
+        return hash_data(previous_output, versions[stage], options["output_format"], options["compression"])
+    return hash_data(previous_output, versions[stage])
+
+
+""" Check whether the output file of a record is still the one written when the record was made. """
+def is_output_intact(record):
+    return "output" in record and stat_file(record["output"]["path"]) == record["output"]["file"]
+
+
+""" Check whether all stages of a movie are up to date, without reading its script or output file.
+    raw_hash is the hash of the current raw script, or None to assume it did not change. """
+def is_up_to_date(record, movie, raw_hash, versions, options):
+    if record == None:
+        return False
+    if raw_hash != None and raw_hash != record["raw"]:
+        return False
+    if record["status"] == "skipped":
+        return True
+    return (record["parse"]["key"] == stage_key("parse", versions, [record["raw"], movie])
+        and record["sentiment"]["key"] == stage_key("sentiment", versions, record["parse"]["output"])
+        and record["analysis"]["key"] == stage_key("analysis", versions, record["sentiment"]["output"])
+        and record["output"]["key"] == stage_key("output", versions, record["analysis"]["key"], options)
+        and is_output_intact(record))
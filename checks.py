@@ -0,0 +1,936 @@
+import argparse
+import contextlib
+import copy
+import csv
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+
+import config
+import utils
+import cli
+import columnar_format
+import corpus_db
+import dialogue_index
+import imsdb_stub
+import script_fetcher
+import script_parser
+import script_analyzer
+import sentiment
+import streaming_format
+
+# Commands of cli.py that must start quickly, in addition to the help of every command
+QUICK_COMMANDS = [["list"], ["query", "top-characters"]]
+HEAVY_MODULES = ["numpy", "bs4", "requests", "matplotlib", "nltk"]
+IMPORT_TIME_BUDGET = 0.15 # seconds
+# Import times are the best of several runs, as they vary with the load of the machine
+IMPORT_TIME_RUNS = 3
+# Random scripts of the co-occurrence check: (number of characters, number of entries)
+COOCCURRENCE_SCRIPTS = [(1, 20), (5, 200), (30, 2000), (200, 5000)]
+# Number of movies added to the stub website for the resumed crawl, and of pages fetched before the interruption
+CRAWL_NEW_MOVIES = 60
+CRAWL_INTERRUPT_AFTER = 20
+# Number of characters with the most lines of each movie, whose interactions are checked
+INTERACTION_CHARACTERS = 10
+# Queries of the dialogue index check: (query, options of DialogueIndex.search)
+DIALOGUE_QUERIES = [
+    ("the", dict()),
+    ("love", dict()),
+    ("ship iceberg", dict()),
+    ("i'll be back", {"phrase": True}),
+    ("may the force be with you", {"phrase": True}),
+    ("what", {"character": "HAN"}),
+    ("good", {"min_cs": 0.5}),
+]
+
+""" Run a command with python -X importtime. Returns the total import time (in seconds) and the imported modules. """
+def measure_imports(command):
+    process = subprocess.run([sys.executable, "-X", "importtime"] + command, capture_output=True, text=True, check=True)
+    total, modules = 0, []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        modules.append(name.strip())
+        # Top-level imports are indented by one space, the modules they import by more
+        if len(name) - len(name.lstrip()) == 1:
+            total += int(cumulative) / 1e6
+    return total, modules
+
+
+""" Check that the quick commands and the help of every command of cli.py start within the import time budget,
+    without importing heavy modules. """
+def check_imports():
+    problems = []
+    for command in QUICK_COMMANDS + [[name, "--help"] for name in cli.COMMANDS]:
+        measures = [measure_imports(["cli.py"] + command) for _ in range(IMPORT_TIME_RUNS)]
+        total = min(t for t, _ in measures)
+        heavy = [m for m in HEAVY_MODULES if m in measures[0][1]]
+        print("  {:<30} {:7.1f} ms  {}".format(" ".join(command), total*1000, "imports " + ", ".join(heavy) if len(heavy) > 0 else ""))
+        if total > IMPORT_TIME_BUDGET:
+            problems.append("'" + " ".join(command) + "' takes {:.0f} ms to import its modules (budget: {:.0f} ms)".format(total*1000, IMPORT_TIME_BUDGET*1000))
+        if len(heavy) > 0:
+            problems.append("'" + " ".join(command) + "' imports " + ", ".join(heavy))
+    return problems
+
+
+""" The original dict-of-dicts co-occurrence matrix, kept as a reference. """
+def legacy_create_cooccurrences_matrix(character_names, entries):
+    m = dict()
+    for namei in character_names:
+        m[namei] = dict()
+        for namej in character_names:
+            m[namei][namej] = {"count": 0, "avg_cs": 0}
+
+    characters_in_scene = dict()
+    for i,e in enumerate(entries):
+        if e["type"] == script_parser.TYPE_LOCATION:
+            if len(characters_in_scene) > 0:
+                for namei in characters_in_scene:
+                    avg_cs_i = (characters_in_scene[namei]["sum_cs"] / characters_in_scene[namei]["num_lines"])
+                    for namej in characters_in_scene:
+                        avg_cs_j = (characters_in_scene[namej]["sum_cs"] / characters_in_scene[namej]["num_lines"])
+                        mutual_cs = (avg_cs_i + avg_cs_j) / 2
+                        c = m[namei][namej]["count"]
+                        m[namei][namej]["avg_cs"] = (m[namei][namej]["avg_cs"] * c + mutual_cs) / (c + 1)
+                        m[namei][namej]["count"] += 1
+            characters_in_scene = dict()
+        if e["type"] == script_parser.TYPE_CHARACTER:
+            name = e["content"]
+            if not name in characters_in_scene:
+                characters_in_scene[name] = {"sum_cs": 0, "num_lines": 0}
+            characters_in_scene[name]["num_lines"] += 1
+            if i+1 < len(entries) and entries[i+1]["type"] == script_parser.TYPE_SPEECH:
+                characters_in_scene[name]["sum_cs"] += entries[i+1]["cs"]
+    return m
+
+
+""" Compare two co-occurrence matrices (as dicts), up to floating point rounding of the averages. Returns the list
+    of differences. """
+def compare_cooccurrences(expected, actual, title):
+    if list(expected) != list(actual):
+        return ["co-occurrence characters differ for '" + title + "'"]
+    for namei in expected:
+        for namej, cell in expected[namei].items():
+            other = actual[namei][namej]
+            if cell["count"] != other["count"] or abs(cell["avg_cs"] - other["avg_cs"]) > 1e-9:
+                return ["co-occurrences differ for '" + title + "' (" + namei + ", " + namej + ")"]
+    return []
+
+
+""" Make a random script of the given size: scenes of character lines (followed by speech or not) and directions,
+    including characters that never appear and scenes without characters. """
+def make_random_script(rng, num_characters, num_entries):
+    names = ["CHARACTER " + str(i) for i in range(num_characters)]
+    # Some characters never appear
+    appearing = names[:max(1, num_characters * 3 // 4)]
+    entries = []
+    while len(entries) < num_entries:
+        r = rng.random()
+        if r < 0.08:
+            entries.append({"type": script_parser.TYPE_LOCATION, "content": "INT. ROOM", "cs": None})
+        elif r < 0.25:
+            entries.append({"type": script_parser.TYPE_DIRECTION, "content": "Direction", "cs": round(rng.uniform(-1, 1), 4)})
+        else:
+            entries.append({"type": script_parser.TYPE_CHARACTER, "content": rng.choice(appearing), "cs": None})
+            if rng.random() < 0.9:
+                entries.append({"type": script_parser.TYPE_SPEECH, "content": "Speech", "cs": round(rng.uniform(-1, 1), 4)})
+    movie = script_analyzer.AnalyzedMovieScript.__new__(script_analyzer.AnalyzedMovieScript)
+    movie.character_names = names
+    movie.entries = script_parser.entries_from_dicts(entries)
+    return movie
+
+
+""" Check that the NumPy co-occurrence matrices give the same co-occurrences as the original dict-of-dicts matrix,
+    as dense and sparse dicts, on random scripts. """
+def check_cooccurrences():
+    rng = random.Random(0)
+    problems = []
+    for num_characters, num_entries in COOCCURRENCE_SCRIPTS:
+        title = str(num_characters) + " characters, " + str(num_entries) + " entries"
+        movie = make_random_script(rng, num_characters, num_entries)
+        expected = legacy_create_cooccurrences_matrix(movie.character_names, movie.entries)
+        movie.compute_cooccurrences()
+        problems += compare_cooccurrences(expected, movie.cooccurrences_to_dict(), title)
+
+        # Sparse rows only leave out the pairs that never share a scene
+        sparse = movie.cooccurrences_to_dict(sparse=True)
+        nonzero = {name: {other: cell for other, cell in row.items() if cell["count"] > 0} for name, row in expected.items()}
+        if list(sparse) != list(nonzero) or any(set(sparse[name]) != set(nonzero[name]) for name in nonzero):
+            problems.append("sparse co-occurrence pairs differ for '" + title + "'")
+        else:
+            problems += compare_cooccurrences(nonzero, sparse, title + " (sparse)")
+        print("  {:<40} {:>5} scenes".format(title, sum(e.type == script_parser.TYPE_LOCATION for e in movie.entries)))
+    return problems
+
+
+""" Get the metadata file rows expected from a crawl of the given stub movies, as movies (see utils.array_to_movie). """
+def get_expected_metadata(movies):
+    expected = []
+    for title, authors, script_page in movies:
+        if script_page != None and script_page.lower().endswith(".html"):
+            listed_title = title[:-5] if title.lower().endswith(", the") else title
+            expected.append({"title": listed_title, "authors": authors, "page": imsdb_stub.get_movie_page(title), "script_page": script_page})
+    return expected
+
+
+""" Check the metadata crawl against the stub website: a full crawl fetches every movie page, a refresh of an unchanged
+    website only requests the list of scripts, and an interrupted incremental crawl resumes without fetching the pages
+    it already fetched (missing pages are fetched again by the next crawl). """
+def check_crawl():
+    import fetch_movie_metadata
+    problems = []
+    server = imsdb_stub.StubServer().start()
+    metadata_file = config.MOVIES_METADATA_FILE
+    add_specific_movie_data = fetch_movie_metadata.add_specific_movie_data
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            config.MOVIES_METADATA_FILE = os.path.join(directory, "movies_metadata.csv")
+            state_path = os.path.join(directory, "crawl_state.json")
+            def crawl(incremental):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    fetch_movie_metadata.crawl(4, 0, server.url, incremental, state_path)
+                return server.pop_requests()
+
+            # Full crawl
+            requests = crawl(False)
+            if sorted(requests) != sorted(["/all scripts"] + [imsdb_stub.get_movie_page(m[0]) for m in server.movies]):
+                problems.append("the full crawl did not request every movie page once")
+            if utils.get_all_movies_metadata() != get_expected_metadata(server.movies):
+                problems.append("the metadata file of the full crawl differs from the stub website")
+
+            # Refresh of an unchanged website
+            requests = crawl(True)
+            if requests != ["/all scripts"]:
+                problems.append("the refresh of an unchanged website sent " + str(len(requests)) + " requests instead of 1")
+
+            # New movies and a movie whose page changed, crawled until an interruption (as with Ctrl+C)
+            movies = list(server.movies)
+            movies[0] = (movies[0][0] + " (Director's Cut)", movies[0][1], movies[0][2])
+            movies += [("New Movie " + str(i), ["Author " + str(i)], "/scripts/New-Movie-" + str(i) + ".html") for i in range(CRAWL_NEW_MOVIES)]
+            server.set_movies(movies)
+            to_fetch = {imsdb_stub.get_movie_page(m[0]) for m in movies} - {imsdb_stub.get_movie_page(m[0]) for m in imsdb_stub.MOVIES}
+            with open(config.MOVIES_METADATA_FILE, "rb") as f:
+                previous_metadata = f.read()
+            lock, fetched = threading.Lock(), [0]
+            def interrupted_add_specific_movie_data(*args):
+                with lock:
+                    fetched[0] += 1
+                    if fetched[0] > CRAWL_INTERRUPT_AFTER:
+                        raise KeyboardInterrupt()
+                add_specific_movie_data(*args)
+            fetch_movie_metadata.add_specific_movie_data = interrupted_add_specific_movie_data
+            try:
+                crawl(True)
+                problems.append("the crawl was not interrupted")
+            except KeyboardInterrupt:
+                pass
+            finally:
+                fetch_movie_metadata.add_specific_movie_data = add_specific_movie_data
+            requests = server.pop_requests()
+            with open(config.MOVIES_METADATA_FILE, "rb") as f:
+                if f.read() != previous_metadata:
+                    problems.append("the interrupted crawl changed the metadata file")
+
+            # Resumed crawl, with a missing page
+            state = fetch_movie_metadata.CrawlState(state_path)
+            remaining = {page for page in to_fetch if not state.has_page(page)}
+            if len(to_fetch) - len(remaining) < CRAWL_INTERRUPT_AFTER // 2:
+                problems.append("the interrupted crawl only recorded " + str(len(to_fetch) - len(remaining)) + " fetched pages")
+            missing = imsdb_stub.get_movie_page(movies[-1][0])
+            server.missing.add(missing)
+            requests = crawl(True)
+            if sorted(requests) != sorted(["/all scripts"] + list(remaining | {missing})):
+                problems.append("the resumed crawl fetched " + str(len(requests) - 1) + " pages instead of the " + str(len(remaining | {missing})) + " pages left")
+            if utils.get_all_movies_metadata() != get_expected_metadata(movies[:-1]):
+                problems.append("the metadata file of the resumed crawl differs from the stub website")
+
+            # The next crawl only fetches the missing page again
+            server.missing.clear()
+            requests = crawl(True)
+            if sorted(requests) != sorted(["/all scripts", missing]):
+                problems.append("the crawl after a missing page sent " + str(len(requests)) + " requests instead of 2")
+            if utils.get_all_movies_metadata() != get_expected_metadata(movies):
+                problems.append("the metadata file differs from the stub website after the missing page was fetched")
+            print("  {} movies, {} pages fetched before the interruption, {} after".format(len(movies), len(to_fetch) - len(remaining), len(remaining)))
+    finally:
+        config.MOVIES_METADATA_FILE = metadata_file
+        server.stop()
+    return problems
+
+
+""" Compare nested results, with a tolerance on floats (e.g. SQLite and Python may sum in a different order). """
+def all_close(a, b):
+    if isinstance(a, float) and isinstance(b, (int, float)):
+        return abs(a - b) <= 1e-9
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(all_close(a[key], b[key]) for key in a)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(all_close(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+""" Merge analyzed movies into one script with distinct characters, to stress quadratic costs. """
+def merge_analyzed_movies(analyzed_movies):
+    merged = {"info": {"title": "(all movies merged)"}, "entries": [], "characters": dict()}
+    for m in analyzed_movies:
+        prefix = m["info"]["title"] + "/"
+        for e in m["entries"]:
+            if e["type"] == script_parser.TYPE_CHARACTER:
+                e = dict(e, content=prefix + e["content"])
+            merged["entries"].append(e)
+        for name, c in m["characters"].items():
+            merged["characters"][prefix + name] = dict(c, name=prefix + name)
+    return merged
+
+
+# Analyzed corpus and raw scripts rebuilt from it, loaded on first use
+corpus = None
+
+""" Get the analyzed corpus and the raw scripts rebuilt from it, loaded once for all the checks that use them. """
+def get_corpus():
+    global corpus
+    if corpus == None:
+        import benchmark_suite
+        analyzed_movies = benchmark_suite.load_analyzed()
+        corpus = (analyzed_movies, [(m["info"]["title"], benchmark_suite.synthesize_raw_script(m["entries"])) for m in analyzed_movies])
+    return corpus
+
+
+""" Check the targeted scanner of script pages against BeautifulSoup on the analyzed corpus, with the canonical markup
+    of IMSDb pages and with markup the scanner has to normalize (uppercase tags, <br> and entities). """
+def check_extract():
+    import benchmark_suite
+    analyzed_movies, _ = get_corpus()
+    problems = []
+    for analyzed in analyzed_movies:
+        page = benchmark_suite.synthesize_script_page(analyzed)
+        start, end = page.index("<pre>") + 5, page.index("</pre>")
+        markup = page[:start] + page[start:end].replace("<b>", "<B>").replace("</b>", "</B>").replace("\n\n", "<br>\n", 100).replace(" - ", " &nbsp;&amp; ") + page[end:]
+        for name, variant in [("canonical", page), ("markup", markup)]:
+            data = variant.encode("utf-8")
+            if script_fetcher.scan_script(data) != script_fetcher.extract_script_soup(data):
+                problems.append("extracted scripts differ for '" + analyzed["info"]["title"] + "' (" + name + " markup)")
+    print("  {} script pages, 2 markups each".format(len(analyzed_movies)))
+    return problems
+
+
+# The original preprocessing chain of parse_movie, as (stage, function) passes, kept as a reference
+LEGACY_PREPROCESS_STAGES = [
+    ("\\r", lambda text: re.sub("\r", "", text)),
+    ("<br>", lambda text: re.sub("<br>", "\n", text)),
+    ("<br/>", lambda text: re.sub("<br/>", "\n", text)),
+    ("spaces before </b>", lambda text: re.sub("(?<=[^ ])( +)(?=</b>)", "", text)),
+] + [("line breaks out of <b> #" + str(i+1), lambda text: re.sub("<b>( *)\n(?=(\s|\n)*</b>)", "\n<b>", text)) for i in range(4)] + [
+    ("empty <b>", lambda text: re.sub("<b>(\s)*</b>", "", text)),
+    ("blank lines", lambda text: re.sub(r"\n( *)\n", r"\n\n", text)),
+]
+
+""" The original basic_cleanup of entries, kept as a reference. """
+def legacy_basic_cleanup(l):
+    for x in ["<b>", "</b>", "<pre>", "</pre>", "<html>", "</html>"]:
+        l = l.replace(x, "")
+    l = l.strip()
+    l = re.sub(r"[\t ]+", " ", l)
+    return l
+
+
+""" Check the fused preprocessing of parse_movie against the original chain of passes, and basic_cleanup against its
+    original version on all raw entries, on the raw scripts rebuilt from the analyzed corpus. """
+def check_preprocess():
+    _, raw_scripts = get_corpus()
+    problems, segments = [], []
+    for title, raw_script in raw_scripts:
+        # IMSDb pages are served with \r\n line breaks
+        raw_script = raw_script.replace("\n", "\r\n")
+        expected = raw_script
+        for _, fn in LEGACY_PREPROCESS_STAGES:
+            expected = fn(expected)
+        actual = script_parser.preprocess_script(raw_script)
+        if actual != expected:
+            problems.append("preprocessed scripts differ for '" + title + "'")
+        for segment, is_bold in script_parser.tokenize_script(actual):
+            segments += [segment] if is_bold else segment.split("\n\n")
+    if [script_parser.basic_cleanup(l) for l in segments] != [legacy_basic_cleanup(l) for l in segments]:
+        problems.append("cleaned-up entries differ")
+    print("  {} scripts, {} raw entries".format(len(raw_scripts), len(segments)))
+    return problems
+
+
+""" The original slice-and-search tokenizer of parse_movie, kept as a reference. """
+def legacy_tokenize_script(text):
+    exp_bold = re.compile(r"(?<=(<b>))(.|\n|\s)*?(?=(</b>))")
+    exp_until_bold = re.compile(r"(.|\n|\s)*?(?=<b>|$)")
+
+    while True:
+        match = exp_until_bold.search(text)
+
+        if len(match.group()) > 0:
+            yield match.group(), False
+            text = text[match.end():]
+        else:
+            bold_match = exp_bold.search(text)
+
+            if bold_match == None and len(match.group()) == 0:
+                break
+
+            if bold_match != None:
+                text = text[bold_match.end() + 4:]
+                yield bold_match.group(), True
+
+
+""" Parse a raw script with the given tokenizer, silencing the parser output. """
+def parse_with_tokenizer(tokenize, raw_script):
+    original = script_parser.tokenize_script
+    script_parser.tokenize_script = tokenize
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return script_parser.parse_raw_script({"title": ""}, raw_script)
+    finally:
+        script_parser.tokenize_script = original
+
+
+""" Check the single-pass tokenizer against the original one, on its tokens and on the parsed entries. """
+def check_tokenizer():
+    _, raw_scripts = get_corpus()
+    problems = []
+    for title, raw_script in raw_scripts:
+        text = script_parser.preprocess_script(raw_script)
+        if list(legacy_tokenize_script(text)) != list(script_parser.tokenize_script(text)):
+            problems.append("tokens differ for '" + title + "'")
+        elif parse_with_tokenizer(legacy_tokenize_script, raw_script).entries != parse_with_tokenizer(script_parser.tokenize_script, raw_script).entries:
+            problems.append("parsed entries differ for '" + title + "'")
+    print("  {} scripts".format(len(raw_scripts)))
+    return problems
+
+
+# Classifier patterns of the original MovieScript.classify_entry_type
+legacy_exp_location = re.compile("INT\.|EXT\.|INT |EXT |INT:|EXT:|INTERIOR|EXTERIOR|EXT/INT|INT/EXT|I/E|INSIDE|OUTSIDE| ROOM")
+legacy_exp_location_2 = re.compile("^\s*[0-9]+[A-Z]{0,1}\s*[A-Z]+")
+legacy_exp_direction = re.compile("FADE |FADES |THE END|- END |- THE END |CREDITS|END CREDITS|CUT TO|CUT BACK TO|(\()*CONTINUED|\(MORE\)|TITLE |\(INTERCUT\)|ANGLE|CLOSE ON |CLOSE UP| SHOT|THEIR POV|\'S POV|WIDER ON|WIDE ON|CLOSER ON|CLOSE ON|RESUME ON|^\s*ON | VIEW|LATER| SHOTS|DISSOLVE|SUPER:|IN THE |UNDER THE |OVER THE |BACK ON |UP ON |FROM |CLOSEUP|CAMERA|IMAGE:")
+legacy_exp_direction_continued = re.compile("^(\s)*[0-9    ]*(\s)*(\()*CONTINUED")
+legacy_exp_number_period = re.compile("^(\s|\n)*[0-9]+\.(\s|\n)*$")
+legacy_exp_character_colon_speech = re.compile("^[\t ]*[0-9A-Z\- l]+(?=\: [a-zA-Z!() ]+)")
+legacy_exp_direction_colon_ending = re.compile("\:\s*$")
+legacy_exp_direction_period_ending = re.compile("\.\s*$")
+legacy_exp_numeric_only = re.compile("^\s*[0-9]+\s*$")
+legacy_exp_parenthesis_caps = re.compile("^(\s|\n)*\([A-Z 0-9`]+\)(\s|\n)*$")
+
+""" The original if/elif cascade of MovieScript.classify_entry_type, kept as a reference. """
+def legacy_classify_entry_type(self, raw, is_bold):
+    is_first = len(self.entries) == 0
+
+    entry_type = script_parser.TYPE_DIRECTION
+
+    if legacy_exp_number_period.search(raw) != None or legacy_exp_numeric_only.search(raw) != None:
+        entry_type = script_parser.TYPE_DIRECTION
+    else:
+        if is_bold and (legacy_exp_location.search(raw) != None or legacy_exp_location_2.search(raw) != None):
+            entry_type = script_parser.TYPE_LOCATION
+            self.meta_finished = True
+        elif legacy_exp_direction.search(raw) != None:
+            entry_type = script_parser.TYPE_DIRECTION
+            self.meta_finished = True
+        elif legacy_exp_character_colon_speech.search(raw) != None:
+            match = legacy_exp_character_colon_speech.search(raw)
+            character_name = match.group().strip()
+            character_name = character_name.replace("l", "I")
+            self.entries.append(script_parser.Entry(script_parser.TYPE_CHARACTER, character_name))
+            entry_type = script_parser.TYPE_SPEECH
+            raw = raw[match.end()+1:]
+        elif is_bold:
+            if legacy_exp_direction_continued.search(raw) != None or legacy_exp_direction_colon_ending.search(raw) != None or legacy_exp_direction_period_ending.search(raw) != None:
+                entry_type = script_parser.TYPE_DIRECTION
+            elif (not is_first) and self.entries[-1]["type"] == script_parser.TYPE_CHARACTER:
+                entry_type == script_parser.TYPE_SPEECH
+            elif "!" in raw or raw.strip().count(" ") >= 4:
+                entry_type = script_parser.TYPE_SPEECH
+            elif legacy_exp_parenthesis_caps.search(raw) != None:
+                if (not is_first) and self.entries[-1]["type"] in [script_parser.TYPE_CHARACTER, script_parser.TYPE_SPEECH]:
+                    entry_type = script_parser.TYPE_SPEECH
+                else:
+                    entry_type = script_parser.TYPE_DIRECTION
+            else:
+                entry_type = script_parser.TYPE_CHARACTER
+        else:
+            if legacy_exp_location.search(raw) != None:
+                entry_type = script_parser.TYPE_LOCATION
+                self.meta_finished = True
+            elif legacy_exp_direction_colon_ending.search(raw) != None:
+                entry_type = script_parser.TYPE_DIRECTION
+            elif (not is_first) and self.entries[-1]["type"] in [script_parser.TYPE_CHARACTER, script_parser.TYPE_SPEECH]:
+                entry_type = script_parser.TYPE_SPEECH
+
+    if not self.meta_finished:
+        entry_type = script_parser.TYPE_META
+
+    return entry_type, raw
+
+
+""" Split a raw script into entries with the given classifier. """
+def parse_entries_with_classifier(classify, raw_script):
+    original = script_parser.MovieScript.classify_entry_type
+    script_parser.MovieScript.classify_entry_type = classify
+    try:
+        return script_parser.parse_entries({"title": ""}, raw_script)
+    finally:
+        script_parser.MovieScript.classify_entry_type = original
+
+
+""" Check the rule-based entry classifier against the original cascade. """
+def check_classifier():
+    _, raw_scripts = get_corpus()
+    problems = []
+    for title, raw_script in raw_scripts:
+        expected = parse_entries_with_classifier(legacy_classify_entry_type, raw_script)
+        actual = parse_entries_with_classifier(script_parser.MovieScript.classify_entry_type, raw_script)
+        if expected.entries != actual.entries or expected.meta_finished != actual.meta_finished:
+            problems.append("classified entries differ for '" + title + "'")
+    print("  {} scripts".format(len(raw_scripts)))
+    return problems
+
+
+""" The original MovieScript.finalize, kept as a reference. """
+def legacy_finalize(movie_script):
+    character_dict = movie_script.create_character_occurrence_dict()
+
+    for i,e in enumerate(movie_script.entries):
+        if e["type"] in [script_parser.TYPE_SPEECH, script_parser.TYPE_DIRECTION]:
+            text = e["content"]
+            text = re.sub("\s*\(([a-zA-Z]|\s)+\)", "", text, count=1)
+            lines = text.split("\n")
+
+            for name in character_dict:
+                if name == lines[0]:
+                    e["type"] = script_parser.TYPE_CHARACTER
+                    e["content"] = name
+
+                    if len(lines) > 1:
+                        speech_entry = script_parser.Entry(script_parser.TYPE_SPEECH, " ".join(lines[1:]))
+                        movie_script.entries.insert(i+1, speech_entry)
+                    break
+
+    for e in movie_script.entries:
+        if e["type"] == script_parser.TYPE_CHARACTER:
+            e["content"] = utils.fix_scan_errors(e["content"], character_dict)
+
+    character_dict = movie_script.create_character_occurrence_dict()
+    print("Cleaned-up character occurrences:", character_dict, sep="\n")
+
+    for i in range(1, len(movie_script.entries)):
+        if movie_script.entries[i]["type"] == script_parser.TYPE_SPEECH and movie_script.entries[i-1]["type"] != script_parser.TYPE_CHARACTER:
+            movie_script.entries[i]["type"] = script_parser.TYPE_DIRECTION
+
+    for e in movie_script.entries:
+        e["content"] = e["content"].replace("\n", "")
+
+    for e in movie_script.entries:
+        if e["type"] == script_parser.TYPE_CHARACTER:
+            name = e["content"]
+            if not(name in movie_script.character_names):
+                movie_script.character_names.append(name)
+
+
+""" Check MovieScript.finalize against the original implementation. """
+def check_finalize():
+    _, raw_scripts = get_corpus()
+    problems = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for title, raw_script in raw_scripts:
+            expected = script_parser.parse_entries({"title": title}, raw_script)
+            actual = copy.deepcopy(expected)
+            legacy_finalize(expected)
+            actual.finalize()
+            if expected.entries != actual.entries or expected.character_names != actual.character_names:
+                problems.append("finalized script differs for '" + title + "'")
+    print("  {} scripts".format(len(raw_scripts)))
+    return problems
+
+
+""" Check the indexed scan-error corrector against fix_scan_errors, on the names of every movie with scanning mistakes
+    injected, and on the names of all movies merged. """
+def check_scan_errors():
+    import benchmark_suite
+    analyzed_movies, _ = get_corpus()
+    problems, fixed = [], 0
+    for analyzed in analyzed_movies + [merge_analyzed_movies(analyzed_movies)]:
+        names, character_dict = benchmark_suite.make_scan_error_names(analyzed)
+        corrector = utils.ScanErrorCorrector(character_dict)
+        actual = [corrector.fix(n) for n in names]
+        if actual != [utils.fix_scan_errors(n, character_dict) for n in names]:
+            problems.append("scan-error corrections differ for '" + analyzed["info"]["title"] + "'")
+        fixed += sum(1 for n, f in zip(names, actual) if n != f)
+    print("  {} scripts and all scripts merged, {} names fixed".format(len(analyzed_movies), fixed))
+    return problems
+
+
+""" The original metadata lookup, scanning the whole CSV file on every call. """
+def legacy_get_movie_metadata_by_name(movie_name):
+    with open(config.MOVIES_METADATA_FILE, newline="", encoding=config.MOVIES_METADATA_ENCODING) as f:
+        reader = csv.reader(f, delimiter=";", quotechar="|")
+        for row in reader:
+            if row[0] == movie_name:
+                return utils.array_to_movie(row)
+    return None
+
+
+""" Check metadata lookups through the indexed store against full scans of the CSV file, for the movies of the
+    analyzed corpus and for every title of the metadata file. """
+def check_metadata():
+    analyzed_movies, _ = get_corpus()
+    store = utils.MetadataStore()
+    titles = [m["info"]["title"] for m in analyzed_movies] + [m["title"] for m in store.get_all()]
+    problems = []
+    for title in titles:
+        if store.get_by_title(title) != legacy_get_movie_metadata_by_name(title):
+            problems.append("metadata of '" + title + "' differs from the CSV file")
+    print("  {} titles".format(len(titles)))
+    return problems
+
+
+""" Check memoized batch sentiment scoring against scoring every entry with VADER. """
+def check_sentiment():
+    analyzed_movies, _ = get_corpus()
+    scorer = sentiment.SentimentScorer()
+    analyzer = scorer.get_analyzer()
+    problems, num_texts = [], 0
+    for m in analyzed_movies:
+        texts = [e["content"] for e in m["entries"] if e["type"] in [script_parser.TYPE_SPEECH, script_parser.TYPE_DIRECTION]]
+        if scorer.score_batch(texts) != [analyzer.polarity_scores(t)["compound"] for t in texts]:
+            problems.append("memoized sentiment scores differ from VADER scores for '" + m["info"]["title"] + "'")
+        num_texts += len(texts)
+    print("  {} entries, {:.1%} memo hit rate".format(num_texts, scorer.get_stats()["hit_rate"]))
+    return problems
+
+
+""" Python equivalent of getPreviousCharacter (step=-1) and getNextCharacter (step=1) from display/utils.js. """
+def legacy_adjacent_character(entries, i, step):
+    original_character = entries[i]["content"]
+    while True:
+        i += step
+        if not (0 < i < len(entries) - 1 and (entries[i]["type"] != script_parser.TYPE_CHARACTER or entries[i]["content"] == original_character) and entries[i]["type"] != script_parser.TYPE_LOCATION):
+            break
+    return entries[i]["content"] if entries[i]["type"] == script_parser.TYPE_CHARACTER else None
+
+
+""" Python equivalent of the entry scan of updateCharacterInteractions in display/analysis-display.js. """
+def legacy_get_interactions(entries, name_a, name_b):
+    exchanges = []
+    line_index = 0
+    for i in range(2, len(entries) - 2):
+        e = entries[i]
+        if e["type"] == script_parser.TYPE_CHARACTER:
+            previous_character = legacy_adjacent_character(entries, i, -1)
+            next_character = legacy_adjacent_character(entries, i, 1)
+            a_to_b = e["content"] == name_a and name_b in [previous_character, next_character]
+            b_to_a = e["content"] == name_b and name_a in [previous_character, next_character]
+            if a_to_b or b_to_a:
+                speech = entries[i+1]
+                exchanges.append({"turn": line_index, "speaker": e["content"], "content": speech["content"], "cs": speech.get("cs")})
+            line_index += 1
+    return exchanges
+
+
+""" Check interaction queries through the turn index against the entry scan of the viewer, for all pairs of the
+    characters with the most lines of each movie. """
+def check_interactions():
+    import benchmark_suite
+    analyzed_movies, _ = get_corpus()
+    problems, num_pairs = [], 0
+    for analyzed in analyzed_movies:
+        movie = benchmark_suite.make_analyzed_movie(analyzed)
+        movie.compute_turns()
+        names = sorted(analyzed["characters"], key=lambda n: analyzed["characters"][n]["line_count"], reverse=True)[:INTERACTION_CHARACTERS]
+        pairs = [(a, b) for a in names for b in names if a != b]
+        if [movie.get_interactions(a, b) for a, b in pairs] != [legacy_get_interactions(movie.entries, a, b) for a, b in pairs]:
+            problems.append("interactions differ for '" + analyzed["info"]["title"] + "'")
+        num_pairs += len(pairs)
+    print("  {} pairs of characters".format(num_pairs))
+    return problems
+
+
+""" The moving average of the viewer before timelines were precomputed, in O(n * window), kept as a reference. """
+def legacy_smooth_moving_window(data, window):
+    if window <= 1:
+        return data
+    out = []
+    for i in range(len(data)):
+        total = 0
+        for j in range(i - window, i + 1):
+            total += data[abs(j)]
+        out.append(total / (window + 1))
+    return out
+
+
+""" Check the prefix sums of the timelines against the moving average of the viewer, on the SPEECH series of every
+    movie with each window of the timelines. """
+def check_timelines():
+    import numpy as np
+    analyzed_movies, _ = get_corpus()
+    problems = []
+    for analyzed in analyzed_movies:
+        scores = [e["cs"] for e in analyzed["entries"] if e["type"] == script_parser.TYPE_SPEECH]
+        for fraction in script_analyzer.TIMELINE_WINDOWS:
+            window = int(len(scores) * fraction + 0.5)
+            if not np.allclose(legacy_smooth_moving_window(scores, window), script_analyzer.smooth_moving_window(np.array(scores), window)):
+                problems.append("smoothed timelines differ for '" + analyzed["info"]["title"] + "' (window " + str(fraction) + ")")
+    print("  {} movies, {} windows".format(len(analyzed_movies), len(script_analyzer.TIMELINE_WINDOWS)))
+    return problems
+
+
+""" The type-filtered passes of the parser and analyzer over dict entries, as they were before entries used
+    __slots__: character occurrences, SPEECH and DIRECTION entries to score, and character line counts and scores. """
+def legacy_entry_passes(character_names, entries):
+    character_dict = dict()
+    for e in entries:
+        if e["type"] == script_parser.TYPE_CHARACTER:
+            character_dict[e["content"]] = character_dict.get(e["content"], 0) + 1
+    scored_entries = [e for e in entries if e["type"] in [script_parser.TYPE_SPEECH, script_parser.TYPE_DIRECTION]]
+    characters = {n: {"name": n, "line_count": 0, "avg_cs": 0} for n in character_names}
+    for i in range(1, len(entries)):
+        e = entries[i]
+        prev_e = entries[i-1]
+        if e["type"] == script_parser.TYPE_SPEECH and prev_e["type"] == script_parser.TYPE_CHARACTER:
+            c = characters[prev_e["content"]]
+            c["avg_cs"] = (c["line_count"] * c["avg_cs"] + e["cs"]) / (c["line_count"] + 1)
+            c["line_count"] += 1
+    return character_dict, len(scored_entries), characters
+
+
+""" Check the passes of the parser and analyzer over entries against the same passes over dict entries. """
+def check_entries():
+    import benchmark_suite
+    analyzed_movies, _ = get_corpus()
+    problems = []
+    for analyzed in analyzed_movies:
+        movie = benchmark_suite.make_analyzed_movie(analyzed)
+        movie.parsed_script.entries = movie.entries
+        character_dict = movie.parsed_script.create_character_occurrence_dict()
+        scored_entries = [e for e in movie.entries if e.type in [script_parser.TYPE_SPEECH, script_parser.TYPE_DIRECTION]]
+        movie.compute_characters()
+        if not all_close(legacy_entry_passes(movie.character_names, analyzed["entries"]), (character_dict, len(scored_entries), movie.characters)):
+            problems.append("entry passes differ for '" + analyzed["info"]["title"] + "'")
+    print("  {} movies".format(len(analyzed_movies)))
+    return problems
+
+
+""" Check that the analyzed movies, with their tables and all timelines, read back the same from the columnar format
+    (compressed or not, as dicts and lazily) and from files written by streaming_format. """
+def check_output_formats():
+    import benchmark_suite
+    analyzed_movies, _ = get_corpus()
+    problems = []
+    with tempfile.TemporaryDirectory() as directory:
+        for analyzed in analyzed_movies:
+            title = analyzed["info"]["title"]
+            movie = benchmark_suite.make_analyzed_movie(analyzed)
+            movie.compute_turns()
+            movie.timelines = script_analyzer.compute_timelines(movie.entries, movie.character_names, movie.scenes["start"], script_analyzer.TIMELINE_WINDOWS, script_analyzer.TIMELINE_RESOLUTIONS, all_series=True)
+            obj = dict(analyzed, **movie.get_tables())
+            for compression in [None, "gzip"]:
+                path = columnar_format.write_columnar(obj, os.path.join(directory, "movie.columnar.json"), compression)
+                if columnar_format.read_analyzed(path) != obj:
+                    problems.append("columnar round trip differs for '" + title + "'")
+                lazy = columnar_format.open_analyzed(path)
+                if list(lazy["entries"]) != analyzed["entries"] or lazy["characters"] != analyzed["characters"]:
+                    problems.append("lazy columnar entries differ for '" + title + "'")
+                if any(lazy[key] != obj[key] for key in columnar_format.TABLE_KEYS):
+                    problems.append("lazy columnar tables differ for '" + title + "'")
+
+            movie.characters = analyzed["characters"]
+            movie.compute_cooccurrences()
+            path = os.path.join(directory, "movie.json")
+            streaming_format.write_movie(path, analyzed["info"], analyzed["entries"], analyzed["characters"], movie.iter_cooccurrence_rows())
+            name = next(iter(analyzed["characters"]), None)
+            with streaming_format.StreamingMovieReader(path) as reader:
+                if (name != None and reader.get_cooccurrence_row(name) != movie.cooccurrences_to_dict()[name]) or list(reader.iter_entries()) != analyzed["entries"]:
+                    problems.append("streaming reader differs for '" + title + "'")
+    print("  {} movies".format(len(analyzed_movies)))
+    return problems
+
+
+""" Check aggregate queries on the corpus database against computing them from the analyzed files loaded in memory. """
+def check_corpus_db(k=10, bins=100):
+    problems = []
+    with tempfile.TemporaryDirectory() as directory:
+        db = corpus_db.CorpusDatabase(os.path.join(directory, "corpus.db"))
+        db.ingest()
+        if db.ingest() != 0:
+            problems.append("unchanged files were ingested again")
+        movies = [columnar_format.read_analyzed(path) for path in corpus_db.get_analyzed_files()]
+
+        # Reference answers, from the analyzed files
+        def top_characters():
+            characters = [(m["info"]["title"], i, c) for m in movies for i, c in enumerate(m["characters"].values())]
+            characters.sort(key=lambda x: (-x[2]["line_count"], x[0], x[1]))
+            return [{"title": title, "name": c["name"], "line_count": c["line_count"], "avg_cs": c["avg_cs"]} for title, _, c in characters[:k]]
+        def character_stats(name):
+            found = [{"title": m["info"]["title"], "name": n, "line_count": c["line_count"], "avg_cs": c["avg_cs"]} for m in movies for n, c in m["characters"].items() if n.lower() == name.lower()]
+            found.sort(key=lambda x: x["title"])
+            line_count = sum(x["line_count"] for x in found)
+            avg_cs = sum(x["line_count"] * x["avg_cs"] for x in found) / line_count if line_count > 0 else 0
+            return {"name": max(found, key=lambda x: x["line_count"])["name"] if len(found) > 0 else name, "line_count": line_count, "avg_cs": avg_cs, "movies": found}
+        def top_cooccurrences():
+            pairs = []
+            for m in movies:
+                names = list(m["characters"])
+                for a, namea in enumerate(names):
+                    for b in range(a + 1, len(names)):
+                        cell = m["cooccurrences"][namea].get(names[b])
+                        if cell != None and cell["count"] > 0:
+                            pairs.append((m["info"]["title"], a, b, namea, names[b], cell))
+            pairs.sort(key=lambda x: (-x[5]["count"], x[0], x[1], x[2]))
+            return [{"title": title, "a": namea, "b": nameb, "count": cell["count"], "avg_cs": cell["avg_cs"]} for title, _, _, namea, nameb, cell in pairs[:k]]
+        def sentiment_timelines():
+            timelines = []
+            for m in movies:
+                sums, counts = [0] * bins, [0] * bins
+                for i, e in enumerate(m["entries"]):
+                    if "cs" in e:
+                        sums[i * bins // len(m["entries"])] += e["cs"]
+                        counts[i * bins // len(m["entries"])] += 1
+                timelines.append([s / c if c > 0 else None for s, c in zip(sums, counts)])
+            return timelines
+
+        names = [c["name"] for c in top_characters()]
+        titles = [m["info"]["title"] for m in movies]
+        queries = [
+            ("top " + str(k) + " characters", top_characters, lambda: db.get_top_characters(k)),
+            ("stats of " + str(len(names)) + " character names", lambda: [character_stats(n) for n in names], lambda: [db.get_character_stats(n.lower()) for n in names]),
+            ("top " + str(k) + " co-occurring pairs", top_cooccurrences, lambda: db.get_top_cooccurrences(k)),
+            (str(bins) + "-bin timelines of all movies", sentiment_timelines, lambda: [db.get_sentiment_timeline(t, bins) for t in titles]),
+        ]
+        for name, reference, query in queries:
+            if not all_close(query(), reference()):
+                problems.append("query '" + name + "' differs from the analyzed files")
+        db.close()
+    print("  {} movies, {} queries".format(len(movies), len(queries)))
+    return problems
+
+
+""" Scan the entries of analyzed movies for a dialogue index query, as a reference. """
+def scan_dialogue(analyzed_movies, query, phrase=False, character=None, min_cs=None):
+    terms = dialogue_index.tokenize(query)
+    hits = []
+    for m in analyzed_movies:
+        entries = m["entries"]
+        for i, e in enumerate(entries):
+            if e["type"] not in dialogue_index.INDEXED_TYPES:
+                continue
+            if character != None and not (e["type"] == "SPEECH" and entries[i-1]["type"] == "CHARACTER" and entries[i-1]["content"] == character):
+                continue
+            if min_cs != None and not e.get("cs", -2) >= min_cs:
+                continue
+            tokens = dialogue_index.tokenize(e["content"])
+            if phrase:
+                found = any(tokens[j:j+len(terms)] == terms for j in range(len(tokens) - len(terms) + 1))
+            else:
+                found = all(t in tokens for t in terms)
+            if found:
+                hits.append((m["info"]["title"], i))
+    return hits
+
+
+""" Check queries on the dialogue index of the analyzed corpus against scanning the entries of every movie. """
+def check_dialogue_index():
+    analyzed_movies, _ = get_corpus()
+    problems = []
+    with tempfile.TemporaryDirectory() as directory:
+        builder = dialogue_index.IndexBuilder()
+        for m in analyzed_movies:
+            builder.add_movie(m["info"], m["entries"])
+        with dialogue_index.DialogueIndex(builder.write(os.path.join(directory, "dialogue.idx"))) as index:
+            for query, options in DIALOGUE_QUERIES:
+                hits = index.search(query, **options)
+                if [(h["title"], h["entry"]) for h in hits] != scan_dialogue(analyzed_movies, query, **options):
+                    problems.append("dialogue index differs for query '" + query + "'")
+    print("  {} queries".format(len(DIALOGUE_QUERIES)))
+    return problems
+
+
+""" Check the responses of the query server to the requests of the viewer before its first chart (movie summary,
+    co-occurrences and direction timeline), and their revalidation with the ETags of the responses. """
+def check_query_server():
+    import http.client
+    import query_server
+    analyzed_movies, _ = get_corpus()
+    problems = []
+    with tempfile.TemporaryDirectory() as directory:
+        names = []
+        for analyzed in sorted(analyzed_movies, key=lambda m: len(m["entries"]), reverse=True)[:3]:
+            names.append(utils.get_safe_name(analyzed["info"]["title"]))
+            with open(os.path.join(directory, names[-1] + ".json"), "w") as f:
+                json.dump(analyzed, f)
+        server = query_server.QueryServer(("127.0.0.1", 0), directory)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+        try:
+            for name in names:
+                url = "/api/movies/" + name
+                paths = [url, url + "/cooccurrences", url + "/timeline?series=direction"]
+                etags = []
+                for path in paths:
+                    connection.request("GET", path, headers={"Accept-Encoding": "gzip"})
+                    response = connection.getresponse()
+                    response.read()
+                    etags.append(response.getheader("ETag"))
+                    if response.status != 200:
+                        problems.append(path + " answered " + str(response.status))
+                for path, etag in zip(paths, etags):
+                    connection.request("GET", path, headers={"If-None-Match": etag})
+                    response = connection.getresponse()
+                    response.read()
+                    if response.status != 304:
+                        problems.append(path + " answered " + str(response.status) + " to a revalidation")
+        finally:
+            connection.close()
+            server.shutdown()
+            server.server_close()
+    print("  {} movies".format(len(names)))
+    return problems
+
+
+# Checks: name, function returning the list of problems found
+CHECKS = [
+    ("extract", check_extract),
+    ("preprocess", check_preprocess),
+    ("tokenizer", check_tokenizer),
+    ("classifier", check_classifier),
+    ("finalize", check_finalize),
+    ("scan_errors", check_scan_errors),
+    ("metadata", check_metadata),
+    ("sentiment", check_sentiment),
+    ("cooccurrences", check_cooccurrences),
+    ("interactions", check_interactions),
+    ("timelines", check_timelines),
+    ("entries", check_entries),
+    ("output_formats", check_output_formats),
+    ("corpus_db", check_corpus_db),
+    ("dialogue_index", check_dialogue_index),
+    ("query_server", check_query_server),
+    ("crawl", check_crawl),
+    ("imports", check_imports),
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks of the tools that run on the files of the repository, without the network or the full corpus.")
+    parser.add_argument("--only", nargs="+", choices=[c[0] for c in CHECKS], default=[c[0] for c in CHECKS], help="checks to run (default: all)")
+    args = parser.parse_args()
+
+    problems = []
+    for name, check in CHECKS:
+        if name in args.only:
+            print("Checking", name + "...")
+            problems += [name + ": " + p for p in check()]
+
+    if len(problems) > 0:
+        print("\nChecks failed:", *problems, sep="\n  ")
+        sys.exit(1)
+    print("All checks passed.")
@@ -0,0 +1,67 @@
+import argparse
+import importlib
+import sys
+
+import config
+import utils
+
+# Subcommands: the module implementing each command (with add_arguments and main functions) and its help.
+# Modules are only imported when their command runs, so that every command only loads the dependencies it needs
+# (e.g. listing movies never imports NumPy, BeautifulSoup or requests).
+COMMANDS = {
+    "fetch": ("fetch_movie_metadata", "fetch the metadata of all movies listed on IMSDb"),
+    "list": (None, "list the movies of the metadata file"),
+    "parse": ("script_parser", "parse movie scripts and print a breakdown of their entries"),
+    "analyze": ("corpus_runner", "parse and analyze movie scripts in parallel"),
+    "convert": ("columnar_format", "convert analyzed scripts to the columnar format"),
+    "query": ("corpus_db", "query the analyzed corpus (characters, pairs, timelines)"),
+    "search": ("dialogue_index", "search what characters say in the analyzed corpus"),
+    "serve": ("query_server", "serve the viewer and the analyzed movies on a local HTTP server"),
+}
+
+""" Add the command-line arguments of movie listing to a parser. """
+def add_list_arguments(parser):
+    parser.add_argument("--title", help="only list movies whose title contains this text")
+    parser.add_argument("--author", help="only list movies written by this author")
+    parser.add_argument("--analyzed", action="store_true", help="only list movies with an analyzed script")
+
+
+def list_movies(args):
+    movies = utils.get_metadata_store().get_by_author(args.author) if args.author else utils.get_all_movies_metadata()
+    if args.title:
+        movies = [m for m in movies if utils.normalize_title(args.title) in utils.normalize_title(m["title"])]
+    if args.analyzed:
+        import corpus_db
+        analyzed = {corpus_db.exp_analyzed_file.sub("", path) for path in corpus_db.get_analyzed_files()}
+        movies = [m for m in movies if config.DIR_ANALYZED + utils.get_safe_name(m["title"]) in analyzed]
+    for m in movies:
+        print(m["title"], "(" + ", ".join(m["authors"]) + ")")
+    print(len(movies), "movies.")
+
+
+""" Get the add_arguments and main functions of a command. """
+def get_command(name):
+    module_name, _ = COMMANDS[name]
+    if module_name == None:
+        return add_list_arguments, list_movies
+    module = importlib.import_module(module_name)
+    return module.add_arguments, module.main
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv == None else argv
+    parser = argparse.ArgumentParser(description="Parsing, analyzing and visualizing character interactions in movie scripts.")
+    subparsers = parser.add_subparsers(dest="command", required=True, metavar="COMMAND")
+    command_parsers = {name: subparsers.add_parser(name, help=help, description=help[0].upper() + help[1:] + ".") for name, (_, help) in COMMANDS.items()}
+
+    # Only the arguments of the requested command are defined, which imports its module
+    name = next((a for a in argv if not a.startswith("-")), None)
+    if name in COMMANDS:
+        add_arguments, run = get_command(name)
+        add_arguments(command_parsers[name])
+    args = parser.parse_args(argv)
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+import argparse
+import base64
+import gzip
+import json
+import math
+import os
+import re
+from collections.abc import Mapping, Sequence
+
+import utils
+import streaming_format
+
+# Entry types, in the order of their codes
+ENTRY_TYPES = ["META", "CHARACTER", "SPEECH", "DIRECTION", "LOCATION"]
+
+FORMAT_NAME = "columnar"
+# Version 2 writes the string table last, with the length of every string, so that it can be decoded lazily.
+# Version 3 stores the scene, turn, interaction and timeline tables column-wise, under "tables"
+FORMAT_VERSION = 3
+
+# Keys of an analyzed movie dict that are stored column-wise, other keys are stored as-is
+COLUMNAR_KEYS = ["info", "entries", "characters", "cooccurrences"]
+# Tables of an analyzed movie dict (see AnalyzedMovieScript.get_tables) that are stored column-wise
+TABLE_KEYS = ["scenes", "turns", "interactions", "timelines"]
+
+# Timeline scores have 4 decimals and lie in [-1, 1]: they are stored as int16 multiples of 10^-4, with codes
+# outside of that range for NaN and for the -0.0 that rounding produces, so that timelines are decoded exactly
+TIMELINE_SCALE = 10000
+TIMELINE_NAN = -32768
+TIMELINE_NEGATIVE_ZERO = -32767
+
+# Compression schemes, with their file extension
+COMPRESSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+# Start of version 2 documents: the offset of the string table, as a fixed-width string
+exp_strings_start = re.compile(rb'^\{"strings_start":"([0-9]{10})",')
+STRINGS_KEY = b',"strings":['
+
+""" Encode a NumPy array as base64 of its little-endian bytes. """
+def encode_array(array, dtype):
+    import numpy as np
+    return base64.b64encode(np.asarray(array, dtype=dtype).tobytes()).decode("ascii")
+
+""" Decode an array encoded with encode_array. """
+def decode_array(data, dtype):
+    import numpy as np
+    return np.frombuffer(base64.b64decode(data), dtype=dtype)
+
+
+""" Encode integers that are mostly increasing (indices of entries, scenes or turns) as their differences, which
+    compress better. """
+def encode_deltas(values):
+    import numpy as np
+    return encode_array(np.diff(np.asarray(values, dtype=np.int64), prepend=0), "<i4")
+
+""" Decode integers encoded with encode_deltas, as a list. """
+def decode_deltas(data):
+    import numpy as np
+    return np.cumsum(decode_array(data, "<i4"), dtype=np.int64).tolist()
+
+
+""" Encode timeline scores (see TIMELINE_SCALE). """
+def encode_scores(values):
+    import numpy as np
+    values = np.asarray(values, dtype=np.float64)
+    codes = np.rint(np.nan_to_num(values) * TIMELINE_SCALE)
+    codes[(values == 0) & np.signbit(values)] = TIMELINE_NEGATIVE_ZERO
+    codes[np.isnan(values)] = TIMELINE_NAN
+    return encode_array(codes, "<i2")
+
+""" Decode timeline scores encoded with encode_scores, as a list. """
+def decode_scores(data):
+    import numpy as np
+    codes = decode_array(data, "<i2")
+    values = codes / TIMELINE_SCALE
+    values[codes == TIMELINE_NEGATIVE_ZERO] = -0.0
+    values[codes == TIMELINE_NAN] = np.nan
+    return values.tolist()
+
+
+""" Iterate over the timelines of a nested dict of timelines (as computed by script_analyzer.compute_timelines),
+    as pairs of the path of keys to the timeline and the timeline, in order. """
+def iter_timelines(timelines, path=()):
+    for key, value in timelines.items():
+        if "levels" in value:
+            yield path + (key,), value
+        else:
+            yield from iter_timelines(value, path + (key,))
+
+
+""" Encode a table of an analyzed movie column-wise, with character names as indices into the string table
+    (see to_columnar, string_id adds a string to the table and returns its index). Speakers that are None are
+    stored as -1 and indices as their differences (see encode_deltas). Interactions are flattened in order: the speaker and other character of each pair, and the
+    offsets of the turns of each pair. Timelines are flattened in order as well: the number of levels of each
+    timeline, the number of points of each level, and the points of all levels. """
+def encode_table(key, table, string_id):
+    if key == "scenes":
+        return {"start": encode_deltas(table["start"]), "end": encode_deltas(table["end"])}
+    if key == "turns":
+        speaker_ids = lambda names: encode_array([-1 if name == None else string_id(name) for name in names], "<i4")
+        return {
+            "entry": encode_deltas(table["entry"]),
+            "speaker": speaker_ids(table["speaker"]),
+            "previous": speaker_ids(table["previous"]),
+            "next": speaker_ids(table["next"]),
+            "scene": encode_deltas(table["scene"]),
+        }
+    if key == "interactions":
+        speakers, others, offsets, turns = [], [], [0], []
+        for speaker, row in table.items():
+            for other, pair_turns in row.items():
+                speakers.append(string_id(speaker))
+                others.append(string_id(other))
+                turns.extend(pair_turns)
+                offsets.append(len(turns))
+        return {
+            "speaker": encode_array(speakers, "<u4"),
+            "other": encode_array(others, "<u4"),
+            "offsets": encode_deltas(offsets),
+            "turns": encode_deltas(turns),
+        }
+    if key == "timelines":
+        paths, lengths, level_counts, point_counts, windows = [], [], [], [], None
+        x, entry, raw, smoothed = [], [], [], dict()
+        for path, timeline in iter_timelines(table):
+            paths.append(list(path))
+            lengths.append(timeline["length"])
+            level_counts.append(len(timeline["levels"]))
+            for level in timeline["levels"]:
+                if windows == None:
+                    windows = list(level["smoothed"])
+                    smoothed = {w: [] for w in windows}
+                if list(level["smoothed"]) != windows:
+                    raise ValueError("Timelines with different smoothing windows: {} and {}".format(windows, list(level["smoothed"])))
+                point_counts.append(len(level["x"]))
+                x.extend(level["x"])
+                entry.extend(level["entry"])
+                raw.extend(level["raw"])
+                for w in windows:
+                    smoothed[w].extend(level["smoothed"][w])
+        return {
+            "path": paths,
+            "length": lengths,
+            "levels": encode_array(level_counts, "<u4"),
+            "points": encode_array(point_counts, "<u4"),
+            "windows": windows or [],
+            "x": encode_deltas(x),
+            "entry": encode_deltas(entry),
+            "raw": encode_scores(raw),
+            "smoothed": {w: encode_scores(values) for w, values in smoothed.items()},
+        }
+    raise ValueError("Unknown table: " + key)
+
+""" Decode a table encoded with encode_table, with get_string returning a string of the string table. """
+def decode_table(key, table, get_string):
+    if key == "scenes":
+        return {"start": decode_deltas(table["start"]), "end": decode_deltas(table["end"])}
+    if key == "turns":
+        speaker_names = lambda data: [None if i == -1 else get_string(i) for i in decode_array(data, "<i4").tolist()]
+        return {
+            "entry": decode_deltas(table["entry"]),
+            "speaker": speaker_names(table["speaker"]),
+            "previous": speaker_names(table["previous"]),
+            "next": speaker_names(table["next"]),
+            "scene": decode_deltas(table["scene"]),
+        }
+    if key == "interactions":
+        offsets, turns = decode_deltas(table["offsets"]), decode_deltas(table["turns"])
+        interactions = dict()
+        for k, (speaker, other) in enumerate(zip(decode_array(table["speaker"], "<u4").tolist(), decode_array(table["other"], "<u4").tolist())):
+            interactions.setdefault(get_string(speaker), dict())[get_string(other)] = turns[offsets[k]:offsets[k+1]]
+        return interactions
+    if key == "timelines":
+        x, entry = decode_deltas(table["x"]), decode_deltas(table["entry"])
+        raw = decode_scores(table["raw"])
+        smoothed = {w: decode_scores(data) for w, data in table["smoothed"].items()}
+        point_counts = iter(decode_array(table["points"], "<u4").tolist())
+        timelines, start = dict(), 0
+        for path, length, level_count in zip(table["path"], table["length"], decode_array(table["levels"], "<u4").tolist()):
+            levels = []
+            for _ in range(level_count):
+                end = start + next(point_counts)
+                levels.append({"x": x[start:end], "entry": entry[start:end], "raw": raw[start:end], "smoothed": {w: values[start:end] for w, values in smoothed.items()}})
+                start = end
+            parent = timelines
+            for key in path[:-1]:
+                parent = parent.setdefault(key, dict())
+            parent[path[-1]] = {"length": length, "levels": levels}
+        return timelines
+    raise ValueError("Unknown table: " + key)
+
+
+""" Convert an analyzed movie (as returned by AnalyzedMovieScript.to_dict) to the columnar format.
+    Entries are stored column-wise: type codes as uint8, contents as indices into a string table and
+    compound scores as float32 (NaN when an entry has no score). Co-occurrences only store the pairs of
+    characters that share at least one scene. Tables are stored column-wise as well (see encode_table). """
+def to_columnar(obj):
+    strings, string_ids = [], dict()
+    def string_id(s):
+        if s not in string_ids:
+            string_ids[s] = len(strings)
+            strings.append(s)
+        return string_ids[s]
+
+    type_codes = {t: i for i, t in enumerate(ENTRY_TYPES)}
+    entries = obj["entries"]
+    types = [type_codes[e["type"]] for e in entries]
+    contents = [string_id(e["content"]) for e in entries]
+    scores = [e.get("cs", math.nan) for e in entries]
+
+    names = list(obj["characters"])
+    name_index = {n: i for i, n in enumerate(names)}
+    rows, columns, counts, avg_cs = [], [], [], []
+    for namei, row in obj["cooccurrences"].items():
+        for namej, cell in row.items():
+            if cell["count"] > 0:
+                rows.append(name_index[namei])
+                columns.append(name_index[namej])
+                counts.append(cell["count"])
+                avg_cs.append(cell["avg_cs"])
+
+    return {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "info": obj["info"],
+        "strings": strings,
+        "entries": {
+            "length": len(entries),
+            "type_names": ENTRY_TYPES,
+            "type": encode_array(types, "<u1"),
+            "content": encode_array(contents, "<u4"),
+            "cs": encode_array(scores, "<f4"),
+        },
+        "characters": {
+            "name": names,
+            "line_count": [obj["characters"][n]["line_count"] for n in names],
+            "avg_cs": [obj["characters"][n]["avg_cs"] for n in names],
+        },
+        "cooccurrences": {
+            "row": encode_array(rows, "<u4"),
+            "column": encode_array(columns, "<u4"),
+            "count": encode_array(counts, "<u4"),
+            "avg_cs": encode_array(avg_cs, "<f8"),
+        },
+        "tables": {key: encode_table(key, obj[key], string_id) for key in TABLE_KEYS if key in obj},
+        "extra": {key: value for key, value in obj.items() if key not in COLUMNAR_KEYS and key not in TABLE_KEYS},
+    }
+
+
+""" Convert a movie in the columnar format back to the dict produced by AnalyzedMovieScript.to_dict.
+    If sparse, co-occurrences only contain the pairs of characters that share at least one scene. """
+def from_columnar(columnar, sparse=False):
+    import numpy as np
+    strings = columnar["strings"]
+    type_names = columnar["entries"]["type_names"]
+    types = [type_names[t] for t in decode_array(columnar["entries"]["type"], "<u1").tolist()]
+    contents = [strings[c] for c in decode_array(columnar["entries"]["content"], "<u4").tolist()]
+    # VADER compound scores have 4 decimals, which float32 preserves after rounding
+    scores = np.round(decode_array(columnar["entries"]["cs"], "<f4").astype(np.float64), 4)
+
+    entries = [{"type": t, "content": c} for t, c in zip(types, contents)]
+    scored = np.flatnonzero(~np.isnan(scores))
+    for i, cs in zip(scored.tolist(), scores[scored].tolist()):
+        entries[i]["cs"] = cs
+
+    names = columnar["characters"]["name"]
+    characters = dict()
+    for n, line_count, avg_cs in zip(names, columnar["characters"]["line_count"], columnar["characters"]["avg_cs"]):
+        characters[n] = {"name": n, "line_count": line_count, "avg_cs": avg_cs}
+
+    cooccurrences = {namei: (dict() if sparse else {namej: {"count": 0, "avg_cs": 0} for namej in names}) for namei in names}
+    co = columnar["cooccurrences"]
+    for i, j, count, avg_cs in zip(decode_array(co["row"], "<u4").tolist(), decode_array(co["column"], "<u4").tolist(), decode_array(co["count"], "<u4").tolist(), decode_array(co["avg_cs"], "<f8").tolist()):
+        cooccurrences[names[i]][names[j]] = {"count": count, "avg_cs": avg_cs}
+
+    obj = {"info": columnar["info"], "entries": entries, "characters": characters, "cooccurrences": cooccurrences}
+    obj.update(decode_tables(columnar, strings.__getitem__))
+    return obj
+
+""" Get the tables and other keys of a movie in the columnar format (before version 3, tables are stored as-is). """
+def decode_tables(columnar, get_string):
+    obj = {key: decode_table(key, table, get_string) for key, table in columnar.get("tables", dict()).items()}
+    obj.update(columnar.get("extra", dict()))
+    return obj
+
+
+""" Compress data with the given scheme (None, "gzip" or "zstd"). zstd requires the zstandard package. """
+def compress(data, compression):
+    if compression == "gzip":
+        return gzip.compress(data)
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+""" Decompress data, detecting the compression scheme from its magic number. """
+def decompress(data):
+    if data[:2] == b"\x1f\x8b":
+        return gzip.decompress(data)
+    if data[:4] == b"\x28\xb5\x2f\xfd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+""" Serialize a movie in the columnar format as a JSON document whose string table comes last, preceded by its offset
+    in the document and with the length of every string in the table (as JSON, with its separator), so that strings
+    can be decoded one by one (see ColumnarMovie). The document is ASCII, so that lengths in characters are also
+    lengths in bytes. """
+def encode_columnar(columnar):
+    strings = [json.dumps(string) for string in columnar["strings"]]
+    header = {key: value for key, value in columnar.items() if key != "strings"}
+    header["string_lengths"] = encode_array([len(string) + 1 for string in strings], "<u4")
+    header = json.dumps(header, separators=(",", ":"))[1:-1]
+
+    strings_start = len('{"strings_start":"0000000000",' + header) + len(STRINGS_KEY)
+    return ('{"strings_start":"' + str(strings_start).zfill(10) + '",' + header + STRINGS_KEY.decode("ascii") + ",".join(strings) + "]}").encode("ascii")
+
+""" Write an analyzed movie dict to a file in the columnar format, atomically. Returns the path of the written file. """
+def write_columnar(obj, path, compression=None):
+    path = path + COMPRESSIONS[compression]
+    data = encode_columnar(to_columnar(obj))
+    with utils.write_atomic(path, "wb") as f:
+        f.write(compress(data, compression))
+    return path
+
+""" Read a file in the columnar format without rebuilding per-entry dicts. Entry and co-occurrence columns
+    are returned as NumPy arrays, with entry contents resolved through the string table on demand. Tables and
+    other keys are returned as in read_analyzed, under "extra". """
+def read_columns(path):
+    with open(path, "rb") as f:
+        columnar = json.loads(decompress(f.read()))
+    entries, co = columnar["entries"], columnar["cooccurrences"]
+    return {
+        "info": columnar["info"],
+        "strings": columnar["strings"],
+        "type_names": entries["type_names"],
+        "type": decode_array(entries["type"], "<u1"),
+        "content": decode_array(entries["content"], "<u4"),
+        "cs": decode_array(entries["cs"], "<f4"),
+        "characters": columnar["characters"],
+        "cooccurrences": {k: decode_array(co[k], "<f8" if k == "avg_cs" else "<u4") for k in ["row", "column", "count", "avg_cs"]},
+        "extra": decode_tables(columnar, columnar["strings"].__getitem__),
+    }
+
+""" Read an analyzed movie file, in the columnar format (possibly compressed) or as a plain analyzed JSON file. """
+def read_analyzed(path, sparse=False):
+    with open(path, "rb") as f:
+        obj = json.loads(decompress(f.read()))
+    if obj.get("format") == FORMAT_NAME:
+        return from_columnar(obj, sparse)
+    return streaming_format.strip_index(obj)
+
+
+""" Lazily decoded entries of a ColumnarMovie, as a sequence of entry dicts. """
+class ColumnarEntries(Sequence):
+    def __init__(self, movie):
+        self.movie = movie
+
+
+    def __len__(self):
+        return len(self.movie.types)
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.movie.get_entry(i)
+
+
+""" Analyzed movie read from a file in the columnar format without decoding it: only the header of the document (the
+    info, characters and columns) is parsed, while entry contents are decoded from the string table when they are
+    accessed. Reads like the dict returned by read_analyzed(path, sparse=True), with entries as a lazy sequence.
+    Tables are decoded when they are first accessed. """
+class ColumnarMovie(Mapping):
+    def __init__(self, data):
+        match = exp_strings_start.match(data)
+        if match != None:
+            self.data = data
+            self.strings_start = int(match.group(1))
+            self.header = json.loads(b"{" + data[match.end():self.strings_start - len(STRINGS_KEY)] + b"}")
+            lengths = decode_array(self.header["string_lengths"], "<u4")
+            self.string_offsets = [0] + lengths.cumsum().tolist()
+            self.strings = dict()
+        else:
+            # Version 1: the string table is decoded with the document
+            self.data = None
+            self.header = json.loads(data)
+            self.strings = dict(enumerate(self.header["strings"]))
+
+        entries = self.header["entries"]
+        self.type_names = entries["type_names"]
+        self.types = decode_array(entries["type"], "<u1").tolist()
+        self.contents = decode_array(entries["content"], "<u4").tolist()
+        self.scores = decode_array(entries["cs"], "<f4").tolist()
+        self.key_names = ["info", "entries", "characters", "cooccurrences"] + list(self.header.get("tables", dict())) + list(self.header.get("extra", dict()))
+        self.items_loaded = {"info": self.header["info"], "entries": ColumnarEntries(self)}
+        self.items_loaded.update(self.header.get("extra", dict()))
+
+
+    def get_string(self, i):
+        string = self.strings.get(i)
+        if string == None:
+            start, end = self.strings_start + self.string_offsets[i], self.strings_start + self.string_offsets[i + 1] - 1
+            string = self.strings[i] = json.loads(self.data[start:end])
+        return string
+
+
+    """ Get an entry dict, as in the dict returned by read_analyzed. """
+    def get_entry(self, i):
+        e = {"type": self.type_names[self.types[i]], "content": self.get_string(self.contents[i])}
+        if not math.isnan(self.scores[i]):
+            e["cs"] = round(self.scores[i], 4)
+        return e
+
+
+    def __getitem__(self, key):
+        if key not in self.items_loaded:
+            if key == "characters":
+                c = self.header["characters"]
+                self.items_loaded[key] = {n: {"name": n, "line_count": line_count, "avg_cs": avg_cs} for n, line_count, avg_cs in zip(c["name"], c["line_count"], c["avg_cs"])}
+            elif key == "cooccurrences":
+                names, co = self.header["characters"]["name"], self.header["cooccurrences"]
+                cooccurrences = {n: dict() for n in names}
+                for i, j, count, avg_cs in zip(decode_array(co["row"], "<u4").tolist(), decode_array(co["column"], "<u4").tolist(), decode_array(co["count"], "<u4").tolist(), decode_array(co["avg_cs"], "<f8").tolist()):
+                    cooccurrences[names[i]][names[j]] = {"count": count, "avg_cs": avg_cs}
+                self.items_loaded[key] = cooccurrences
+            elif key in self.header.get("tables", dict()):
+                self.items_loaded[key] = decode_table(key, self.header["tables"][key], self.get_string)
+            else:
+                raise KeyError(key)
+        return self.items_loaded[key]
+
+
+    def __iter__(self):
+        return iter(self.key_names)
+
+
+    def __len__(self):
+        return len(self.key_names)
+
+
+""" Open an analyzed movie file: files in the columnar format (possibly compressed) are read lazily as a
+    ColumnarMovie, plain analyzed JSON files are read with read_analyzed. """
+def open_analyzed(path):
+    with open(path, "rb") as f:
+        data = decompress(f.read())
+    if exp_strings_start.match(data) != None or data.startswith(b'{"format":"' + FORMAT_NAME.encode("ascii") + b'"'):
+        return ColumnarMovie(data)
+    return streaming_format.strip_index(json.loads(data))
+
+
+""" Add the command-line arguments of conversions to the columnar format to a parser. """
+def add_arguments(parser):
+    parser.add_argument("files", nargs="+", help="analyzed movie scripts (JSON)")
+    parser.add_argument("--compression", choices=["gzip", "zstd"], default=None, help="compress the output files")
+
+
+def main(args):
+    for path in args.files:
+        obj = read_analyzed(path)
+        out_path = write_columnar(obj, os.path.splitext(path)[0] + ".columnar.json", args.compression)
+        print(path, "({:.0f} KB) ->".format(os.path.getsize(path) / 1024), out_path, "({:.0f} KB)".format(os.path.getsize(out_path) / 1024))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert analyzed movie scripts to the columnar format.")
+    add_arguments(parser)
+    main(parser.parse_args())
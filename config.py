@@ -1,3 +1,35 @@
 URL_IMSDB = "https://www.imsdb.com"
 MOVIES_METADATA_FILE = "data/movies_metadata.csv"
-DIR_ANALYZED = "data/analyzed/"
\ No newline at end of file
+MOVIES_METADATA_ENCODING = "utf-8"
+# Encoding of metadata files written before they were UTF-8, still read until the next crawl rewrites them
+MOVIES_METADATA_LEGACY_ENCODING = "cp1252"
+DIR_ANALYZED = "data/analyzed/"
+DIR_SCRIPT_CACHE = "data/cache/scripts/"
+SENTIMENT_CACHE_FILE = "data/cache/sentiment.json"
+BUILD_MANIFEST_FILE = "data/cache/manifest.json"
+CORPUS_DB_FILE = "data/cache/corpus.db"
+DIR_BENCHMARK = "data/benchmark/"
+
+# Raw script cache
+SCRIPT_CACHE_MAX_SIZE = 200 * 1024 * 1024 # bytes (compressed)
+
+# Sentiment scoring
+SENTIMENT_MEMO_SIZE = 50000 # max number of scores kept in memory
+SENTIMENT_CACHE_MAX_SIZE = 500000 # max number of scores kept in the cache file
+
+# HTTP fetching
+FETCH_WORKERS = 8
+FETCH_RATE_LIMIT = 10 # max requests per second and per host
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 0.5 # seconds, doubled after each retry
+FETCH_TIMEOUT = 30 # seconds
+
+# Local query server of analyzed movies
+SERVER_PORT = 8000
+SERVER_CACHE_MAX_SIZE = 512 * 1024 * 1024 # bytes (approximate size of the loaded movies)
+
+# Full-text index of the analyzed corpus
+DIALOGUE_INDEX_FILE = "data/cache/dialogue.idx"
+
+# State of the incremental metadata crawls
+CRAWL_STATE_FILE = "data/cache/crawl_state.json"
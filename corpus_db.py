@@ -0,0 +1,251 @@
+import argparse
+import glob
+import os
+import re
+import sqlite3
+
+import config
+import columnar_format
+import build_manifest
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS movies (
+    id INTEGER PRIMARY KEY,
+    title TEXT UNIQUE NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    num_entries INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS characters (
+    movie_id INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    line_count INTEGER NOT NULL,
+    avg_cs REAL NOT NULL,
+    PRIMARY KEY (movie_id, idx)
+) WITHOUT ROWID;
+DROP INDEX IF EXISTS characters_name;
+CREATE INDEX IF NOT EXISTS characters_name_nocase ON characters (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS characters_line_count ON characters (line_count);
+CREATE TABLE IF NOT EXISTS entries (
+    movie_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    type INTEGER NOT NULL,
+    cs REAL,
+    PRIMARY KEY (movie_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_type ON entries (type, movie_id);
+CREATE TABLE IF NOT EXISTS cooccurrences (
+    movie_id INTEGER NOT NULL,
+    a INTEGER NOT NULL,
+    b INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    avg_cs REAL NOT NULL,
+    PRIMARY KEY (movie_id, a, b)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cooccurrences_count ON cooccurrences (count);
+"""
+
+# Entry type codes, shared with the columnar format
+ENTRY_TYPE_CODES = {t: i for i, t in enumerate(columnar_format.ENTRY_TYPES)}
+
+# Extensions of analyzed movie files
+exp_analyzed_file = re.compile(r"(\.columnar)?\.json(\.gz|\.zst)?$")
+
+""" Get the analyzed movie files of a directory, in any output format. When a movie was saved in several formats,
+    only its most recent file is returned. """
+def get_analyzed_files(directory=None):
+    directory = config.DIR_ANALYZED if directory == None else directory
+    files = dict()
+    for path in glob.glob(os.path.join(directory, "*.json*")):
+        name = exp_analyzed_file.sub("", path)
+        if name != path and (name not in files or os.path.getmtime(path) > os.path.getmtime(files[name])):
+            files[name] = path
+    return sorted(files.values())
+
+
+""" SQLite database of the analyzed corpus, for aggregate queries across movies.
+    Characters, entries (type and compound score only, not their contents) and co-occurring pairs of characters
+    of all movies are stored in indexed tables. Movies are ingested from the analyzed files, and only ingested
+    again when their file changes. """
+class CorpusDatabase:
+    def __init__(self, path=None):
+        path = config.CORPUS_DB_FILE if path == None else path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+
+    def close(self):
+        self.connection.close()
+
+
+    def remove_movie(self, movie_id):
+        for table in ["characters", "entries", "cooccurrences"]:
+            self.connection.execute("DELETE FROM " + table + " WHERE movie_id = ?", (movie_id,))
+        self.connection.execute("DELETE FROM movies WHERE id = ?", (movie_id,))
+
+
+    """ Ingest an analyzed movie file, replacing any previous version of the movie. """
+    def ingest_file(self, path):
+        obj = columnar_format.read_analyzed(path, sparse=True)
+        file = build_manifest.stat_file(path)
+        title = obj["info"]["title"]
+
+        c = self.connection
+        row = c.execute("SELECT id FROM movies WHERE title = ?", (title,)).fetchone()
+        if row != None:
+            self.remove_movie(row[0])
+        movie_id = c.execute("INSERT INTO movies (title, path, size, mtime, num_entries) VALUES (?, ?, ?, ?, ?)",
+            (title, path, file["size"], file["mtime"], len(obj["entries"]))).lastrowid
+
+        names = list(obj["characters"])
+        name_index = {n: i for i, n in enumerate(names)}
+        c.executemany("INSERT INTO characters VALUES (?, ?, ?, ?, ?)",
+            ((movie_id, i, n, obj["characters"][n]["line_count"], obj["characters"][n]["avg_cs"]) for i, n in enumerate(names)))
+        c.executemany("INSERT INTO entries VALUES (?, ?, ?, ?)",
+            ((movie_id, i, ENTRY_TYPE_CODES[e["type"]], e.get("cs")) for i, e in enumerate(obj["entries"])))
+
+        # Co-occurrences are symmetric, only pairs (a, b) with a < b are stored
+        pairs = []
+        for namei, row in obj["cooccurrences"].items():
+            for namej, cell in row.items():
+                a, b = name_index[namei], name_index[namej]
+                if a < b and cell["count"] > 0:
+                    pairs.append((movie_id, a, b, cell["count"], cell["avg_cs"]))
+        c.executemany("INSERT INTO cooccurrences VALUES (?, ?, ?, ?, ?)", pairs)
+
+
+    """ Ingest all analyzed movie files that changed since they were last ingested, and remove the movies
+        whose file no longer exists. Returns the number of ingested files. """
+    def ingest(self, paths=None):
+        if paths == None:
+            paths = get_analyzed_files()
+        known = {path: (movie_id, size, mtime) for movie_id, path, size, mtime in self.connection.execute("SELECT id, path, size, mtime FROM movies")}
+
+        num_ingested = 0
+        with self.connection:
+            for path in paths:
+                file = build_manifest.stat_file(path)
+                if path in known and known[path][1:] == (file["size"], file["mtime"]):
+                    continue
+                self.ingest_file(path)
+                num_ingested += 1
+            for path, (movie_id, _, _) in known.items():
+                if path not in paths:
+                    self.remove_movie(movie_id)
+        return num_ingested
+
+
+    def get_titles(self):
+        return [title for title, in self.connection.execute("SELECT title FROM movies ORDER BY title")]
+
+
+    """ Get the line count and average compound score of all characters with the given name (ignoring case), in every
+        movie, along with their overall line count and average compound score (weighted by line count). Names are
+        returned as stored: the overall name is the one of the character with the most lines. """
+    def get_character_stats(self, name):
+        rows = self.connection.execute("""
+            SELECT m.title, c.name, c.line_count, c.avg_cs FROM characters c JOIN movies m ON m.id = c.movie_id
+            WHERE c.name = ? COLLATE NOCASE ORDER BY m.title""", (name,)).fetchall()
+        movies = [{"title": title, "name": stored_name, "line_count": line_count, "avg_cs": avg_cs} for title, stored_name, line_count, avg_cs in rows]
+        line_count = sum(m["line_count"] for m in movies)
+        avg_cs = sum(m["line_count"] * m["avg_cs"] for m in movies) / line_count if line_count > 0 else 0
+        stored_name = max(movies, key=lambda m: m["line_count"])["name"] if len(movies) > 0 else name
+        return {"name": stored_name, "line_count": line_count, "avg_cs": avg_cs, "movies": movies}
+
+
+    """ Get the k characters with the most lines across the corpus (or in a movie), as dicts. """
+    def get_top_characters(self, k=10, title=None):
+        query = "SELECT m.title, c.name, c.line_count, c.avg_cs FROM characters c JOIN movies m ON m.id = c.movie_id"
+        params = []
+        if title != None:
+            query += " WHERE m.title = ?"
+            params.append(title)
+        rows = self.connection.execute(query + " ORDER BY c.line_count DESC, m.title, c.idx LIMIT ?", params + [k])
+        return [{"title": title, "name": name, "line_count": line_count, "avg_cs": avg_cs} for title, name, line_count, avg_cs in rows]
+
+
+    """ Get the k pairs of characters sharing the most scenes across the corpus (or in a movie), as dicts. """
+    def get_top_cooccurrences(self, k=10, title=None):
+        query = """
+            SELECT m.title, ca.name, cb.name, co.count, co.avg_cs FROM cooccurrences co
+            JOIN movies m ON m.id = co.movie_id
+            JOIN characters ca ON ca.movie_id = co.movie_id AND ca.idx = co.a
+            JOIN characters cb ON cb.movie_id = co.movie_id AND cb.idx = co.b"""
+        params = []
+        if title != None:
+            query += " WHERE m.title = ?"
+            params.append(title)
+        rows = self.connection.execute(query + " ORDER BY co.count DESC, m.title, co.a, co.b LIMIT ?", params + [k])
+        return [{"title": title, "a": a, "b": b, "count": count, "avg_cs": avg_cs} for title, a, b, count, avg_cs in rows]
+
+
+    """ Get the sentiment timeline of a movie: the average compound score of its scored entries in each of the given
+        number of equal parts of the movie (None for parts without scored entries). Only entries of the given type
+        ("SPEECH" or "DIRECTION") are used if entry_type is given. Returns None for an unknown movie. """
+    def get_sentiment_timeline(self, title, bins=100, entry_type=None):
+        row = self.connection.execute("SELECT id, num_entries FROM movies WHERE title = ?", (title,)).fetchone()
+        if row == None:
+            return None
+        movie_id, num_entries = row
+
+        query = "SELECT position * ? / ? AS bin, AVG(cs) FROM entries WHERE movie_id = ? AND cs IS NOT NULL"
+        params = [bins, num_entries, movie_id]
+        if entry_type != None:
+            query += " AND type = ?"
+            params.append(ENTRY_TYPE_CODES[entry_type])
+
+        timeline = [None] * bins
+        for b, avg_cs in self.connection.execute(query + " GROUP BY bin", params):
+            timeline[b] = avg_cs
+        return timeline
+
+
+""" Add the command-line arguments of corpus queries to a parser. """
+def add_arguments(parser):
+    parser.add_argument("--db", default=config.CORPUS_DB_FILE, help="path of the corpus database")
+    parser.add_argument("-k", type=int, default=10, help="number of results of top-k queries")
+    subparsers = parser.add_subparsers(dest="query", required=True)
+    subparsers.add_parser("ingest", help="only ingest the analyzed files")
+    subparsers.add_parser("character", help="statistics of a character across movies").add_argument("name")
+    subparsers.add_parser("top-characters", help="characters with the most lines").add_argument("--title")
+    subparsers.add_parser("top-pairs", help="pairs of characters sharing the most scenes").add_argument("--title")
+    timeline_parser = subparsers.add_parser("timeline", help="sentiment timeline of a movie")
+    timeline_parser.add_argument("title")
+    timeline_parser.add_argument("--bins", type=int, default=20)
+
+
+def main(args):
+    db = CorpusDatabase(args.db)
+    num_ingested = db.ingest()
+    if num_ingested > 0:
+        print("Ingested", num_ingested, "analyzed files.")
+
+    if args.query == "character":
+        stats = db.get_character_stats(args.name)
+        print(stats["name"] + ":", stats["line_count"], "lines, average score {:.3f}".format(stats["avg_cs"]))
+        for m in stats["movies"]:
+            print("  {:<50} {:5d} lines, average score {:.3f}".format(m["title"], m["line_count"], m["avg_cs"]))
+    elif args.query == "top-characters":
+        for c in db.get_top_characters(args.k, args.title):
+            print("{:<25} {:<50} {:5d} lines, average score {:.3f}".format(c["name"], c["title"], c["line_count"], c["avg_cs"]))
+    elif args.query == "top-pairs":
+        for p in db.get_top_cooccurrences(args.k, args.title):
+            print("{:<41} {:<50} {:4d} scenes, average score {:.3f}".format(p["a"] + " & " + p["b"], p["title"], p["count"], p["avg_cs"]))
+    elif args.query == "timeline":
+        timeline = db.get_sentiment_timeline(args.title, args.bins)
+        if timeline == None:
+            print("Movie not found in the corpus:", args.title)
+        else:
+            for i, avg_cs in enumerate(timeline):
+                print("{:5.0%}".format(i / args.bins), "" if avg_cs == None else "{:+.3f}".format(avg_cs))
+    db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the analyzed corpus. Analyzed files that changed are ingested first.")
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,300 @@
+import argparse
+import contextlib
+import io
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import config
+import utils
+import build_manifest
+import instrumentation
+import columnar_format
+import script_fetcher
+import script_parser
+import script_analyzer
+import sentiment
+
+# Result statuses for a movie
+STATUS_OK = "ok"
+STATUS_SKIPPED = "skipped"
+STATUS_FAILED = "failed"
+
+# Statistics of the sentiment scorer reported for every movie
+SENTIMENT_STATS = ["requests", "memo_hits", "persistent_hits", "scored", "time"]
+
+# Options of a corpus run
+DEFAULT_OPTIONS = {
+    "verbose": False, # show the parser and analyzer output
+    "offline": False, # only use locally cached scripts
+    "sentiment_cache": False, # keep sentiment scores in a cache file shared across runs
+    "output_format": "json", # "json" or "columnar"
+    "compression": None, # compression of columnar output: None, "gzip" or "zstd"
+    "refresh": False, # revalidate cached scripts with the server
+    "profile": False, # add the most expensive functions (cProfile) to the report of each movie
+    "trace_memory": False, # add the peak memory allocated (tracemalloc) to the report of each movie
+}
+
+""" Rebuild a parsed script from a previously analyzed movie. """
+def restore_parsed_script(movie, previous):
+    parsed_script = script_parser.MovieScript(movie)
+    parsed_script.character_names = list(previous["characters"])
+    parsed_script.entries = [script_parser.Entry(e["type"], e["content"]) for e in previous["entries"]]
+    return parsed_script
+
+
+""" Get the sentiment scores of analyzed entries, in the order expected by AnalyzedMovieScript. """
+def get_sentiment_scores(entries):
+    return [e["cs"] for e in entries if e["type"] in [script_parser.TYPE_SPEECH, script_parser.TYPE_DIRECTION]]
+
+
+""" Run the stages of a movie whose inputs changed since its manifest record, reusing the outputs of the other
+    stages from the previous output file. Returns the new manifest record and the list of stages that were run. """
+def run_stages(movie, options, record, versions):
+    stages = []
+    script_cache = script_fetcher.get_cache()
+    entry = script_cache.get_entry(movie["script_page"])
+
+    # Fetch the script when it is not cached or when cached scripts must be revalidated
+    raw_script = None
+    if options["refresh"] or entry == None:
+        raw_script = script_fetcher.get_raw_script(movie, offline=options["offline"], refresh=options["refresh"])
+        stages.append("fetch")
+        entry = script_cache.get_entry(movie["script_page"])
+    raw_hash = entry["hash"] if entry != None else None
+
+    # Movies without a usable script are recorded, unless their script may become available later
+    skipped_record = {"status": STATUS_SKIPPED, "raw": raw_hash} if raw_hash != None or not movie["script_page"].lower().endswith(".html") else None
+    if "fetch" in stages and raw_script == None:
+        return skipped_record, stages
+
+    # Previous output, read when a stage can be reused
+    previous = None
+    def get_previous():
+        nonlocal previous
+        if previous == None:
+            with instrumentation.timer("restore"):
+                previous = columnar_format.read_analyzed(record["output"]["path"])
+        return previous
+    can_reuse = record != None and record["status"] == STATUS_OK and build_manifest.is_output_intact(record)
+
+    # Parse
+    parse_key = build_manifest.stage_key("parse", versions, [raw_hash, movie])
+    if can_reuse and record["parse"]["key"] == parse_key:
+        parsed_script = restore_parsed_script(movie, get_previous())
+        parse_output = record["parse"]["output"]
+    else:
+        if raw_script == None:
+            raw_script = script_fetcher.get_raw_script(movie, offline=True)
+            if raw_script == None:
+                return skipped_record, stages
+        parsed_script = script_parser.parse_raw_script(movie, raw_script)
+        parse_output = build_manifest.hash_data(parsed_script.info, parsed_script.character_names, [e.to_dict() for e in parsed_script.entries])
+        stages.append("parse")
+
+    # Sentiment, reused as long as the parser output did not change
+    sentiment_key = build_manifest.stage_key("sentiment", versions, parse_output)
+    scores = None
+    if can_reuse and record["sentiment"]["key"] == sentiment_key:
+        scores = get_sentiment_scores(get_previous()["entries"])
+    else:
+        stages.append("sentiment")
+
+    # Analysis and output take a few milliseconds, they are run whenever any stage changed
+    analyzed = script_analyzer.AnalyzedMovieScript(parsed_script, scores=scores)
+    sentiment_output = build_manifest.hash_data(get_sentiment_scores(analyzed.entries))
+    analysis_key = build_manifest.stage_key("analysis", versions, sentiment_output)
+    path = script_analyzer.save_analyzed_movie(analyzed, options["output_format"], options["compression"])
+    stages += ["analysis", "output"]
+
+    new_record = {
+        "status": STATUS_OK,
+        "raw": raw_hash,
+        "parse": {"key": parse_key, "output": parse_output},
+        "sentiment": {"key": sentiment_key, "output": sentiment_output},
+        "analysis": {"key": analysis_key},
+        "output": {"key": build_manifest.stage_key("output", versions, analysis_key, options), "path": path, "file": build_manifest.stat_file(path)},
+    }
+    return new_record, stages
+
+
+""" Parse, analyze and save a single movie, only running the stages whose inputs changed since its manifest record.
+    Never raises: failures are reported in the returned result, along with the new manifest record and the report
+    of the timers and counters of the stages (see instrumentation). """
+def process_movie(movie, options=DEFAULT_OPTIONS, record=None, versions=None):
+    result = {"title": movie["title"], "status": STATUS_OK, "error": None, "stages": [], "record": None, "sentiment": {k: 0 for k in SENTIMENT_STATS}}
+    start = time.perf_counter()
+    report = instrumentation.Report()
+
+    # Parser and analyzer output is only shown in verbose mode
+    output = contextlib.nullcontext() if options["verbose"] else contextlib.redirect_stdout(io.StringIO())
+    try:
+        if versions == None:
+            versions = build_manifest.get_stage_versions()
+
+        # Worker processes keep their sentiment scorer across movies
+        if options["sentiment_cache"] and sentiment.get_scorer().cache_file == None:
+            sentiment.scorer = sentiment.SentimentScorer(cache_file=config.SENTIMENT_CACHE_FILE)
+        scorer = sentiment.get_scorer()
+        stats_before = scorer.get_stats()
+
+        try:
+            with output, instrumentation.record(options["profile"], options["trace_memory"]) as report:
+                result["record"], result["stages"] = run_stages(movie, options, record, versions)
+            if result["record"] == None or result["record"]["status"] == STATUS_SKIPPED:
+                result["status"] = STATUS_SKIPPED
+            scorer.save_persistent()
+        finally:
+            stats = scorer.get_stats()
+            result["sentiment"] = {k: stats[k] - stats_before[k] for k in SENTIMENT_STATS}
+    except Exception:
+        result["status"] = STATUS_FAILED
+        result["error"] = traceback.format_exc()
+
+    result["report"] = report.to_dict()
+    result["time"] = time.perf_counter() - start
+    return result
+
+
+""" Get the result of a movie whose processing failed outside of process_movie (e.g. its worker process died). """
+def get_failed_result(movie, error):
+    return {"title": movie["title"], "status": STATUS_FAILED, "error": error, "stages": [], "record": None,
+        "sentiment": {k: 0 for k in SENTIMENT_STATS}, "report": instrumentation.Report().to_dict(), "time": 0}
+
+
+""" Process all given movies over a pool of worker processes, printing progress as movies complete.
+    Movies whose stages are all up to date in the manifest are skipped, unless force is set.
+    The manifest is updated with the records of the processed movies. """
+def run_corpus(movies, workers=None, options=DEFAULT_OPTIONS, manifest=None, force=False):
+    if manifest == None:
+        manifest = build_manifest.BuildManifest()
+    versions = build_manifest.get_stage_versions()
+
+    # Only check the hash of cached scripts here, outputs are checked from their size and modification time
+    script_cache = script_fetcher.get_cache()
+    to_process = []
+    num_unavailable = 0
+    for movie in movies:
+        entry = script_cache.get_entry(movie["script_page"])
+        record = None if force else manifest.get(movie)
+        if options["offline"] and entry == None and record == None and movie["script_page"].lower().endswith(".html"):
+            # Nothing can be done for this movie until its script is downloaded
+            num_unavailable += 1
+        elif force or options["refresh"] or not build_manifest.is_up_to_date(record, movie, entry["hash"] if entry != None else None, versions, options):
+            to_process.append(movie)
+    print(len(movies) - len(to_process) - num_unavailable, "movies are up to date.")
+    if num_unavailable > 0:
+        print(num_unavailable, "movies have no cached script (offline mode).")
+
+    results = []
+    if len(to_process) == 0:
+        return results
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_movie, movie, options, None if force else manifest.get(movie), versions): movie for movie in to_process}
+            for future in as_completed(futures):
+                movie = futures[future]
+                try:
+                    result = future.result()
+                except Exception:
+                    # The worker process died (BrokenProcessPool), or the result could not be sent back
+                    result = get_failed_result(movie, traceback.format_exc())
+                results.append(result)
+                # Movies without a record (e.g. scripts not downloaded yet) keep their previous one
+                if result["status"] != STATUS_FAILED and result["record"] != None:
+                    manifest.set(movie, result["record"])
+                stages = " (" + ", ".join(result["stages"]) + ")" if len(result["stages"]) > 0 else ""
+                print("[" + str(len(results)) + "/" + str(len(to_process)) + "]", "'" + result["title"] + "':", result["status"] + stages, "({:.1f}s)".format(result["time"]))
+    finally:
+        manifest.save()
+    return results
+
+
+""" Print a summary of the results of a corpus run. """
+def print_summary(results, elapsed):
+    statuses = {STATUS_OK: 0, STATUS_SKIPPED: 0, STATUS_FAILED: 0}
+    for r in results:
+        statuses[r["status"]] += 1
+
+    cpu_time = sum(r["time"] for r in results)
+    print("Processed", len(results), "movies in {:.1f}s (cumulated movie time: {:.1f}s).".format(elapsed, cpu_time))
+    print("Succeeded:", statuses[STATUS_OK], "- Skipped:", statuses[STATUS_SKIPPED], "- Failed:", statuses[STATUS_FAILED])
+    if len(results) > 0:
+        print("Stage timings (cumulated):", instrumentation.format_timers(instrumentation.merge_reports([r["report"] for r in results])))
+
+    # Sentiment scoring statistics, summed over all worker processes
+    num_scored = sum(r["sentiment"]["requests"] for r in results)
+    if num_scored > 0:
+        hits = sum(r["sentiment"]["memo_hits"] + r["sentiment"]["persistent_hits"] for r in results)
+        scoring_time = sum(r["sentiment"]["time"] for r in results)
+        print("Sentiment scoring: {} entries, {:.1%} cache hits, {:.0f} entries/s.".format(num_scored, hits / num_scored, num_scored / scoring_time))
+
+    for r in results:
+        if r["status"] == STATUS_FAILED:
+            print("\nFailed: '" + r["title"] + "'", r["error"], sep="\n")
+
+
+""" Add the command-line arguments of corpus runs to a parser. """
+def add_arguments(parser):
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument("--all", action="store_true", help="process every movie of the metadata file")
+    selection.add_argument("--titles", nargs="+", metavar="TITLE", help="process the movies with the given titles")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--verbose", action="store_true", help="show the parser and analyzer output")
+    parser.add_argument("--offline", action="store_true", help="only use locally cached scripts, never access the network")
+    parser.add_argument("--refresh", action="store_true", help="revalidate cached scripts with the server")
+    parser.add_argument("--force", action="store_true", help="run all stages of every movie, even if they are up to date")
+    parser.add_argument("--sentiment-cache", action="store_true", help="keep sentiment scores in a cache file shared across runs")
+    parser.add_argument("--format", choices=["json", "columnar"], default="json", help="output format of analyzed scripts")
+    parser.add_argument("--compression", choices=["gzip", "zstd"], default=None, help="compress columnar output")
+    parser.add_argument("--report", metavar="PATH", help="write a JSON report of the run, with the timings of every movie")
+    parser.add_argument("--profile", action="store_true", help="profile every movie with cProfile (in the report)")
+    parser.add_argument("--trace-memory", action="store_true", help="trace the peak memory of every movie with tracemalloc (in the report, slow)")
+
+
+def main(args):
+    if args.all:
+        movies = utils.get_all_movies_metadata()
+    else:
+        titles = args.titles if args.titles else script_analyzer.EXPORT_MOVIES
+        movies = []
+        for title in titles:
+            movie = utils.get_movie_metadata_by_name(title)
+            if movie == None:
+                print("Movie not found in metadata:", title)
+            else:
+                movies.append(movie)
+
+    options = {
+        "verbose": args.verbose,
+        "offline": args.offline,
+        "sentiment_cache": args.sentiment_cache,
+        "output_format": args.format,
+        "compression": args.compression,
+        "refresh": args.refresh and not args.offline,
+        "profile": args.profile,
+        "trace_memory": args.trace_memory,
+    }
+
+    print("Processing", len(movies), "movies with", args.workers, "workers...")
+    start = time.perf_counter()
+    results = run_corpus(movies, args.workers, options, force=args.force)
+    elapsed = time.perf_counter() - start
+    print_summary(results, elapsed)
+
+    if args.report:
+        instrumentation.write_report({
+            "elapsed": elapsed,
+            "workers": args.workers,
+            "options": options,
+            "totals": instrumentation.merge_reports([r["report"] for r in results]),
+            "movies": [{k: r[k] for k in ["title", "status", "stages", "time", "sentiment", "report"]} for r in results],
+        }, args.report)
+        print("Report written to", args.report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parse and analyze movie scripts in parallel.")
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,399 @@
+import argparse
+import bisect
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+
+import config
+import utils
+import build_manifest
+import columnar_format
+import corpus_db
+
+MAGIC = b"MADIDX1\n"
+# Sections are aligned for zero-copy NumPy views of the memory-mapped file
+SECTION_ALIGNMENT = 8
+
+# Entry types whose contents are indexed
+INDEXED_TYPES = ["SPEECH", "DIRECTION"]
+ENTRY_TYPE_CODES = {t: i for i, t in enumerate(columnar_format.ENTRY_TYPES)}
+
+# Tokens: lowercase words and numbers, with inner apostrophes ("don't", "o'clock")
+exp_token = re.compile(r"[0-9a-z]+(?:'[0-9a-z]+)*")
+
+""" Split text into index terms. """
+def tokenize(text):
+    return exp_token.findall(text.lower().replace("’", "'"))
+
+
+""" Encode non-negative integers as LEB128 varints (7 bits per byte, high bit set on all but the last byte). """
+def encode_varints(values):
+    import numpy as np
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = get_varint_lengths(values)
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    starts = np.cumsum(lengths) - lengths
+    for j in range(int(lengths.max()) if len(values) > 0 else 0):
+        selected = lengths > j
+        data = ((values[selected] >> np.uint64(7 * j)) & np.uint64(0x7f)).astype(np.uint8)
+        data[lengths[selected] - 1 > j] |= 0x80
+        out[starts[selected] + j] = data
+    return out
+
+""" Get the number of bytes of the varint of each value. """
+def get_varint_lengths(values):
+    import numpy as np
+    lengths = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        lengths += values >= np.uint64(1 << (7 * k))
+    return lengths
+
+""" Decode a buffer of varints written by encode_varints. """
+def decode_varints(data):
+    import numpy as np
+    data = np.frombuffer(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    is_last = data < 0x80
+    starts = np.concatenate(([0], np.flatnonzero(is_last)[:-1] + 1))
+    # Index of the value of each byte, and of the byte within its value
+    value_of_byte = np.cumsum(is_last) - is_last
+    shifts = (np.arange(len(data)) - starts[value_of_byte]) * 7
+    return np.add.reduceat((data & 0x7f).astype(np.int64) << shifts, starts)
+
+
+""" Builds a dialogue index: the SPEECH and DIRECTION entries of movies are tokenized, then written as a sorted term
+    dictionary with delta-encoded postings (see write). """
+class IndexBuilder:
+    def __init__(self):
+        self.movies = []
+        self.character_ids = dict()
+        self.term_ids = dict()
+        # Indexed entries
+        self.doc_movie, self.doc_entry, self.doc_character, self.doc_type, self.doc_cs = [], [], [], [], []
+        # Tokens: term, indexed entry and position in the entry
+        self.token_term, self.token_doc, self.token_position = [], [], []
+
+
+    """ Add the entries of a movie (dicts or script_parser.Entry objects), with the path of the analyzed file it was
+        read from, if any. SPEECH entries are attributed to the CHARACTER entry before them. """
+    def add_movie(self, info, entries, path=None):
+        movie_id = len(self.movies)
+        self.movies.append({"title": info["title"], "path": path, "file": build_manifest.stat_file(path) if path != None else None, "num_entries": len(entries)})
+        term_ids = self.term_ids
+        for i, e in enumerate(entries):
+            if e["type"] not in INDEXED_TYPES:
+                continue
+            character = -1
+            if e["type"] == "SPEECH" and i > 0 and entries[i-1]["type"] == "CHARACTER":
+                character = self.character_ids.setdefault(entries[i-1]["content"], len(self.character_ids))
+            cs = e.get("cs")
+            doc = len(self.doc_entry)
+            self.doc_movie.append(movie_id)
+            self.doc_entry.append(i)
+            self.doc_character.append(character)
+            self.doc_type.append(ENTRY_TYPE_CODES[e["type"]])
+            self.doc_cs.append(math.nan if cs == None else cs)
+
+            terms = [term_ids.setdefault(t, len(term_ids)) for t in tokenize(e["content"])]
+            self.token_term += terms
+            self.token_doc += [doc] * len(terms)
+            self.token_position += range(len(terms))
+
+
+    """ Write the index to a file, atomically. Postings are sorted by term, then entry and position, and stored in
+        three varint streams: the delta of the indexed entry of each (term, entry) pair from the previous one of the
+        term, the number of occurrences of the term in the entry, and the delta of each position from the previous
+        one in the entry. The term dictionary gives the start of every term in each stream. """
+    def write(self, path):
+        import numpy as np
+        terms = sorted(self.term_ids, key=lambda t: t.encode("utf-8"))
+        rank = np.empty(len(terms), dtype=np.int64)
+        rank[[self.term_ids[t] for t in terms]] = np.arange(len(terms))
+
+        token_term = rank[np.array(self.token_term, dtype=np.int64)]
+        token_doc = np.array(self.token_doc, dtype=np.int64)
+        token_position = np.array(self.token_position, dtype=np.int64)
+        order = np.lexsort((token_position, token_doc, token_term))
+        token_term, token_doc, token_position = token_term[order], token_doc[order], token_position[order]
+
+        # (term, entry) pairs
+        is_pair_start = np.ones(len(order), dtype=bool)
+        is_pair_start[1:] = (token_term[1:] != token_term[:-1]) | (token_doc[1:] != token_doc[:-1])
+        pair_starts = np.flatnonzero(is_pair_start)
+        pair_term, pair_doc = token_term[pair_starts], token_doc[pair_starts]
+        pair_count = np.diff(np.append(pair_starts, len(order)))
+        is_term_start = np.ones(len(pair_starts), dtype=bool)
+        is_term_start[1:] = pair_term[1:] != pair_term[:-1]
+
+        doc_deltas = pair_doc.copy()
+        doc_deltas[1:] -= np.where(is_term_start[1:], 0, pair_doc[:-1])
+        position_deltas = token_position.copy()
+        position_deltas[1:] -= np.where(is_pair_start[1:], 0, token_position[:-1])
+
+        # Start of every term in each stream
+        pairs_per_term = np.bincount(pair_term, minlength=len(terms))
+        tokens_per_term = np.bincount(token_term, minlength=len(terms))
+        # Offsets are stored as uint32 unless a stream is larger than 4 GB
+        def offsets(values, per_term):
+            byte_ends = np.concatenate(([0], np.cumsum(get_varint_lengths(values.astype(np.uint64)))))
+            return byte_ends[np.concatenate(([0], np.cumsum(per_term)))].astype(np.uint32 if byte_ends[-1] < 2**32 else np.uint64)
+
+        encoded_terms = [t.encode("utf-8") for t in terms]
+        sections = {
+            "term_strings": np.frombuffer(b"".join(encoded_terms), dtype=np.uint8),
+            "term_offsets": np.cumsum([0] + [len(t) for t in encoded_terms], dtype=np.uint32),
+            "term_frequencies": pairs_per_term.astype(np.uint32),
+            "doc_offsets": offsets(doc_deltas, pairs_per_term),
+            "count_offsets": offsets(pair_count, pairs_per_term),
+            "position_offsets": offsets(position_deltas, tokens_per_term),
+            "docs": encode_varints(doc_deltas),
+            "counts": encode_varints(pair_count),
+            "positions": encode_varints(position_deltas),
+            "doc_movie": np.array(self.doc_movie, dtype=np.uint32),
+            "doc_entry": np.array(self.doc_entry, dtype=np.uint32),
+            "doc_character": np.array(self.doc_character, dtype=np.int32),
+            "doc_type": np.array(self.doc_type, dtype=np.uint8),
+            "doc_cs": np.array(self.doc_cs, dtype=np.float32),
+        }
+
+        with utils.write_atomic(path, "wb") as f:
+            f.write(MAGIC)
+            header = {"movies": self.movies, "characters": sorted(self.character_ids, key=self.character_ids.get),
+                "num_tokens": len(order), "sections": dict()}
+            for name, array in sections.items():
+                f.write(b"\0" * (-f.tell() % SECTION_ALIGNMENT))
+                header["sections"][name] = [f.tell(), array.dtype.str, len(array)]
+                f.write(array.tobytes())
+            # The header is at the end of the file, followed by its offset
+            header_offset = f.tell()
+            f.write(json.dumps(header).encode("utf-8"))
+            f.write(struct.pack("<Q", header_offset))
+        return path
+
+
+""" Sorted terms of the memory-mapped term dictionary, as a sequence for binary search. """
+class TermList:
+    def __init__(self, strings, offsets):
+        self.strings = strings
+        self.offsets = offsets
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+    def __getitem__(self, i):
+        return self.strings[int(self.offsets[i]):int(self.offsets[i+1])].tobytes()
+
+
+""" Full-text index of the dialogue and directions of the analyzed corpus, memory-mapped: only the term dictionary
+    entries and postings of the queried terms are read. Hits are dicts with the title of the movie, the path of its
+    analyzed file, the index of the entry in the analyzed movie, its type, the speaking character (SPEECH entries) and
+    the compound score. """
+class DialogueIndex:
+    def __init__(self, path=None):
+        path = config.DIALOGUE_INDEX_FILE if path == None else path
+        import numpy as np
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a dialogue index: " + path)
+        header_offset, = struct.unpack("<Q", self.mmap[-8:])
+        header = json.loads(self.mmap[header_offset:-8])
+        self.movies = header["movies"]
+        self.characters = header["characters"]
+        self.num_tokens = header["num_tokens"]
+        for name, (offset, dtype, length) in header["sections"].items():
+            setattr(self, name, np.frombuffer(self.mmap, dtype=dtype, count=length, offset=offset))
+        self.terms = TermList(self.term_strings, self.term_offsets)
+        # Ids of the characters by normalized name: names may differ in case or punctuation between movies (e.g.
+        # after scan error corrections), and in the queries
+        self.character_ids = dict()
+        for i, name in enumerate(self.characters):
+            self.character_ids.setdefault(utils.normalize_name(name), []).append(i)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        import numpy as np
+        # NumPy views must be released before the map can be closed
+        for name in list(vars(self)):
+            if isinstance(getattr(self, name), np.ndarray):
+                delattr(self, name)
+        self.terms = None
+        self.mmap.close()
+
+
+    """ Whether the index covers exactly the given analyzed files, unchanged since the index was built. """
+    def is_up_to_date(self, paths):
+        return sorted((m["path"], m["file"]) for m in self.movies) == sorted((p, build_manifest.stat_file(p)) for p in paths)
+
+
+    """ Get the id of a term, or None if it is not in the index. """
+    def get_term_id(self, term):
+        key = term.encode("utf-8")
+        i = bisect.bisect_left(self.terms, key)
+        return i if i < len(self.terms) and self.terms[i] == key else None
+
+
+    """ Get the postings of a term: the indexed entries it occurs in, with the number of occurrences in each, and
+        the positions of all occurrences (grouped by entry). """
+    def get_postings(self, term):
+        import numpy as np
+        t = self.get_term_id(term)
+        if t == None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        docs = np.cumsum(decode_varints(self.docs[self.doc_offsets[t]:self.doc_offsets[t+1]]))
+        counts = decode_varints(self.counts[self.count_offsets[t]:self.count_offsets[t+1]])
+        deltas = decode_varints(self.positions[self.position_offsets[t]:self.position_offsets[t+1]])
+        # Positions are deltas from the previous position in the entry, and the first one of each entry is absolute
+        positions = np.cumsum(deltas)
+        starts = np.cumsum(counts) - counts
+        positions -= np.repeat(positions[starts] - deltas[starts], counts)
+        return docs, counts, positions
+
+
+    """ Get the indexed entries that contain all the given terms. """
+    def match_terms(self, terms):
+        import numpy as np
+        docs = None
+        for term in terms:
+            term_docs = self.get_postings(term)[0]
+            docs = term_docs if docs is None else np.intersect1d(docs, term_docs, assume_unique=True)
+            if len(docs) == 0:
+                break
+        return docs if docs is not None else np.zeros(0, dtype=np.int64)
+
+
+    """ Get the indexed entries that contain the given terms next to each other, in order. """
+    def match_phrase(self, terms):
+        import numpy as np
+        keys = None
+        for k, term in enumerate(terms):
+            docs, counts, positions = self.get_postings(term)
+            # (entry, position of the first term of the phrase)
+            term_keys = (np.repeat(docs, counts) << 32) + positions - k
+            keys = term_keys if keys is None else np.intersect1d(keys, term_keys, assume_unique=True)
+            if len(keys) == 0:
+                break
+        if keys is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(keys >> 32)
+
+
+    """ Search the index for entries containing all the words of a query, or the query as a phrase. Hits can be
+        filtered by movie title, speaking character (ignoring case and punctuation), entry type ("SPEECH" or
+        "DIRECTION") and range of compound score. Hits are in the order of the corpus; at most limit hits are returned
+        (all if None). """
+    def search(self, query, phrase=False, title=None, character=None, entry_type=None, min_cs=None, max_cs=None, limit=None):
+        import numpy as np
+        terms = tokenize(query)
+        if len(terms) == 0:
+            return []
+        docs = self.match_phrase(terms) if phrase else self.match_terms(terms)
+
+        mask = np.ones(len(docs), dtype=bool)
+        if title != None:
+            movie_ids = [i for i, m in enumerate(self.movies) if utils.normalize_title(m["title"]) == utils.normalize_title(title)]
+            mask &= np.isin(self.doc_movie[docs], movie_ids)
+        if character != None:
+            mask &= np.isin(self.doc_character[docs], self.character_ids.get(utils.normalize_name(character), []))
+        if entry_type != None:
+            mask &= self.doc_type[docs] == ENTRY_TYPE_CODES[entry_type]
+        if min_cs != None:
+            mask &= self.doc_cs[docs] >= min_cs
+        if max_cs != None:
+            mask &= self.doc_cs[docs] <= max_cs
+        docs = docs[mask][:limit]
+
+        hits = []
+        columns = zip(self.doc_movie[docs].tolist(), self.doc_entry[docs].tolist(), self.doc_type[docs].tolist(), self.doc_character[docs].tolist(), self.doc_cs[docs].round(4).tolist())
+        for movie_id, entry, type_code, character_id, cs in columns:
+            hits.append({
+                "title": self.movies[movie_id]["title"],
+                "path": self.movies[movie_id]["path"],
+                "entry": entry,
+                "type": columnar_format.ENTRY_TYPES[type_code],
+                "character": self.characters[character_id] if character_id >= 0 else None,
+                "cs": None if math.isnan(cs) else cs,
+            })
+        return hits
+
+
+""" Build the dialogue index of the analyzed files. """
+def build_index(paths=None, path=None):
+    path = config.DIALOGUE_INDEX_FILE if path == None else path
+    if paths == None:
+        paths = corpus_db.get_analyzed_files()
+    builder = IndexBuilder()
+    for p in paths:
+        obj = columnar_format.read_analyzed(p, sparse=True)
+        builder.add_movie(obj["info"], obj["entries"], p)
+    return builder.write(path)
+
+
+""" Open the dialogue index of the analyzed files, building it first if it is missing or out of date. """
+def open_index(path=None):
+    path = config.DIALOGUE_INDEX_FILE if path == None else path
+    paths = corpus_db.get_analyzed_files()
+    if os.path.exists(path):
+        index = DialogueIndex(path)
+        if index.is_up_to_date(paths):
+            return index
+        index.close()
+    build_index(paths, path)
+    return DialogueIndex(path)
+
+
+""" Add the command-line arguments of dialogue searches to a parser. """
+def add_arguments(parser):
+    parser.add_argument("query", nargs="?", help="words to search (all of them must occur in an entry)")
+    parser.add_argument("--index", default=config.DIALOGUE_INDEX_FILE, help="path of the index file")
+    parser.add_argument("--build", action="store_true", help="only build the index")
+    parser.add_argument("--phrase", action="store_true", help="search the words as a phrase")
+    parser.add_argument("--title", help="only search this movie")
+    parser.add_argument("--character", help="only search the lines of this character")
+    parser.add_argument("--type", choices=INDEXED_TYPES, help="only search entries of this type")
+    parser.add_argument("--min-cs", type=float, help="minimum compound sentiment score")
+    parser.add_argument("--max-cs", type=float, help="maximum compound sentiment score")
+    parser.add_argument("-k", type=int, default=20, help="maximum number of hits shown")
+
+
+def main(args):
+    if args.build:
+        path = build_index(path=args.index)
+        with DialogueIndex(path) as index:
+            print("Indexed", len(index.movies), "movies,", len(index.doc_entry), "entries,", index.num_tokens, "tokens,", len(index.terms), "terms ({:.0f} KB)".format(os.path.getsize(path) / 1024))
+    elif args.query == None:
+        sys.exit("A query is required (or --build).")
+    else:
+        with open_index(args.index) as index:
+            hits = index.search(args.query, args.phrase, args.title, args.character, args.type, args.min_cs, args.max_cs)
+            print(len(hits), "hits")
+            # Contents are not stored in the index: they are read from the analyzed files of the hits shown (by path, as
+            # several files may have the same title)
+            movies = dict()
+            for hit in hits[:args.k]:
+                if hit["path"] not in movies:
+                    movies[hit["path"]] = columnar_format.open_analyzed(hit["path"])
+                content = movies[hit["path"]]["entries"][hit["entry"]]["content"]
+                speaker = hit["character"] if hit["character"] != None else "(" + hit["type"].lower() + ")"
+                print("  {:<35} {:<20} {:>6}  {}".format(hit["title"][:35], speaker[:20], "" if hit["cs"] == None else "{:+.3f}".format(hit["cs"]), content.strip()[:100]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search what characters say in the analyzed corpus. The index is built again when analyzed files changed.")
+    add_arguments(parser)
+    main(parser.parse_args())
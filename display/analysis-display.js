@@ -3,6 +3,10 @@ const TYPE_CHARACTER = "CHARACTER";
 const TYPE_LOCATION = "LOCATION";
 const TYPE_DIRECTION = "DIRECTION";
 
+// Precomputed sentiment timelines: maximum number of points plotted, and smoothing window
+const MAX_TIMELINE_POINTS = 1000;
+const TIMELINE_WINDOW = "0.2";
+
 // Get DOM elements for later use
 let dom = {};
 dom.breakdownSelect = $("#content-character-breakdown select");
@@ -42,13 +46,6 @@ function onResize() {
 window.addEventListener("resize", onResize);
 onResize();
 
-// Create a FileReader to be used for reading the analyzed scripts in JSON format.
-let fr = new FileReader();
-fr.onload = () => {
-    displayMovie(JSON.parse(fr.result));
-    enableMovieSpecificSections();
-};
-
 function getSettings() {
     // Read settings
     let minLinesThreshold = $("#min-lines-threshold").val();
@@ -147,8 +144,8 @@ function createSocialGraph(movie, settings) {
         
         for(let cjName in movie.characters) {
             let cj = movie.characters[cjName];
-            let co = movie.cooccurrences[ci.name][cj.name]; 
-            if(ciName == cjName || co.count == 0 || cj.line_count <= settings.minLinesThresholdGraph)
+            let co = movie.cooccurrences[ci.name][cj.name]; // missing when co-occurrences are sparse
+            if(ciName == cjName || co === undefined || co.count == 0 || cj.line_count <= settings.minLinesThresholdGraph)
                 continue;
             
             g.edges.push({
@@ -200,7 +197,7 @@ function createSocialGraph(movie, settings) {
     return interactionGraph;
 }
 
-function showCharacterBreakdown(name) {
+async function showCharacterBreakdown(name) {
     let character = movie.characters[name];
 
     dom.breakdownMeta.empty();
@@ -216,33 +213,10 @@ function showCharacterBreakdown(name) {
             )
     );
     
-    // Attempt at average per scene
-    let lineIndices = [], lines = [], lineIndex = 0;
-    let scoresSceneAvg = [];
-    let scores = [];
-    let sceneLines = 0, sceneSum = 0;
-
-    for(let i = 1; i < movie.entries.length; i++) {
-        let prevE = movie.entries[i-1];
-        let e = movie.entries[i];
-        if(e.type == TYPE_SPEECH && prevE.type == TYPE_CHARACTER) {
-            if(prevE.content == name) {
-                lineIndices.push(lineIndex);
-                lines.push(e.content);
-                scores.push(e.cs);
-                sceneLines++;
-                sceneSum += e.cs;
-            }
-            lineIndex++;
-        }
-        else if(e.type == TYPE_LOCATION) {
-            let sceneAvg = sceneSum / sceneLines;
-            for(let j = 0; j < sceneLines; j++)
-                scoresSceneAvg.push(sceneAvg);
-            sceneLines = 0;
-            sceneSum = 0;
-        }
-    }
+    let shownMovie = movie;
+    let series = await getSentimentSeries(movie, "speech", name);
+    if(movie != shownMovie)
+        return; // another movie was loaded in the meantime
 
     let canvas = $("<canvas>");
     let chartCtx = canvas[0].getContext("2d");
@@ -251,10 +225,10 @@ function showCharacterBreakdown(name) {
     new Chart(chartCtx, {
         type: "line",
         data: {
-            labels: lineIndices,
+            labels: series.x,
             datasets: [
-                {data: scores, label: "Sentiment score (compound)", fill: false},
-                {data: smoothMovingWindow(scores), label: "Sentiment score (compound), smoothed", fill: false, borderColor: "rgb(60,140,180)"}
+                {data: series.raw, label: "Sentiment score (compound)", fill: false},
+                {data: series.smoothed, label: "Sentiment score (compound), smoothed", fill: false, borderColor: "rgb(60,140,180)"}
             ]
         },
         options: {
@@ -266,7 +240,7 @@ function showCharacterBreakdown(name) {
             tooltips: {
                 callbacks: {
                     title: (tooltipItem, data) => formatLabelTitle(tooltipItem),
-                    label: (tooltipItem, data) => formatLabel(lines[tooltipItem.index])
+                    label: (tooltipItem, data) => formatLabel(series.content[tooltipItem.index])
                 },
             }
         }
@@ -274,39 +248,30 @@ function showCharacterBreakdown(name) {
 }
 
 
-function updateCharacterInteractions() {
+async function updateCharacterInteractions() {
     let nameA = dom.characterInteractionsSelectA.val();
     let nameB = dom.characterInteractionsSelectB.val();
+    let shownMovie = movie;
 
-    let lineIndices = [], lines = [], lineIndex = 0;
-    let scoresA = [], scoresB = [];
-    let numInteractions = 0;
+    let exchanges = await getInteractions(movie, nameA, nameB);
+    if(movie != shownMovie)
+        return; // another movie was loaded in the meantime
 
-    for(let i = 2; i < movie.entries.length - 2; i++) {
-        let e = movie.entries[i];
-        if(e.type == TYPE_CHARACTER) {
-            let speech = movie.entries[i+1];
-            let isA = e.content == nameA, isB = e.content == nameB;
-            
-            let previousCharacter = getPreviousCharacter(movie, i), nextCharacter = getNextCharacter(movie, i);
-            let aToB = isA && (previousCharacter == nameB || nextCharacter == nameB);
-            let bToA = isB && (previousCharacter == nameA || nextCharacter == nameA);
+    let lineIndices = [], lines = [];
+    let scoresA = [], scoresB = [];
+    let numInteractions = exchanges.length;
 
-            if(aToB) {
-                scoresA.push(speech.cs);
-                scoresB.push(NaN);
-            }
-            if(bToA) {
-                scoresB.push(speech.cs);
-                scoresA.push(NaN);
-            }
-            if(aToB || bToA) {
-                numInteractions++;
-                lines.push(speech.content);
-                lineIndices.push(lineIndex);
-            }
-            lineIndex++;
+    for(let exchange of exchanges) {
+        if(exchange.speaker == nameA) {
+            scoresA.push(exchange.cs);
+            scoresB.push(NaN);
+        }
+        if(exchange.speaker == nameB) {
+            scoresB.push(exchange.cs);
+            scoresA.push(NaN);
         }
+        lines.push(exchange.content);
+        lineIndices.push(exchange.turn);
     }
 
     let averageScore = 0;
@@ -388,9 +353,29 @@ $(document).ready(() => {
     // Register listener on file selection input
     $("#movie-file-selection").change((d) => {
         let file = $("#movie-file-selection")[0].files[0];
-        fr.readAsText(file);
+        readMovieFile(file).then((newMovie) => {
+            displayMovie(newMovie);
+            enableMovieSpecificSections();
+        });
     });
 
+    // When the viewer is served by the query server, movies can be loaded from it
+    if(location.protocol.startsWith("http")) {
+        fetchJSON("api/movies").then((data) => {
+            let select = $("#movie-server-selection");
+            for(let m of data.movies)
+                select.append($("<option>").text(m.name).attr("value", m.name));
+            $("#movie-server-selection-container").show();
+
+            select.change(() => {
+                fetchMovie(select.val()).then((newMovie) => {
+                    displayMovie(newMovie);
+                    enableMovieSpecificSections();
+                });
+            });
+        }).catch(() => {}); // served by another web server
+    }
+
     // Register listener on character breakdown <select>
     dom.breakdownSelect.change(() => {
         showCharacterBreakdown(dom.breakdownSelect.val());
@@ -403,32 +388,21 @@ $(document).ready(() => {
 });
 
 
-function createDirectionSentimentChart(movie, container) {
+async function createDirectionSentimentChart(movie, container) {
+    let series = await getSentimentSeries(movie, "direction");
+
     let canvas = $("<canvas>");
     container.empty().append(canvas);
     
     let chartCtx2d = canvas[0].getContext("2d");
-    
-    let lineIndices = [], lines = [], lineIndex = 0;
-    let scores = [];
-
-    for(let i = 0; i < movie.entries.length; i++) {
-        let e = movie.entries[i];
-        if(e.type == TYPE_DIRECTION) {
-            lineIndices.push(lineIndex);
-            scores.push(e.cs);
-            lineIndex++;
-            lines.push(e.content);
-        }
-    }
 
     new Chart(chartCtx2d, {
         type: "line",
         data: {
-            labels: lineIndices,
+            labels: series.x,
             datasets: [
-                {data: scores, label: "Sentiment score (compound)", fill: false}, 
-                {data: smoothMovingWindow(scores), label: "Sentiment score (compound), smoothed", fill: false, borderColor: "rgb(60,140,180)"}
+                {data: series.raw, label: "Sentiment score (compound)", fill: false}, 
+                {data: series.smoothed, label: "Sentiment score (compound), smoothed", fill: false, borderColor: "rgb(60,140,180)"}
             ]
         },
         options: {
@@ -440,9 +414,100 @@ function createDirectionSentimentChart(movie, container) {
             tooltips: {
                 callbacks: {
                     title: (tooltipItem, data) => formatLabelTitle(tooltipItem),
-                    label: (tooltipItem, data) => formatLabel(lines[tooltipItem.index])
+                    label: (tooltipItem, data) => formatLabel(series.content[tooltipItem.index])
                 },
             }
         }
     });
-}
\ No newline at end of file
+}
+
+/**
+ * Get the sentiment series of the DIRECTION entries or of the lines of a character, to plot: from the query server,
+ * from the precomputed timelines of the movie, or from its entries for analyzed scripts without timelines.
+ * @param {Object} movie - A movie object
+ * @param {String} kind - "direction" or "speech"
+ * @param {String} [name] - The name of a character, for "speech"
+ * @return {Promise} a promise resolving to the x coordinates, raw scores, smoothed scores and contents of the points.
+ */
+async function getSentimentSeries(movie, kind, name) {
+    if(movie.server !== undefined) {
+        let params = {series: kind, max_points: MAX_TIMELINE_POINTS, window: TIMELINE_WINDOW};
+        if(name !== undefined)
+            params.character = name;
+        return fetchJSON(movie.server + "/timeline", params);
+    }
+
+    if(movie.timelines !== undefined) {
+        // Precomputed timeline, which does not get longer with the script
+        let timeline = name === undefined ? movie.timelines.direction : movie.timelines.characters[name].speech;
+        let series = getTimelineSeries(timeline, MAX_TIMELINE_POINTS, TIMELINE_WINDOW);
+        series.content = series.entry.map((i) => movie.entries[i].content);
+        return series;
+    }
+
+    let series = {x: [], raw: [], content: []};
+    let lineIndex = 0;
+    for(let i = 0; i < movie.entries.length; i++) {
+        let e = movie.entries[i];
+        if(kind == "direction" && e.type == TYPE_DIRECTION) {
+            series.x.push(lineIndex++);
+            series.raw.push(e.cs);
+            series.content.push(e.content);
+        }
+        else if(kind == "speech" && i > 0 && e.type == TYPE_SPEECH && movie.entries[i-1].type == TYPE_CHARACTER) {
+            if(movie.entries[i-1].content == name) {
+                series.x.push(lineIndex);
+                series.raw.push(e.cs);
+                series.content.push(e.content);
+            }
+            lineIndex++;
+        }
+    }
+    series.smoothed = smoothMovingWindow(series.raw);
+    return series;
+}
+
+/**
+ * Get all exchanges between two characters: the lines of each character when the other one speaks right before or
+ * after them in the same scene, in order. They are fetched from the query server, looked up in the interaction index
+ * of the movie, or found by scanning its entries for analyzed scripts without a turn table.
+ * @param {Object} movie - A movie object
+ * @param {String} nameA - The name of a character
+ * @param {String} nameB - The name of another character
+ * @return {Promise} a promise resolving to the exchanges (turn index, speaker, content and score of the line).
+ */
+async function getInteractions(movie, nameA, nameB) {
+    if(movie.server !== undefined)
+        return (await fetchJSON(movie.server + "/interactions", {a: nameA, b: nameB})).exchanges;
+
+    let exchanges = [];
+    let addExchange = (turn, i) => {
+        let speech = movie.entries[i+1];
+        exchanges.push({turn: turn, speaker: movie.entries[i].content, content: speech.content, cs: speech.cs});
+    };
+
+    if(movie.turns !== undefined) {
+        // Only visit the turns where A and B speak next to each other, from the precomputed interaction index
+        let turnsAB = (movie.interactions[nameA] || {})[nameB] || [];
+        let turnsBA = (movie.interactions[nameB] || {})[nameA] || [];
+        let turns = Array.from(new Set(turnsAB.concat(turnsBA))).sort((a, b) => a - b);
+        for(let t of turns)
+            addExchange(t, movie.turns.entry[t]);
+    }
+    else {
+        // Analyzed scripts without a turn table: scan all entries
+        let lineIndex = 0;
+        for(let i = 2; i < movie.entries.length - 2; i++) {
+            let e = movie.entries[i];
+            if(e.type == TYPE_CHARACTER) {
+                let previousCharacter = getPreviousCharacter(movie, i), nextCharacter = getNextCharacter(movie, i);
+                let aToB = e.content == nameA && (previousCharacter == nameB || nextCharacter == nameB);
+                let bToA = e.content == nameB && (previousCharacter == nameA || nextCharacter == nameA);
+                if(aToB || bToA)
+                    addExchange(lineIndex, i);
+                lineIndex++;
+            }
+        }
+    }
+    return exchanges;
+}
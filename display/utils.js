@@ -32,6 +32,7 @@ function interpolateColor(c1, c2, f) {
 
 /**
  * Smooths the given data array using an averaging moving window strategy.
+ * Window sums are computed from prefix sums, in linear time.
  * @param {Array} data - An array of numeric data 
  * @param {int} [windowSize=data.length / 5] - The size of the moving window (number of sample before current sample).
  * @return {Array} the smoothed data, always the same length as the given array
@@ -42,27 +43,49 @@ function smoothMovingWindow(data, windowSize) {
     if(windowSize <= 1)
         return data 
 
-    out = []
+    // Prefix sums and counts of the values that are not NaN
+    let sums = new Float64Array(data.length + 1), counts = new Uint32Array(data.length + 1);
+    for(let i = 0; i < data.length; i++) {
+        let isNumber = !Number.isNaN(data[i]);
+        sums[i+1] = sums[i] + (isNumber ? data[i] : 0);
+        counts[i+1] = counts[i] + (isNumber ? 1 : 0);
+    }
+
+    let out = [];
     for(let i = 0; i < data.length; i++) {
-        let praticalWindowSize = 0;
-        let sum = 0;
         if(Number.isNaN(data[i]))
             out.push(NaN);
         else {
-            // Calculate the average in the moving window
-            for(let j = i - windowSize; j <= i; j++) {
-                idx = Math.abs(j);
-                if(!Number.isNaN(data[idx])) {
-                    praticalWindowSize++;
-                    sum += data[idx];
-                }
-            }
-            out.push(sum / praticalWindowSize);
+            // Calculate the average in the moving window, where samples before the start are mirrored (-j for j < 0)
+            let start = Math.max(i - windowSize, 0);
+            let mirrored = Math.min(Math.max(windowSize - i, 0), data.length - 1);
+            let sum = sums[i+1] - sums[start] + (mirrored > 0 ? sums[mirrored+1] - sums[1] : 0);
+            let count = counts[i+1] - counts[start] + (mirrored > 0 ? counts[mirrored+1] - counts[1] : 0);
+            out.push(sum / count);
         }
     }
     return out;
 }
 
+/**
+ * Get the series to plot from a precomputed sentiment timeline (see make_timeline in script_analyzer.py):
+ * the level with the most points, up to a maximum number of points.
+ * @param {Object} timeline - A timeline of the analyzed movie 
+ * @param {int} maxPoints - The maximum number of points to plot
+ * @param {String} window - The smoothing window, as a fraction of the length of the timeline
+ * @return {Object} the x coordinates, entry indices, raw scores and smoothed scores of the points.
+ */
+function getTimelineSeries(timeline, maxPoints, window) {
+    let level = null;
+    for(let l of timeline.levels) {
+        if(level == null || l.x.length <= maxPoints)
+            level = l;
+    }
+    if(level == null)
+        return {x: [], entry: [], raw: [], smoothed: []};
+    return {x: level.x, entry: level.entry, raw: level.raw, smoothed: level.smoothed[window]};
+}
+
 /**
  * Get the name of the character who speaks after the one at a given index, within a scene.
  * @param {Object} movie - A movie object 
@@ -112,4 +135,187 @@ function formatLabel(text) {
  */
 function formatLabelTitle(tooltipItem) {
     return Math.round(parseFloat(tooltipItem[0].value)*1000)/1000;
-}
\ No newline at end of file
+}
+
+/**
+ * Decode a base64 string into a typed array.
+ * @param {String} data - The base64 encoding of little-endian binary data
+ * @param {Function} ArrayType - The typed array constructor (e.g. Float32Array)
+ * @return {TypedArray} the decoded array.
+ */
+function decodeBase64Array(data, ArrayType) {
+    let binary = atob(data);
+    let bytes = new Uint8Array(binary.length);
+    for(let i = 0; i < binary.length; i++)
+        bytes[i] = binary.charCodeAt(i);
+    return new ArrayType(bytes.buffer);
+}
+
+/**
+ * Decode integers stored as their differences (see encode_deltas in columnar_format.py).
+ * @param {String} data - The base64 data of the differences, as int32
+ * @return {Array} the integers.
+ */
+function decodeBase64Deltas(data) {
+    let deltas = decodeBase64Array(data, Int32Array);
+    let values = new Array(deltas.length);
+    for(let i = 0, sum = 0; i < deltas.length; i++)
+        values[i] = sum += deltas[i];
+    return values;
+}
+
+/**
+ * Decode timeline scores stored as int16 multiples of 10^-4 (see encode_scores in columnar_format.py).
+ * @param {String} data - The base64 data of the scores
+ * @return {Array} the scores.
+ */
+function decodeBase64Scores(data) {
+    let codes = decodeBase64Array(data, Int16Array);
+    let values = new Array(codes.length);
+    for(let i = 0; i < codes.length; i++)
+        values[i] = codes[i] == -32768 ? NaN : codes[i] == -32767 ? -0 : codes[i] / 10000;
+    return values;
+}
+
+/**
+ * Decode a table of a movie in the columnar format (see decode_table in columnar_format.py).
+ * @param {String} key - The name of the table
+ * @param {Object} table - The encoded table
+ * @param {Array} strings - The string table of the movie
+ * @return {Object} the table.
+ */
+function decodeColumnarTable(key, table, strings) {
+    let speakerNames = data => Array.from(decodeBase64Array(data, Int32Array), i => i == -1 ? null : strings[i]);
+    if(key == "scenes")
+        return {start: decodeBase64Deltas(table.start), end: decodeBase64Deltas(table.end)};
+    if(key == "turns") {
+        return {entry: decodeBase64Deltas(table.entry), speaker: speakerNames(table.speaker),
+            previous: speakerNames(table.previous), next: speakerNames(table.next), scene: decodeBase64Deltas(table.scene)};
+    }
+    if(key == "interactions") {
+        let speakers = decodeBase64Array(table.speaker, Uint32Array), others = decodeBase64Array(table.other, Uint32Array);
+        let offsets = decodeBase64Deltas(table.offsets), turns = decodeBase64Deltas(table.turns);
+        let interactions = {};
+        for(let k = 0; k < speakers.length; k++) {
+            let row = interactions[strings[speakers[k]]] = interactions[strings[speakers[k]]] || {};
+            row[strings[others[k]]] = turns.slice(offsets[k], offsets[k+1]);
+        }
+        return interactions;
+    }
+    if(key == "timelines") {
+        let x = decodeBase64Deltas(table.x), entry = decodeBase64Deltas(table.entry), raw = decodeBase64Scores(table.raw);
+        let smoothed = {};
+        for(let w in table.smoothed)
+            smoothed[w] = decodeBase64Scores(table.smoothed[w]);
+        let levelCounts = decodeBase64Array(table.levels, Uint32Array), pointCounts = decodeBase64Array(table.points, Uint32Array);
+
+        let timelines = {}, level = 0, start = 0;
+        for(let t = 0; t < table.path.length; t++) {
+            let levels = [];
+            for(let l = 0; l < levelCounts[t]; l++) {
+                let end = start + pointCounts[level++];
+                let levelSmoothed = {};
+                for(let w in smoothed)
+                    levelSmoothed[w] = smoothed[w].slice(start, end);
+                levels.push({x: x.slice(start, end), entry: entry.slice(start, end), raw: raw.slice(start, end), smoothed: levelSmoothed});
+                start = end;
+            }
+            let path = table.path[t], parent = timelines;
+            for(let k = 0; k < path.length - 1; k++)
+                parent = parent[path[k]] = parent[path[k]] || {};
+            parent[path[path.length - 1]] = {length: table.length[t], levels: levels};
+        }
+        return timelines;
+    }
+    throw new Error("Unknown table: " + key);
+}
+
+/**
+ * Convert a movie in the columnar format (see columnar_format.py) to a movie object.
+ * Co-occurrences only contain the pairs of characters that share at least one scene.
+ * @param {Object} columnar - A movie in the columnar format
+ * @return {Object} the movie object.
+ */
+function decodeColumnarMovie(columnar) {
+    let strings = columnar.strings;
+    let typeNames = columnar.entries.type_names;
+    let types = decodeBase64Array(columnar.entries.type, Uint8Array);
+    let contents = decodeBase64Array(columnar.entries.content, Uint32Array);
+    let scores = decodeBase64Array(columnar.entries.cs, Float32Array);
+
+    let entries = new Array(columnar.entries.length);
+    for(let i = 0; i < entries.length; i++) {
+        entries[i] = {type: typeNames[types[i]], content: strings[contents[i]]};
+        if(!Number.isNaN(scores[i]))
+            entries[i].cs = Math.round(scores[i] * 10000) / 10000;
+    }
+
+    let names = columnar.characters.name;
+    let characters = {}, cooccurrences = {};
+    for(let i = 0; i < names.length; i++) {
+        characters[names[i]] = {name: names[i], line_count: columnar.characters.line_count[i], avg_cs: columnar.characters.avg_cs[i]};
+        cooccurrences[names[i]] = {};
+    }
+
+    let co = columnar.cooccurrences;
+    let rows = decodeBase64Array(co.row, Uint32Array), columns = decodeBase64Array(co.column, Uint32Array);
+    let counts = decodeBase64Array(co.count, Uint32Array), averages = decodeBase64Array(co.avg_cs, Float64Array);
+    for(let k = 0; k < rows.length; k++)
+        cooccurrences[names[rows[k]]][names[columns[k]]] = {count: counts[k], avg_cs: averages[k]};
+
+    let movie = {info: columnar.info, entries: entries, characters: characters, cooccurrences: cooccurrences};
+
+    // Tables are stored column-wise (as-is before version 3), other analysis results are stored as-is
+    for(let key in columnar.tables)
+        movie[key] = decodeColumnarTable(key, columnar.tables[key], strings);
+    for(let key in columnar.extra)
+        movie[key] = columnar.extra[key];
+    return movie;
+}
+
+/**
+ * Read an analyzed movie file: plain JSON or columnar format, optionally gzip-compressed.
+ * @param {File} file - The file selected by the user
+ * @return {Promise} a promise resolving to the movie object.
+ */
+async function readMovieFile(file) {
+    let buffer = await file.arrayBuffer();
+    let bytes = new Uint8Array(buffer);
+
+    // Detect gzip compression from its magic number
+    if(bytes[0] == 0x1f && bytes[1] == 0x8b) {
+        let stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream("gzip"));
+        buffer = await new Response(stream).arrayBuffer();
+    }
+
+    let obj = JSON.parse(new TextDecoder().decode(buffer));
+    return obj.format == "columnar" ? decodeColumnarMovie(obj) : obj;
+}
+
+/**
+ * Fetch JSON data from the query server (see query_server.py).
+ * @param {String} url - The URL of an API request, relative to the page
+ * @param {Object} [params] - The parameters of the request
+ * @return {Promise} a promise resolving to the response data.
+ */
+async function fetchJSON(url, params) {
+    if(params !== undefined)
+        url += "?" + new URLSearchParams(params);
+    let response = await fetch(url);
+    let data = await response.json();
+    if(!response.ok)
+        throw new Error(data.error);
+    return data;
+}
+
+/**
+ * Load a movie from the query server, with only the data needed to show it: characters and co-occurrences.
+ * Sentiment timelines and interactions are fetched by the panels that show them.
+ * @param {String} name - The name of the movie on the server
+ * @return {Promise} a promise resolving to the movie object.
+ */
+async function fetchMovie(name) {
+    let url = "api/movies/" + encodeURIComponent(name);
+    let [summary, cooccurrences] = await Promise.all([fetchJSON(url), fetchJSON(url + "/cooccurrences")]);
+    return {info: summary.info, characters: summary.characters, cooccurrences: cooccurrences, server: url};
+}
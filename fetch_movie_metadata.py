@@ -1,13 +1,24 @@
-import requests
-from bs4 import BeautifulSoup
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import csv
+import json
+import os
 
 import config
 import utils
+import http_client
+
+# Number of fetched movie pages between two saves of the crawl state
+CRAWL_STATE_SAVE_INTERVAL = 25
 
 """ Get data from the movie page for the given movie. """
-def add_specific_movie_data(movie):
-    movie_page = requests.get(config.URL_IMSDB + movie["page"])
+def add_specific_movie_data(movie, session=None, rate_limiter=None, base_url=None):
+    base_url = config.URL_IMSDB if base_url == None else base_url
+    if session == None:
+        session = http_client.create_session(1)
+    movie_page = http_client.get(session, base_url + movie["page"], rate_limiter)
+    movie_page.raise_for_status()
+    from bs4 import BeautifulSoup
     movie_soup = BeautifulSoup(movie_page.content, "html.parser")
     
     # Get the <a href="...">Read "Star Wars: A New Hope" Script</a>
@@ -18,9 +29,54 @@ def add_specific_movie_data(movie):
 
     movie["script_page"] = script_href
 
-""" Output data to file for all given movies. """
-def output_movies_data(movies):
-    with open(config.MOVIES_METADATA_FILE, "w", newline="") as f:
+""" Get data from the movie pages of all given movies, using a pool of threads that share a keep-alive session.
+    The script page of every fetched movie is recorded in the crawl state, if given, which is saved regularly so that
+    an interrupted crawl can resume. Returns the movies whose page could not be fetched. """
+def add_all_movies_data(movies, workers=None, rate_limit=None, base_url=None, state=None):
+    workers = config.FETCH_WORKERS if workers == None else workers
+    rate_limit = config.FETCH_RATE_LIMIT if rate_limit == None else rate_limit
+    base_url = config.URL_IMSDB if base_url == None else base_url
+    session = http_client.create_session(workers)
+    rate_limiter = http_client.RateLimiter(rate_limit)
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(add_specific_movie_data, m, session, rate_limiter, base_url): m for m in movies}
+        try:
+            for i, future in enumerate(as_completed(futures)):
+                if i % 50 == 0:
+                    print(i, "/", len(movies), sep="")
+                movie = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    # The movie will be ignored when writing to file
+                    movie["script_page"] = None
+                    failed.append(movie)
+                    print("Could not fetch page for '" + movie["title"] + "':", e)
+                    continue
+                if state != None:
+                    state.set_script_page(movie["page"], movie["script_page"])
+                    if (i + 1) % CRAWL_STATE_SAVE_INTERVAL == 0:
+                        state.save()
+        except KeyboardInterrupt:
+            # Do not wait for the pages that were not requested yet
+            executor.shutdown(cancel_futures=True)
+            raise
+        finally:
+            if state != None:
+                state.save()
+    print(len(movies), "/", len(movies), sep="")
+
+    if len(failed) > 0:
+        print("Failed to fetch", len(failed), "movie pages.")
+    return failed
+
+""" Output data to file for all given movies, in UTF-8 (which also migrates metadata files in the legacy encoding).
+    The file is replaced atomically, so that it is never left half-written. """
+def output_movies_data(movies, path=None):
+    path = config.MOVIES_METADATA_FILE if path == None else path
+    with utils.write_atomic(path, "w", newline="", encoding=config.MOVIES_METADATA_ENCODING) as f:
         writer = csv.writer(f, delimiter=";", quotechar="|", quoting=csv.QUOTE_MINIMAL)
         writer.writerow(["Title", "Authors", "IMSDb Page", "IMSDb Script Page"])
 
@@ -41,55 +97,180 @@ def output_movies_data(movies):
         print("Non-HTML script page for", non_html_script_page, "movies.")
 
 """ Get an array of movies that are listed on the IMSDB all-scripts page """
-def get_imsdb_movies():
+def get_imsdb_movies(session=None, base_url=None):
+    base_url = config.URL_IMSDB if base_url == None else base_url
+    if session == None:
+        session = http_client.create_session(1)
+
     # Access page that lists all movie entries on IMSDB
     print("Accessing scripts list page...")
-    page = requests.get(config.URL_IMSDB + "/all scripts")
+    page = http_client.get(session, base_url + "/all scripts")
 
     if page.status_code != 200:
         print("Error while accessing the page.")
         return []
     else:
-        # Use BeautifulSoup to parse raw HTML
-        print("Parsing HTML...")
-        soup = BeautifulSoup(page.content, "html.parser")
-        
-        # Find elements that contain information about a movie
-        paragraphs = [i.find_parent("p") for i in soup.select("i")]
+        return parse_imsdb_movies(page.content)
 
-        # Extract basic data for each movie
-        movies = []
-        for p in paragraphs:
-            movie = dict()
-            a = p.find("a")
-            movie["title"] = a.text  
-            movie["page"] = a["href"]
-            movie["authors"] = p.find("i").text.replace("Written by ", "").split(",")
+""" Get an array of the movies listed in the HTML of the IMSDB all-scripts page """
+def parse_imsdb_movies(html):
+    # Use BeautifulSoup to parse raw HTML
+    print("Parsing HTML...")
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "html.parser")
+    
+    # Find elements that contain information about a movie
+    paragraphs = [i.find_parent("p") for i in soup.select("i")]
 
-            # Fix title
-            if movie["title"][-5:].lower() == ", the":
-                movie["title"] = movie["title"][:-5]
+    # Extract basic data for each movie
+    movies = []
+    for p in paragraphs:
+        movie = dict()
+        a = p.find("a")
+        movie["title"] = a.text  
+        movie["page"] = a["href"]
+        movie["authors"] = p.find("i").text.replace("Written by ", "").split(",")
 
-            movies.append(movie)
+        # Fix title
+        if movie["title"][-5:].lower() == ", the":
+            movie["title"] = movie["title"][:-5]
 
-        return movies
-    
+        movies.append(movie)
 
-if __name__ == "__main__":
-    # Get all movie entries
-    movies = get_imsdb_movies()
+    return movies
+
+
+""" State of the metadata crawls, kept across runs: the validators of the last list of scripts (ETag and
+    Last-Modified) and whether the metadata file was written from it, and the script page found on every movie page
+    fetched so far (None when the movie has no script page). """
+class CrawlState:
+    def __init__(self, path=None):
+        path = config.CRAWL_STATE_FILE if path == None else path
+        self.path = path
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = dict()
+        self.listing = state.get("listing")
+        self.script_pages = state.get("script_pages", dict())
+
+
+    def has_page(self, page):
+        return page in self.script_pages
+
+
+    def get_script_page(self, page):
+        return self.script_pages[page]
+
+
+    def set_script_page(self, page, script_page):
+        self.script_pages[page] = script_page
+
+
+    """ Write the state to file, atomically. """
+    def save(self):
+        with utils.write_atomic(self.path) as f:
+            json.dump({"listing": self.listing, "script_pages": self.script_pages}, f)
+
+
+""" Compare the listed movies with the metadata file. Listed movies whose title is in the file with the same movie
+    page are reused from the file, as well as movies whose page was already fetched by a previous crawl (which may
+    have been interrupted, or found no HTML script page). Returns the movies to fetch and the changes, as lists of
+    titles: new movies, movies whose page changed and movies no longer listed. """
+def diff_movies(movies, known_movies, state):
+    known = {m["title"]: m for m in known_movies}
+    listed = {m["title"] for m in movies}
+    to_fetch, changes = [], {"new": [], "changed": [], "removed": [t for t in known if t not in listed]}
+    for m in movies:
+        previous = known.get(m["title"])
+        if previous != None and previous["page"] == m["page"]:
+            m["script_page"] = previous["script_page"]
+            continue
+        if previous != None:
+            changes["changed"].append(m["title"])
+        elif not state.has_page(m["page"]):
+            changes["new"].append(m["title"])
+
+        if state.has_page(m["page"]):
+            m["script_page"] = state.get_script_page(m["page"])
+        else:
+            to_fetch.append(m)
+    return to_fetch, changes
+
+
+""" Update the metadata file from the list of scripts, only fetching the pages of movies that are new or whose page
+    changed (see diff_movies); or every page, if not incremental. The list of scripts is requested conditionally, and
+    nothing else is fetched when it did not change since the last complete crawl. """
+def crawl(workers=None, rate_limit=None, base_url=None, incremental=True, state_path=None):
+    workers = config.FETCH_WORKERS if workers == None else workers
+    rate_limit = config.FETCH_RATE_LIMIT if rate_limit == None else rate_limit
+    base_url = config.URL_IMSDB if base_url == None else base_url
+    state_path = config.CRAWL_STATE_FILE if state_path == None else state_path
+    state = CrawlState(state_path)
+    known_movies = utils.get_all_movies_metadata() if incremental and os.path.exists(config.MOVIES_METADATA_FILE) else []
+
+    session = http_client.create_session(1)
+    headers = dict()
+    if incremental and len(known_movies) > 0 and state.listing != None and state.listing["complete"]:
+        if state.listing["etag"] != None:
+            headers["If-None-Match"] = state.listing["etag"]
+        if state.listing["last_modified"] != None:
+            headers["If-Modified-Since"] = state.listing["last_modified"]
+
+    print("Accessing scripts list page...")
+    page = http_client.get(session, base_url + "/all scripts", headers=headers)
+    if page.status_code == 304:
+        print("The list of scripts did not change since the last crawl.")
+        return
+    if page.status_code != 200:
+        print("Error while accessing the page.")
+        return
+    movies = parse_imsdb_movies(page.content)
+    if len(movies) == 0:
+        print("No movies found, the metadata file is left unchanged.")
+        return
     print("Found", len(movies), "movies.")
+    state.listing = {"etag": page.headers.get("ETag"), "last_modified": page.headers.get("Last-Modified"), "complete": False}
+    state.save()
+
+    if incremental:
+        to_fetch, changes = diff_movies(movies, known_movies, state)
+        print(len(changes["new"]), "new movies,", len(changes["changed"]), "movies whose page changed,", len(changes["removed"]), "movies no longer listed.")
+    else:
+        to_fetch = movies
 
     # Get data from the individual movie pages
-    print("Fetching specific data for each movie...")        
-    for i in range(len(movies)):
-        if i % 50 == 0:
-            print(i, "/", len(movies), sep="")
-        add_specific_movie_data(movies[i])
-    print(len(movies), "/", len(movies), sep="")
+    print("Fetching specific data for", len(to_fetch), "movies...")
+    failed = add_all_movies_data(to_fetch, workers, rate_limit, base_url, state)
+
+    # Movies whose page could not be fetched keep their previous data, and are fetched again by the next crawl
+    known = {m["title"]: m for m in known_movies}
+    for m in failed:
+        if m["title"] in known:
+            m["script_page"] = known[m["title"]]["script_page"]
 
     # Output data to file
     print("Writing movie data to file...")
-    output_movies_data(movies)
+    output_movies_data(movies, config.MOVIES_METADATA_FILE)
+    state.listing["complete"] = len(failed) == 0
+    state.save()
+    
 
-    print("Finished!")
\ No newline at end of file
+""" Add the command-line arguments of metadata fetching to a parser. """
+def add_arguments(parser):
+    parser.add_argument("--workers", type=int, default=config.FETCH_WORKERS, help="number of concurrent requests")
+    parser.add_argument("--rate-limit", type=float, default=config.FETCH_RATE_LIMIT, help="max requests per second to the host (0 for no limit)")
+    parser.add_argument("--base-url", default=config.URL_IMSDB, help="base URL of the IMSDb website (e.g. a local mirror)")
+    parser.add_argument("--incremental", action="store_true", help="only fetch the pages of movies that are new or whose page changed since the metadata file was written")
+
+
+def main(args):
+    crawl(args.workers, args.rate_limit, args.base_url, args.incremental)
+    print("Finished!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch metadata for all movies listed on IMSDb.")
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,61 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import config
+
+# Status codes for which a request is retried
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+""" Limits the number of requests sent to each host per second. Thread-safe. """
+class RateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self.next_slot = dict()
+        self.lock = threading.Lock()
+
+
+    def wait(self, url):
+        if self.interval == 0:
+            return
+        host = urlsplit(url).netloc
+
+        # Reserve the next free slot for this host, then sleep outside of the lock until it comes
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+""" Create a session whose keep-alive connection pool can be shared by the given number of threads. """
+def create_session(pool_size=None):
+    pool_size = config.FETCH_WORKERS if pool_size == None else pool_size
+    # requests is only imported by commands that access the network
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+""" GET a URL, retrying with exponential backoff on connection errors and transient HTTP errors. """
+def get(session, url, rate_limiter=None, retries=None, backoff=None, **kwargs):
+    retries = config.FETCH_RETRIES if retries == None else retries
+    backoff = config.FETCH_BACKOFF if backoff == None else backoff
+    import requests
+    kwargs.setdefault("timeout", config.FETCH_TIMEOUT)
+    for attempt in range(retries + 1):
+        if rate_limiter != None:
+            rate_limiter.wait(url)
+        try:
+            response = session.get(url, **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                return response
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2**attempt)
@@ -0,0 +1,144 @@
+import argparse
+import hashlib
+import html
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+# Canned movies: title as listed on IMSDb, authors, script page (None when the movie page has no script link)
+MOVIES = [
+    ("10 Things I Hate About You", ["Karen McCullah Lutz", "Kirsten Smith", "William Shakespeare"], "/scripts/10-Things-I-Hate-About-You.html"),
+    ("Alien", ["Dan O'Bannon"], "/scripts/Alien.html"),
+    ("Apocalypse Now", ["John Milius", "Francis Ford Coppola"], "/scripts/Apocalypse-Now.html"),
+    ("Back to the Future", ["Robert Zemeckis", "Bob Gale"], "/scripts/Back-to-the-Future.html"),
+    ("Big Lebowski, The", ["Ethan Coen", "Joel Coen"], "/scripts/Big-Lebowski,-The.html"),
+    ("Casablanca", ["Julius J. Epstein", "Philip G. Epstein", "Howard Koch"], "/scripts/Casablanca.html"),
+    ("Chinatown", ["Robert Towne"], "/scripts/Chinatown.html"),
+    ("Fight Club", ["Jim Uhls"], "/scripts/Fight-Club.html"),
+    ("Godfather, The", ["Mario Puzo", "Francis Ford Coppola"], "/scripts/Godfather.html"),
+    ("Jaws", ["Peter Benchley", "Carl Gottlieb"], "/scripts/Jaws.html"),
+    ("Memento", ["Christopher Nolan"], "/scripts/Memento.pdf"),
+    ("Ponyo (崖の上のポニョ)", ["Hayao Miyazaki"], "/scripts/Ponyo.html"),
+    ("Pulp Fiction", ["Quentin Tarantino", "Roger Avary"], "/scripts/Pulp-Fiction.html"),
+    ("Shrek", ["William Steig", "Ted Elliott"], "/scripts/Shrek.html"),
+    ("Star Wars: A New Hope", ["George Lucas"], "/scripts/Star-Wars-A-New-Hope.html"),
+    ("Titanic", ["James Cameron"], "/scripts/Titanic.html"),
+    ("Untitled Project", ["Unknown"], None),
+]
+
+""" Get the page of a listed movie. """
+def get_movie_page(title):
+    return "/Movie Scripts/" + title + " Script.html"
+
+""" Build the canned pages of the given movies: the list of all scripts, the movie pages and the script pages,
+    by path. """
+def build_pages(movies):
+    paragraphs = []
+    pages = dict()
+    for title, authors, script_page in movies:
+        page = get_movie_page(title)
+        paragraphs.append("<p><a href=\"" + html.escape(page) + "\" title=\"" + html.escape(title) + " Script\">" + html.escape(title) + "</a> (2000-01-01)<br><i>Written by " + html.escape(",".join(authors)) + "</i><br></p>")
+        links = ""
+        if script_page != None:
+            links = "<a href=\"" + html.escape(script_page) + "\">Read \"" + html.escape(title) + "\" Script</a>"
+            pages[script_page] = ("<html><body><table><tr><td class=\"scrtext\"><pre><b>INT. STUB - DAY</b>\n"
+                + html.escape(title) + " script.</pre></td></tr></table></body></html>")
+        pages[page] = ("<html><body><h1>" + html.escape(title) + " Script</h1><table class=\"script-details\"><tr><td>"
+            + links + "</td></tr></table></body></html>")
+    pages["/all scripts"] = "<html><body><h1>All Movie Scripts on IMSDb (A-Z)</h1>" + "\n".join(paragraphs) + "</body></html>"
+    return {path: content.encode("utf-8") for path, content in pages.items()}
+
+
+""" Local stand-in for the IMSDb website, serving canned pages so that crawls can be checked offline.
+    Pages answer conditional requests with their ETag, every request is recorded, and pages can be made missing. """
+class StubServer(ThreadingHTTPServer):
+    def __init__(self, address=("127.0.0.1", 0), movies=MOVIES):
+        super().__init__(address, StubRequestHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.missing = set()
+        self.set_movies(movies)
+
+
+    @property
+    def url(self):
+        return "http://" + self.server_address[0] + ":" + str(self.server_address[1])
+
+
+    def set_movies(self, movies):
+        with self.lock:
+            self.movies = list(movies)
+            self.pages = build_pages(self.movies)
+
+
+    """ Get and clear the paths requested so far. """
+    def pop_requests(self):
+        with self.lock:
+            requests, self.requests = self.requests, []
+        return requests
+
+
+    """ Serve in a background thread. """
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = unquote(urlsplit(self.path).path)
+        with self.server.lock:
+            self.server.requests.append(path)
+            content = self.server.pages.get(path) if path not in self.server.missing else None
+        if content == None:
+            self.send_content(404, b"<html><body>Not found</body></html>")
+            return
+        etag = "\"" + hashlib.sha1(content).hexdigest()[:16] + "\""
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_content(200, content, etag)
+
+
+    def send_content(self, status, content, etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        if etag != None:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+""" Add the command-line arguments of the stub server to a parser. """
+def add_arguments(parser):
+    parser.add_argument("--port", type=int, default=8001, help="port to listen on (default: 8001)")
+
+
+def main(args):
+    server = StubServer(("127.0.0.1", args.port))
+    print("Serving", len(server.movies), "canned movies on", server.url, "(e.g. python fetch_movie_metadata.py --base-url " + server.url + ")")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the IMSDb website, serving canned pages.")
+    add_arguments(parser)
+    main(parser.parse_args())
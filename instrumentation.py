@@ -0,0 +1,141 @@
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+import utils
+
+# Number of functions kept in the profile of a report, by cumulative time
+PROFILE_TOP = 30
+
+""" Timings and counters recorded while processing a movie (or anything else), with an optional profile
+    (most expensive functions) and memory peak. """
+class Report:
+    def __init__(self):
+        self.timers = dict()
+        self.counters = dict()
+        self.memory_peak = None
+        self.profile = None
+
+
+    def add_time(self, name, elapsed):
+        timer = self.timers.get(name)
+        if timer == None:
+            timer = self.timers[name] = {"calls": 0, "time": 0}
+        timer["calls"] += 1
+        timer["time"] += elapsed
+
+
+    def to_dict(self):
+        obj = {"timers": self.timers, "counters": self.counters}
+        if self.memory_peak != None:
+            obj["memory_peak"] = self.memory_peak
+        if self.profile != None:
+            obj["profile"] = self.profile
+        return obj
+
+
+# Report being recorded, if any
+current = None
+
+""" Time a block of code, when a report is being recorded. Timers with the same name are summed up. """
+@contextlib.contextmanager
+def timer(name):
+    if current == None:
+        yield
+        return
+    report = current
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report.add_time(name, time.perf_counter() - start)
+
+
+""" Decorator timing every call of a function, when a report is being recorded. """
+def timed(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if current == None:
+                return fn(*args, **kwargs)
+            with timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+""" Increment a counter, when a report is being recorded. """
+def count(name, n=1):
+    if current != None:
+        current.counters[name] = current.counters.get(name, 0) + n
+
+
+""" Get the most expensive functions of a profile, as dicts. """
+def get_profile_top(profiler, num_functions=PROFILE_TOP):
+    functions = []
+    for (filename, line, name), (_, num_calls, own_time, cumulative_time, _) in pstats.Stats(profiler).stats.items():
+        functions.append({"function": os.path.basename(filename) + ":" + str(line) + "(" + name + ")", "calls": num_calls, "tottime": own_time, "cumtime": cumulative_time})
+    functions.sort(key=lambda f: f["cumtime"], reverse=True)
+    return functions[:num_functions]
+
+
+""" Record a report of the timers and counters hit in a block of code, optionally with a cProfile profile and
+    the peak memory allocated (traced with tracemalloc, which slows the code down). Yields the report. """
+@contextlib.contextmanager
+def record(profile=False, memory=False):
+    global current
+    previous, current = current, Report()
+    report = current
+
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    elif memory:
+        tracemalloc.reset_peak()
+
+    try:
+        yield report
+    finally:
+        if memory:
+            report.memory_peak = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+        if profiler != None:
+            profiler.disable()
+            report.profile = get_profile_top(profiler)
+        current = previous
+
+
+""" Sum up the timers and counters of several reports (as dicts), keeping the largest memory peak. """
+def merge_reports(reports):
+    merged = {"timers": dict(), "counters": dict()}
+    for r in reports:
+        for name, t in r["timers"].items():
+            total = merged["timers"].setdefault(name, {"calls": 0, "time": 0})
+            total["calls"] += t["calls"]
+            total["time"] += t["time"]
+        for name, n in r["counters"].items():
+            merged["counters"][name] = merged["counters"].get(name, 0) + n
+        if "memory_peak" in r:
+            merged["memory_peak"] = max(merged.get("memory_peak", 0), r["memory_peak"])
+    return merged
+
+
+""" Format the timers of a report (as a dict) on one line, e.g. "fetch 0.12s, parse 0.40s". """
+def format_timers(report):
+    return ", ".join(name + " {:.2f}s".format(t["time"]) for name, t in report["timers"].items())
+
+
+""" Write a report to a JSON file, atomically. """
+def write_report(obj, path):
+    with utils.write_atomic(path) as f:
+        json.dump(obj, f, indent=1)
@@ -0,0 +1,361 @@
+import argparse
+import collections
+import gzip
+import json
+import os
+import sys
+import threading
+import traceback
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import config
+import build_manifest
+import columnar_format
+import corpus_db
+import corpus_runner
+import script_parser
+import script_analyzer
+
+# Directory of the viewer, served along with the API
+DIR_DISPLAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "display")
+
+# Responses smaller than this are not compressed
+GZIP_MIN_SIZE = 1024
+# Fastest gzip level: on a local server, higher levels cost more time than they save in transfer
+GZIP_LEVEL = 1
+# Maximum number of entries of a page
+MAX_PAGE_SIZE = 1000
+
+""" Error of a request, answered with the given HTTP status and a JSON message. """
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+""" Approximate size in memory of a JSON-like object (dicts, lists, strings and numbers), in bytes.
+    Strings and numbers shared by several containers (e.g. interned character names) are counted once. """
+def estimate_size(obj):
+    seen = set()
+    size = 0
+    stack = [obj]
+    while len(stack) > 0:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, list):
+            stack.extend(o)
+    return size
+
+
+""" An analyzed movie loaded in memory, with the scene, turn and interaction tables (computed again from the entries
+    and their scores for files analyzed before these tables existed), and its timelines at every level and smoothing
+    window, computed from the entries (files only store the timelines the viewer plots). """
+class LoadedMovie:
+    def __init__(self, path):
+        self.path = path
+        self.file = build_manifest.stat_file(path)
+        self.obj = columnar_format.read_analyzed(path, sparse=True)
+        if any(key not in self.obj for key in ["scenes", "turns", "interactions"]):
+            parsed_script = corpus_runner.restore_parsed_script(self.obj["info"], self.obj)
+            analyzed = script_analyzer.AnalyzedMovieScript(parsed_script, scores=corpus_runner.get_sentiment_scores(self.obj["entries"]))
+            self.obj.update(analyzed.get_tables())
+        self.timelines = script_analyzer.compute_timelines(script_parser.entries_from_dicts(self.obj["entries"]), list(self.obj["characters"]),
+            self.obj["scenes"]["start"], script_analyzer.TIMELINE_WINDOWS, script_analyzer.TIMELINE_RESOLUTIONS, all_series=True)
+        self.size = estimate_size(self.obj) + estimate_size(self.timelines)
+
+
+    """ Whether the file of the movie changed since it was loaded. """
+    def is_stale(self):
+        return build_manifest.stat_file(self.path) != self.file
+
+
+""" Cache of the most recently used analyzed movies, bounded by their approximate size in memory. Thread-safe. """
+class MovieCache:
+    def __init__(self, max_size=None):
+        max_size = config.SERVER_CACHE_MAX_SIZE if max_size == None else max_size
+        self.max_size = max_size
+        self.movies = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # Locks of the movies being loaded, so that concurrent requests for a movie only load it once
+        self.loading = dict()
+
+
+    """ Get a loaded movie, loading it if it is not cached or if its file changed. """
+    def get(self, path):
+        with self.lock:
+            movie = self.movies.get(path)
+            if movie != None and not movie.is_stale():
+                self.movies.move_to_end(path)
+                return movie
+            load_lock = self.loading.setdefault(path, threading.Lock())
+
+        with load_lock:
+            # Another request may have loaded the movie in the meantime
+            with self.lock:
+                movie = self.movies.get(path)
+                if movie != None and not movie.is_stale():
+                    self.movies.move_to_end(path)
+                    return movie
+            try:
+                movie = LoadedMovie(path)
+                with self.lock:
+                    self.put(movie)
+            finally:
+                with self.lock:
+                    self.loading.pop(path, None)
+        return movie
+
+
+    """ Add a movie, then evict the least recently used ones until the cache fits its maximum size. The last movie
+        added is always kept, even when it is larger than the cache. Must be called with the lock held. """
+    def put(self, movie):
+        previous = self.movies.pop(movie.path, None)
+        if previous != None:
+            self.size -= previous.size
+        self.movies[movie.path] = movie
+        self.size += movie.size
+        while self.size > self.max_size and len(self.movies) > 1:
+            _, evicted = self.movies.popitem(last=False)
+            self.size -= evicted.size
+
+
+    """ Remove a movie from the cache, e.g. when it could not be used to answer a request. """
+    def discard(self, path):
+        with self.lock:
+            movie = self.movies.pop(path, None)
+            if movie != None:
+                self.size -= movie.size
+
+
+    def get_stats(self):
+        with self.lock:
+            return {"movies": len(self.movies), "size": self.size, "max_size": self.max_size}
+
+
+""" Get the sparse co-occurrence row of a character: the characters they share at least one scene with. """
+def get_cooccurrence_row(obj, name):
+    return {other: cell for other, cell in obj["cooccurrences"][name].items() if cell["count"] > 0}
+
+
+""" Get the points of a precomputed timeline to plot, like getTimelineSeries in display/utils.js (the level with the
+    most points, up to max_points), with the content of the entry of each point for tooltips. """
+def get_timeline_series(obj, timeline, max_points, window):
+    level = None
+    for l in timeline["levels"]:
+        if level == None or len(l["x"]) <= max_points:
+            level = l
+    if level == None:
+        return {"length": 0, "x": [], "entry": [], "raw": [], "smoothed": [], "content": []}
+    if window not in level["smoothed"]:
+        raise RequestError(400, "Unknown smoothing window: " + window)
+    entries = obj["entries"]
+    return {"length": timeline["length"], "x": level["x"], "entry": level["entry"], "raw": level["raw"],
+        "smoothed": level["smoothed"][window], "content": [entries[i]["content"] for i in level["entry"]]}
+
+
+""" Get all exchanges between two characters, like AnalyzedMovieScript.get_interactions. """
+def get_interactions(obj, name_a, name_b):
+    interactions, turns = obj["interactions"], obj["turns"]
+    indices = set(interactions.get(name_a, dict()).get(name_b, [])) | set(interactions.get(name_b, dict()).get(name_a, []))
+    exchanges = []
+    for turn in sorted(indices):
+        speech = obj["entries"][turns["entry"][turn] + 1]
+        exchanges.append({"turn": turn, "speaker": turns["speaker"][turn], "content": speech["content"], "cs": speech.get("cs")})
+    return exchanges
+
+
+""" Local HTTP server of the analyzed movies, for the viewer. Movies are identified by the name of their file
+    (e.g. "pulp-fiction") and loaded on first use into a cache of recently used movies. """
+class QueryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, directory=None, cache_size=None, verbose=False):
+        directory = config.DIR_ANALYZED if directory == None else directory
+        cache_size = config.SERVER_CACHE_MAX_SIZE if cache_size == None else cache_size
+        super().__init__(address, QueryRequestHandler)
+        self.directory = directory
+        self.cache = MovieCache(cache_size)
+        self.verbose = verbose
+
+
+    """ Get the analyzed files, by movie name. """
+    def get_movie_files(self):
+        return {os.path.basename(corpus_db.exp_analyzed_file.sub("", path)): path for path in corpus_db.get_analyzed_files(self.directory)}
+
+
+    def get_movie_path(self, name):
+        path = self.get_movie_files().get(name)
+        if path == None:
+            raise RequestError(404, "Unknown movie: " + name)
+        return path
+
+
+""" Handler of the requests of the query server: /api/... requests are answered with JSON, other paths are files of
+    the viewer. API responses have an ETag derived from the file of the movie and the request, and are compressed with
+    gzip when the client accepts it.
+
+    API:
+        /api/movies                                     names of the analyzed movies
+        /api/movies/<name>                              info, number of entries and characters of a movie
+        /api/movies/<name>/entries?start=0&count=100    page of entries
+        /api/movies/<name>/characters                   characters (line count and average score)
+        /api/movies/<name>/cooccurrences[?name=X]       sparse co-occurrence rows, of all characters or of one
+        /api/movies/<name>/interactions?a=X&b=Y         exchanges between two characters
+        /api/movies/<name>/timeline?series=direction    timeline to plot ("direction", "speech" or "scenes"), of the
+            [&character=X][&max_points=1000][&window=0.2]   movie or of a character ("speech" or "scenes")
+        /api/cache                                      statistics of the movie cache
+"""
+class QueryRequestHandler(SimpleHTTPRequestHandler):
+    # Keep connections alive between the requests of the viewer, without delaying small responses
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=DIR_DISPLAY, **kwargs)
+
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if not url.path.startswith("/api/"):
+            return super().do_GET()
+
+        parts = [unquote(p) for p in url.path.split("/")[2:] if p != ""]
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = None
+        try:
+            if parts == ["movies"]:
+                files = self.server.get_movie_files()
+                self.send_json({"movies": [{"name": name} for name in sorted(files)]}, self.make_etag(files, [build_manifest.stat_file(p) for p in files.values()]))
+            elif parts == ["cache"]:
+                self.send_json(self.server.cache.get_stats())
+            elif len(parts) in [2, 3] and parts[0] == "movies":
+                path = self.server.get_movie_path(parts[1])
+                # The file is not read to answer a conditional request for an unchanged movie
+                etag = self.make_etag(build_manifest.stat_file(path), parts, sorted(query.items()))
+                if etag in [t.strip() for t in self.headers.get("If-None-Match", "").split(",")]:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                movie = self.server.cache.get(path)
+                self.send_json(self.get_movie_data(movie, parts[2] if len(parts) == 3 else None, query), etag)
+            else:
+                raise RequestError(404, "Unknown request: " + url.path)
+        except RequestError as e:
+            self.send_json({"error": str(e)}, status=e.status)
+        except ConnectionError:
+            # The client went away, there is no one to answer
+            self.close_connection = True
+        except Exception as e:
+            # e.g. a corrupt or half-written file, or a file written by an older version: the movie is loaded again
+            # by the next request, and the server keeps answering the other ones
+            if path != None:
+                self.server.cache.discard(path)
+            # Logged even when requests are not (see log_message)
+            super().log_message("Error while answering %s: %s", self.path, traceback.format_exc() if self.server.verbose else repr(e))
+            self.send_json({"error": "Internal error: " + type(e).__name__ + ": " + str(e)}, status=500)
+
+
+    """ Get the response to a request about a loaded movie. """
+    def get_movie_data(self, movie, resource, query):
+        obj = movie.obj
+        characters = obj["characters"]
+        def get_character(key):
+            name = query.get(key)
+            if name == None:
+                raise RequestError(400, "Missing parameter: " + key)
+            if name not in characters:
+                raise RequestError(404, "Unknown character: " + name)
+            return name
+        def get_int(key, default):
+            try:
+                return int(query.get(key, default))
+            except ValueError:
+                raise RequestError(400, "Invalid parameter: " + key)
+
+        if resource == None:
+            return {"info": obj["info"], "num_entries": len(obj["entries"]), "characters": characters}
+        elif resource == "entries":
+            start, count = max(get_int("start", 0), 0), min(max(get_int("count", 100), 0), MAX_PAGE_SIZE)
+            return {"start": start, "total": len(obj["entries"]), "entries": obj["entries"][start:start+count]}
+        elif resource == "characters":
+            return characters
+        elif resource == "cooccurrences":
+            if "name" in query:
+                name = get_character("name")
+                return {name: get_cooccurrence_row(obj, name)}
+            return {name: get_cooccurrence_row(obj, name) for name in characters}
+        elif resource == "interactions":
+            return {"exchanges": get_interactions(obj, get_character("a"), get_character("b"))}
+        elif resource == "timeline":
+            series = query.get("series", "direction")
+            timelines = movie.timelines if "character" not in query else movie.timelines["characters"].get(get_character("character"))
+            if timelines == None or series == "characters" or series not in timelines:
+                raise RequestError(404, "Unknown timeline: " + series)
+            return get_timeline_series(obj, timelines[series], get_int("max_points", MAX_PAGE_SIZE), query.get("window", "0.2"))
+        raise RequestError(404, "Unknown request: " + resource)
+
+
+    """ Make a strong ETag from the state of the file of a movie and the request. """
+    def make_etag(self, *data):
+        return "\"" + build_manifest.hash_data(*data)[:32] + "\""
+
+
+    """ Send a compact JSON response, compressed with gzip when the client accepts it and the response is large
+        enough to benefit from it. """
+    def send_json(self, obj, etag=None, status=200):
+        body = json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        accepted = [e.split(";")[0].strip() for e in self.headers.get("Accept-Encoding", "").split(",")]
+        compressed = "gzip" in accepted and len(body) >= GZIP_MIN_SIZE
+        if compressed:
+            body = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Cache-Control", "no-cache")
+        if compressed:
+            self.send_header("Content-Encoding", "gzip")
+        if etag != None:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+""" Add the command-line arguments of the query server to a parser. """
+def add_arguments(parser):
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=config.SERVER_PORT, help="port to listen on (default: " + str(config.SERVER_PORT) + ")")
+    parser.add_argument("--directory", default=config.DIR_ANALYZED, help="directory of the analyzed movies")
+    parser.add_argument("--cache-size", type=int, default=config.SERVER_CACHE_MAX_SIZE // 2**20, help="maximum size of the movies kept in memory, in MB")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+
+
+def main(args):
+    server = QueryServer((args.host, args.port), args.directory, args.cache_size * 2**20, args.verbose)
+    print("Serving the viewer on http://" + args.host + ":" + str(server.server_address[1]) + "/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the analyzed movies and the viewer on a local HTTP server.")
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -1,156 +1,420 @@
 import utils
 import script_parser
 import config
+import sentiment
+import columnar_format
+import streaming_format
+import instrumentation
 
-import matplotlib.pyplot as plt
-import numpy as np
-import json
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
+import os
 
-classifier = SentimentIntensityAnalyzer()
+# Smoothing windows of sentiment timelines, as fractions of the length of the timeline (the viewer plots 0.2)
+TIMELINE_WINDOWS = [0.05, 0.1, 0.2]
+# Maximum number of points of each level of a timeline
+TIMELINE_RESOLUTIONS = [100, 1000]
+# Analyzed movies only store the timelines the viewer plots (DIRECTION entries and lines of each character), with the
+# window and level it plots: the other ones are computed on demand by the query server (see compute_timelines)
+STORED_TIMELINE_WINDOWS = [0.2]
+STORED_TIMELINE_RESOLUTIONS = [1000]
 
 """ Get compound sentiment score for a given utterance. """
 def get_sentiment_score(text):
-    scores = classifier.polarity_scores(text)
-    return scores["compound"]
+    return sentiment.get_scorer().score(text)
 
 class AnalyzedMovieScript:
-    def __init__(self, parsed_script):
+    """ Analyze a parsed script. Sentiment scores can be given (one per SPEECH and DIRECTION entry, in order)
+        to reuse the scores of a previous analysis instead of scoring entries again. """
+    def __init__(self, parsed_script, scorer=None, scores=None):
         self.parsed_script = parsed_script
         self.character_names = parsed_script.character_names
         self.entries = parsed_script.entries
 
-        # Compute sentiment score for all entries
-        for e in self.entries:
-            if e["type"] in [script_parser.TYPE_SPEECH, script_parser.TYPE_DIRECTION]:
-                e["cs"] = get_sentiment_score(e["content"])
+        # Sentiment score of all entries
+        self.compute_sentiment(scorer, scores)
 
-        # Compute information about characters (line count, average compound score)
+        # Information about characters (line count, average compound score)
+        self.compute_characters()
+    
+         # Co-occurrence matrix
+        self.compute_cooccurrences()
+        self._co_occurrences = None
+
+        # Scene and speaking turn tables, for direct interaction lookups
+        self.compute_turns()
+
+        # Sentiment timelines, smoothed and downsampled for plotting
+        self.compute_timelines()
+
+
+    """ Compute the compound sentiment score of all SPEECH and DIRECTION entries, in one batch. """
+    @instrumentation.timed("sentiment")
+    def compute_sentiment(self, scorer=None, scores=None):
+        scored_entries = [e for e in self.entries if e.type in [script_parser.TYPE_SPEECH, script_parser.TYPE_DIRECTION]]
+        if scores == None:
+            if scorer == None:
+                scorer = sentiment.get_scorer()
+            scores = scorer.score_batch([e.content for e in scored_entries])
+            instrumentation.count("sentiment_entries", len(scored_entries))
+        elif len(scores) != len(scored_entries):
+            raise ValueError("Expected " + str(len(scored_entries)) + " sentiment scores, got " + str(len(scores)))
+        for e, score in zip(scored_entries, scores):
+            e.cs = score
+
+
+    """ Compute the line count and average compound score of every character. """
+    def compute_characters(self):
         self.characters = dict()
-        for n in parsed_script.character_names:
+        for n in self.character_names:
             self.characters[n] = {"name": n, "line_count": 0, "avg_cs": 0}
-        for i in range(1, len(parsed_script.entries)):
-            e = parsed_script.entries[i]
-            prev_e = parsed_script.entries[i-1]
-            if e["type"] == script_parser.TYPE_SPEECH and prev_e["type"] == script_parser.TYPE_CHARACTER:
-                name = prev_e["content"]
+        for i in range(1, len(self.entries)):
+            e = self.entries[i]
+            prev_e = self.entries[i-1]
+            if e.type == script_parser.TYPE_SPEECH and prev_e.type == script_parser.TYPE_CHARACTER:
+                name = prev_e.content
                 c = self.characters[name] 
-                c["avg_cs"] = (c["line_count"] * c["avg_cs"] + e["cs"]) / (c["line_count"] + 1)
+                c["avg_cs"] = (c["line_count"] * c["avg_cs"] + e.cs) / (c["line_count"] + 1)
                 c["line_count"] += 1
-    
-         # Co-occurrence matrix
-        self.co_occurrences = self.create_cooccurrences_matrix()
-    
+
+
+    """ Co-occurrence matrix as a dict of dicts of {"count", "avg_cs"}, built on first access. """
+    @property
+    def co_occurrences(self):
+        if self._co_occurrences == None:
+            self._co_occurrences = self.cooccurrences_to_dict()
+        return self._co_occurrences
+
 
     def create_cooccurrences_matrix(self):
-        # Init matrix
-        m = dict()
-        for namei in self.character_names:
-            m[namei] = dict()
-            for namej in self.character_names:
-                m[namei][namej] = {"count": 0, "avg_cs": 0}
+        self.compute_cooccurrences()
+        return self.cooccurrences_to_dict()
+
+
+    """ Compute the number of shared scenes and the average mutual sentiment score of every pair of characters,
+        as NumPy matrices indexed by character_index. """
+    @instrumentation.timed("cooccurrences")
+    def compute_cooccurrences(self):
+        import numpy as np
+        # Map character names to matrix indices
+        self.character_index = {name: i for i, name in enumerate(self.character_names)}
+
+        num_characters = len(self.character_names)
+        self.cooccurrence_counts = np.zeros((num_characters, num_characters), dtype=np.int64)
+        mutual_sums = np.zeros((num_characters, num_characters))
 
         # Fill matrix
         characters_in_scene = dict()
         for i,e in enumerate(self.entries):
             # Check for a new scene
-            if e["type"] == script_parser.TYPE_LOCATION:
+            if e.type == script_parser.TYPE_LOCATION:
                 if len(characters_in_scene) > 0:
-                    for namei in characters_in_scene:
-                        avg_cs_i = (characters_in_scene[namei]["sum_cs"] / characters_in_scene[namei]["num_lines"])
-                        for namej in characters_in_scene:
-                            avg_cs_j = (characters_in_scene[namej]["sum_cs"] / characters_in_scene[namej]["num_lines"])
-                            mutual_cs = (avg_cs_i + avg_cs_j) / 2
-                            c = m[namei][namej]["count"]
-                            m[namei][namej]["avg_cs"] = (m[namei][namej]["avg_cs"] * c + mutual_cs) / (c + 1)
-                            m[namei][namej]["count"] += 1 # TODO replace 1 with number of appearances? 
-                            
+                    # Accumulate the number of shared scenes and the mutual score (avg_cs_i + avg_cs_j) / 2
+                    # of every pair of characters in the scene with outer operations
+                    indices = np.fromiter((self.character_index[name] for name in characters_in_scene), dtype=np.intp, count=len(characters_in_scene))
+                    avg_cs = np.array([sum_cs / num_lines for sum_cs, num_lines in characters_in_scene.values()])
+                    pairs = np.ix_(indices, indices)
+                    self.cooccurrence_counts[pairs] += 1
+                    mutual_sums[pairs] += np.add.outer(avg_cs, avg_cs) / 2
                 characters_in_scene = dict()
-            if e["type"] == script_parser.TYPE_CHARACTER:
-                name = e["content"]
-                if not name in characters_in_scene:
-                    characters_in_scene[name] = {"sum_cs": 0, "num_lines": 0}
-                characters_in_scene[name]["num_lines"] += 1
+            if e.type == script_parser.TYPE_CHARACTER:
+                sum_cs, num_lines = characters_in_scene.get(e.content, (0, 0))
+                if i+1 < len(self.entries) and self.entries[i+1].type == script_parser.TYPE_SPEECH:
+                    sum_cs += self.entries[i+1].cs
+                characters_in_scene[e.content] = (sum_cs, num_lines + 1)
+
+        self.cooccurrence_avg_cs = np.divide(mutual_sums, self.cooccurrence_counts, out=np.zeros_like(mutual_sums), where=self.cooccurrence_counts > 0)
 
-                if i+1 < len(self.entries) and self.entries[i+1]["type"] == script_parser.TYPE_SPEECH:
-                    characters_in_scene[name]["sum_cs"] += self.entries[i+1]["cs"]
-        
-        return m
+
+    """ Iterate over the rows of the co-occurrence matrices, as (name, {name: {"count", "avg_cs"}}).
+        If sparse, rows only include the characters that share at least one scene with the character. """
+    def iter_cooccurrence_rows(self, sparse=False):
+        import numpy as np
+        for i, namei in enumerate(self.character_names):
+            if sparse:
+                row = dict()
+            else:
+                row = {namej: {"count": 0, "avg_cs": 0} for namej in self.character_names}
+            counts = self.cooccurrence_counts[i].tolist()
+            avg_cs = self.cooccurrence_avg_cs[i].tolist()
+            for j in np.flatnonzero(self.cooccurrence_counts[i]).tolist():
+                row[self.character_names[j]] = {"count": counts[j], "avg_cs": avg_cs[j]}
+            yield namei, row
+
+
+    """ Convert the co-occurrence matrices to a dict of dicts of {"count", "avg_cs"}, for serialization.
+        If sparse, only pairs of characters that share at least one scene are included. """
+    def cooccurrences_to_dict(self, sparse=False):
+        return dict(self.iter_cooccurrence_rows(sparse))
 
     
-    def to_dict(self):
+    """ Compute the scene table (entry ranges starting at each LOCATION), the speaking turns (CHARACTER entries)
+        with the previous and next speaker in their scene, and the index of turns by pair of adjacent speakers.
+        Previous/next speakers follow getPreviousCharacter/getNextCharacter of the viewer, including their
+        behavior at the first and last entries. Like the viewer, turns only cover entries 2 to n-3. """
+    @instrumentation.timed("turns")
+    def compute_turns(self):
+        n = len(self.entries)
+
+        # Scenes
+        self.scenes = {"start": [], "end": []}
+        scene_of = [0] * n
+        for i, e in enumerate(self.entries):
+            if i == 0 or e.type == script_parser.TYPE_LOCATION:
+                if i > 0:
+                    self.scenes["end"].append(i)
+                self.scenes["start"].append(i)
+            scene_of[i] = len(self.scenes["start"]) - 1
+        if n > 0:
+            self.scenes["end"].append(n)
+
+        # Previous speaker of each CHARACTER entry: the last speaker of the scene, unless it is the same character,
+        # in which case the speaker before them. Entry 0 is only reached when no LOCATION comes before.
+        previous = [None] * n
+        last_speaker, before_last_speaker, location_found = None, None, False
+        for i in range(1, n):
+            e = self.entries[i]
+            if e.type == script_parser.TYPE_CHARACTER:
+                name = last_speaker if last_speaker != e.content else before_last_speaker
+                if name == None and not location_found and self.entries[0].type == script_parser.TYPE_CHARACTER:
+                    name = self.entries[0].content
+                previous[i] = name
+                if e.content != last_speaker:
+                    before_last_speaker, last_speaker = last_speaker, e.content
+            elif e.type == script_parser.TYPE_LOCATION:
+                last_speaker, before_last_speaker, location_found = None, None, True
+
+        # Next speaker, symmetrically. Entry n-1 is only reached when no LOCATION comes after.
+        following = [None] * n
+        next_speaker, after_next_speaker, location_found = None, None, False
+        for i in range(n - 2, -1, -1):
+            e = self.entries[i]
+            if e.type == script_parser.TYPE_CHARACTER:
+                name = next_speaker if next_speaker != e.content else after_next_speaker
+                if name == None and not location_found and self.entries[-1].type == script_parser.TYPE_CHARACTER:
+                    name = self.entries[-1].content
+                following[i] = name
+                if e.content != next_speaker:
+                    after_next_speaker, next_speaker = next_speaker, e.content
+            elif e.type == script_parser.TYPE_LOCATION:
+                next_speaker, after_next_speaker, location_found = None, None, True
+
+        # Speaking turns and interaction index
+        self.turns = {"entry": [], "speaker": [], "previous": [], "next": [], "scene": []}
+        self.interactions = dict()
+        for i in range(2, n - 2):
+            if self.entries[i].type != script_parser.TYPE_CHARACTER:
+                continue
+            turn = len(self.turns["entry"])
+            speaker = self.entries[i].content
+            self.turns["entry"].append(i)
+            self.turns["speaker"].append(speaker)
+            self.turns["previous"].append(previous[i])
+            self.turns["next"].append(following[i])
+            self.turns["scene"].append(scene_of[i])
+            # Same order in every run (unlike iterating a set), so that output files are reproducible
+            others = [previous[i]] if previous[i] == following[i] else [previous[i], following[i]]
+            for other in others:
+                if other != None:
+                    self.interactions.setdefault(speaker, dict()).setdefault(other, []).append(turn)
+
+
+    """ Compute the sentiment timelines stored with the analyzed movie. See compute_timelines. """
+    @instrumentation.timed("timelines")
+    def compute_timelines(self):
+        self.timelines = compute_timelines(self.entries, self.character_names, self.scenes["start"])
+
+
+    """ Get all exchanges between two characters: the lines of each character when the other one speaks
+        right before or after them in the same scene, in order. """
+    def get_interactions(self, name_a, name_b):
+        turns = set(self.interactions.get(name_a, dict()).get(name_b, [])) | set(self.interactions.get(name_b, dict()).get(name_a, []))
+        exchanges = []
+        for turn in sorted(turns):
+            i = self.turns["entry"][turn]
+            speech = self.entries[i+1]
+            exchanges.append({"turn": turn, "speaker": self.turns["speaker"][turn], "content": speech.content, "cs": speech.cs})
+        return exchanges
+
+    
+    def to_dict(self, sparse_cooccurrences=False):
         obj  = dict()
         obj["info"] = self.parsed_script.info
-        obj["entries"] = self.entries
+        obj["entries"] = [e.to_dict() for e in self.entries]
         obj["characters"] = self.characters
-        obj["cooccurrences"] = self.co_occurrences
+        obj["cooccurrences"] = self.cooccurrences_to_dict(True) if sparse_cooccurrences else self.co_occurrences
+        obj.update(self.get_tables())
         return obj
 
 
-""" Saves an analyzed movie to file. """
-def save_analyzed_movie(analyzed):
+    """ Get the scene, turn and interaction tables, as exported with the analyzed movie. """
+    def get_tables(self):
+        return {"scenes": self.scenes, "turns": self.turns, "interactions": self.interactions, "timelines": self.timelines}
+
+
+""" Smooth a series with the moving average of the viewer (smoothMovingWindow in display/utils.js): the average of the
+    window + 1 values up to each value, with the values before the start of the series mirrored (value -j for j < 0).
+    Computed in linear time with prefix sums. """
+def smooth_moving_window(values, window):
+    import numpy as np
+    n = len(values)
+    if window <= 1:
+        return values
+    prefix = np.concatenate(([0], np.cumsum(values)))
+    i = np.arange(n)
+    start = np.maximum(i - window, 0)
+    sums = prefix[i + 1] - prefix[start]
+    counts = i + 1 - start
+
+    # Mirrored values: indices 1 to window - i
+    mirrored = np.clip(window - i, 0, n - 1)
+    sums += prefix[mirrored + 1] - prefix[1]
+    counts += mirrored
+    return sums / counts
+
+
+""" Make a sentiment timeline from a series of scores, with the x coordinate (for the plot) and the entry (for its content)
+    of each score. The timeline has one level per resolution, each with the raw scores and the scores smoothed with each
+    window, downsampled to at most that many points. The last level has all points when the series is not longer than
+    the largest resolution. """
+def make_timeline(scores, x, entries, windows=TIMELINE_WINDOWS, resolutions=TIMELINE_RESOLUTIONS):
+    import numpy as np
+    n = len(scores)
+    x, entries = np.asarray(x), np.asarray(entries)
+    smoothed = {str(w): smooth_moving_window(scores, int(n * w + 0.5)) for w in windows}
+
+    levels = []
+    for resolution in resolutions:
+        if n == 0:
+            break
+        points = np.arange(n) if n <= resolution else np.unique(np.linspace(0, n - 1, resolution).round().astype(np.intp))
+        levels.append({
+            "x": x[points].tolist(),
+            "entry": entries[points].tolist(),
+            "raw": np.round(scores[points], 4).tolist(),
+            "smoothed": {w: np.round(values[points], 4).tolist() for w, values in smoothed.items()}
+        })
+        if n <= resolution:
+            break
+    return {"length": n, "levels": levels}
+
+
+""" Make the timeline of the average score of the given entries in each scene that contains any of them.
+    x is the index of the scene and the entries are the first entry of each scene. """
+def make_scene_timeline(entries, scores, scene_starts, windows=TIMELINE_WINDOWS, resolutions=TIMELINE_RESOLUTIONS):
+    import numpy as np
+    scene_starts = np.array(scene_starts, dtype=np.intp)
+    scenes = np.searchsorted(scene_starts, entries, side="right") - 1
+    sums = np.bincount(scenes, weights=scores[entries], minlength=len(scene_starts))
+    counts = np.bincount(scenes, minlength=len(scene_starts))
+    x = np.flatnonzero(counts)
+    return make_timeline(sums[x] / counts[x], x, scene_starts[x], windows, resolutions)
+
+
+""" Compute the sentiment timelines of analyzed entries (script_parser.Entry objects) with the given smoothing windows
+    and levels (see make_timeline): the timeline of the DIRECTION entries of the movie, and of the lines of each
+    character. With all_series, the timelines of all SPEECH entries of the movie and of the scene averages of the
+    movie and of each character are computed as well. The defaults are the timelines stored with analyzed movies,
+    which the viewer plots. """
+def compute_timelines(entries, character_names, scene_starts, windows=STORED_TIMELINE_WINDOWS, resolutions=STORED_TIMELINE_RESOLUTIONS, all_series=False):
+    import numpy as np
+    direction, speech, character_speech = [], [], {n: [] for n in character_names}
+    for i, e in enumerate(entries):
+        if e.type == script_parser.TYPE_DIRECTION:
+            direction.append(i)
+        elif e.type == script_parser.TYPE_SPEECH and i > 0 and entries[i-1].type == script_parser.TYPE_CHARACTER:
+            # x is the index of the line among all lines of the movie, like in the viewer
+            character_speech[entries[i-1].content].append((len(speech), i))
+            speech.append(i)
+
+    scores = np.array([np.nan if e.cs == None else e.cs for e in entries])
+    timelines = {"direction": make_timeline(scores[direction], np.arange(len(direction)), direction, windows, resolutions)}
+    if all_series:
+        timelines["speech"] = make_timeline(scores[speech], np.arange(len(speech)), speech, windows, resolutions)
+        timelines["scenes"] = make_scene_timeline(np.flatnonzero(~np.isnan(scores)), scores, scene_starts, windows, resolutions)
+    timelines["characters"] = dict()
+    for name, lines in character_speech.items():
+        x = [x for x, _ in lines]
+        character_entries = [i for _, i in lines]
+        timelines["characters"][name] = {"speech": make_timeline(scores[character_entries], x, character_entries, windows, resolutions)}
+        if all_series:
+            timelines["characters"][name]["scenes"] = make_scene_timeline(np.array(character_entries, dtype=np.intp), scores, scene_starts, windows, resolutions)
+    return timelines
+
+
+""" Saves an analyzed movie to file, as JSON or in the compact columnar format (see columnar_format).
+    Returns the path of the written file. """
+@instrumentation.timed("save")
+def save_analyzed_movie(analyzed, output_format="json", compression=None):
     movie_info = analyzed.parsed_script.info
-    obj = analyzed.to_dict()
-    safe_name = movie_info["title"].lower().replace(" ", "-").replace(":", "")
+    safe_name = utils.get_safe_name(movie_info["title"])
+
+    if output_format == "columnar":
+        path = columnar_format.write_columnar(analyzed.to_dict(sparse_cooccurrences=True), config.DIR_ANALYZED + safe_name + ".columnar.json", compression)
+        print("Saved", os.path.basename(path))
+        return path
 
-    # Write JSON to file
-    with open(config.DIR_ANALYZED + safe_name + ".json", "w") as out_file:
-        json.dump(obj, out_file)
+    # Write JSON to file, one entry and co-occurrence row at a time
+    path = config.DIR_ANALYZED + safe_name + ".json"
+    streaming_format.write_movie(path, movie_info, (e.to_dict() for e in analyzed.entries), analyzed.characters, analyzed.iter_cooccurrence_rows(), analyzed.get_tables())
     
     print("Saved", safe_name + ".json")
+    return path
+
+
+# Movies that are analyzed by default
+EXPORT_MOVIES = [
+    "Apocalypse Now",
+    "Avatar",
+    "Blade Runner",
+    "Ghostbusters",
+    "Gladiator",
+    "Godfather",
+    "Guardians of the Galaxy Vol 2",
+    "Indiana Jones and the Raiders of the Lost Ark",
+    "Indiana Jones and the Last Crusade",
+    "Indiana Jones and the Temple of Doom",
+    "Jurassic Park",
+    "Lord of the Rings: Fellowship of the Ring",
+    "Lord of the Rings: Return of the King",
+    #"Lord of the Rings: The Two Towers"
+    "Men in Black",
+    "Mission Impossible",
+    "Pirates of the Caribbean",
+    "Pulp Fiction",
+    "Shrek",
+    "Star Wars: A New Hope",
+    "Star Wars: The Empire Strikes Back",
+    "Star Wars: Return of the Jedi",
+    "Star Wars: The Phantom Menace",
+    "Star Wars: Attack of the Clones",
+    "Star Wars: Revenge of the Sith",
+    "Star Wars: The Force Awakens",
+    "Terminator",
+    "Terminator 2: Judgement Day",
+    "Terminator Salvation",
+    "Thor",
+    "Thor Ragnarok",
+    "Titanic",
+    "TRON",
+    "Wall-E",
+    "Wizard of Oz", 
+    "Wolf of Wall Street",
+    "X-Men Origins: Wolverine",
+]
 
 
 if __name__ == "__main__":
-    export_movies = [
-        "Apocalypse Now",
-        "Avatar",
-        "Blade Runner",
-        "Ghostbusters",
-        "Gladiator",
-        "Godfather",
-        "Guardians of the Galaxy Vol 2",
-        "Indiana Jones and the Raiders of the Lost Ark",
-        "Indiana Jones and the Last Crusade",
-        "Indiana Jones and the Temple of Doom",
-        "Jurassic Park",
-        "Lord of the Rings: Fellowship of the Ring",
-        "Lord of the Rings: Return of the King",
-        #"Lord of the Rings: The Two Towers"
-        "Men in Black",
-        "Mission Impossible",
-        "Pirates of the Caribbean",
-        "Pulp Fiction",
-        "Shrek",
-        "Star Wars: A New Hope",
-        "Star Wars: The Empire Strikes Back",
-        "Star Wars: Return of the Jedi",
-        "Star Wars: The Phantom Menace",
-        "Star Wars: Attack of the Clones",
-        "Star Wars: Revenge of the Sith",
-        "Star Wars: The Force Awakens",
-        "Terminator",
-        "Terminator 2: Judgement Day",
-        "Terminator Salvation",
-        "Thor",
-        "Thor Ragnarok",
-        "Titanic",
-        "TRON",
-        "Wall-E",
-        "Wizard of Oz", 
-        "Wolf of Wall Street",
-        "X-Men Origins: Wolverine",
-    ]
-
-    movies = [utils.get_movie_metadata_by_name(name) for name in export_movies]
-    #movies = [utils.get_movie_metadata_by_name(export_movies[-1])]
+    movies = [utils.get_movie_metadata_by_name(name) for name in EXPORT_MOVIES]
+    #movies = [utils.get_movie_metadata_by_name(EXPORT_MOVIES[-1])]
 
     for i, movie in enumerate(movies):
         print("Parsing", "'" + movie["title"] + "'", "(" + str(i+1) + "/" + str(len(movies)) + ")")
-        parsed_script = script_parser.parse_movie(movie)
-        if parsed_script != None:
-            parsed_script.print()
-            analyzed = AnalyzedMovieScript(parsed_script)
-            save_analyzed_movie(analyzed)
+        with instrumentation.record() as report:
+            parsed_script = script_parser.parse_movie(movie)
+            if parsed_script != None:
+                parsed_script.print()
+                analyzed = AnalyzedMovieScript(parsed_script)
+                save_analyzed_movie(analyzed)
+        print("Timings:", instrumentation.format_timers(report.to_dict()))
 
 
     
\ No newline at end of file
@@ -0,0 +1,139 @@
+import gzip
+import hashlib
+import json
+import os
+
+import config
+import utils
+
+""" Local cache of raw movie scripts, keyed by script page.
+    Script contents are stored gzip-compressed under the hash of their content, while a small
+    metadata file per script page records the content hash and the HTTP validators (ETag, Last-Modified)
+    used for conditional revalidation. Files are written atomically, so the cache can be shared by
+    several processes. The least recently used scripts are evicted when the cache exceeds its maximum size. """
+class ScriptCache:
+    def __init__(self, directory=None, max_size=None):
+        directory = config.DIR_SCRIPT_CACHE if directory == None else directory
+        max_size = config.SCRIPT_CACHE_MAX_SIZE if max_size == None else max_size
+        self.directory = directory
+        self.max_size = max_size
+        self.entries_dir = os.path.join(directory, "entries")
+        self.blobs_dir = os.path.join(directory, "blobs")
+        os.makedirs(self.entries_dir, exist_ok=True)
+        os.makedirs(self.blobs_dir, exist_ok=True)
+
+
+    def entry_path(self, script_page):
+        key = hashlib.sha1(script_page.encode("utf-8")).hexdigest()
+        return os.path.join(self.entries_dir, key + ".json")
+
+
+    def blob_path(self, content_hash):
+        return os.path.join(self.blobs_dir, content_hash + ".gz")
+
+
+    """ Get the cache metadata for a script page (content hash, ETag, Last-Modified), or None if it is not cached. """
+    def get_entry(self, script_page):
+        try:
+            with open(self.entry_path(script_page)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(self.blob_path(entry["hash"])):
+            return None
+        return entry
+
+
+    """ Get the cached script for a script page, or None if it is not cached. """
+    def get(self, script_page):
+        entry = self.get_entry(script_page)
+        if entry == None:
+            return None
+        try:
+            with gzip.open(self.blob_path(entry["hash"]), "rt", encoding="utf-8") as f:
+                content = f.read()
+        except OSError:
+            return None
+        self.touch(script_page)
+        return content
+
+
+    """ Mark a script page as recently used. """
+    def touch(self, script_page):
+        try:
+            os.utime(self.entry_path(script_page))
+        except OSError:
+            pass
+
+
+    """ Store the script for a script page along with its HTTP validators. """
+    def put(self, script_page, content, etag=None, last_modified=None):
+        data = content.encode("utf-8")
+        content_hash = hashlib.sha256(data).hexdigest()
+
+        blob_path = self.blob_path(content_hash)
+        if not os.path.exists(blob_path):
+            with utils.write_atomic(blob_path, "wb") as f:
+                f.write(gzip.compress(data))
+
+        entry = {"script_page": script_page, "hash": content_hash, "etag": etag, "last_modified": last_modified}
+        with utils.write_atomic(self.entry_path(script_page)) as f:
+            json.dump(entry, f)
+
+        self.evict()
+
+
+    """ Remove unreferenced blobs, then the least recently used scripts, until the cache fits in its maximum size. """
+    def evict(self):
+        blob_sizes = dict()
+        for name in os.listdir(self.blobs_dir):
+            if name.endswith(".gz"):
+                blob_sizes[name[:-3]] = os.path.getsize(os.path.join(self.blobs_dir, name))
+        total_size = sum(blob_sizes.values())
+        if total_size <= self.max_size:
+            return
+
+        # Read all entries, most recently used last
+        entries = []
+        for name in os.listdir(self.entries_dir):
+            path = os.path.join(self.entries_dir, name)
+            try:
+                with open(path) as f:
+                    entries.append((os.path.getmtime(path), path, json.load(f)["hash"]))
+            except (OSError, ValueError, KeyError):
+                continue
+        entries.sort()
+
+        references = dict()
+        for _, _, content_hash in entries:
+            references[content_hash] = references.get(content_hash, 0) + 1
+
+        # Remove the blobs no entry points to anymore (e.g. the previous content of a script that changed)
+        for content_hash, size in blob_sizes.items():
+            if content_hash not in references:
+                try:
+                    os.remove(self.blob_path(content_hash))
+                    total_size -= size
+                except FileNotFoundError:
+                    continue
+
+        for _, path, content_hash in entries:
+            if total_size <= self.max_size:
+                break
+            references[content_hash] -= 1
+
+            # Another process may be evicting at the same time
+            try:
+                os.remove(path)
+
+                # Blobs are shared by pages with identical scripts
+                if references[content_hash] == 0 and content_hash in blob_sizes:
+                    os.remove(self.blob_path(content_hash))
+                    total_size -= blob_sizes[content_hash]
+            except FileNotFoundError:
+                continue
+
+
+    """ Get the total size of the cached scripts, in bytes (compressed). """
+    def size(self):
+        return sum(os.path.getsize(os.path.join(self.blobs_dir, n)) for n in os.listdir(self.blobs_dir) if n.endswith(".gz"))
@@ -1,26 +1,211 @@
+import re
+
 import config
-from bs4 import BeautifulSoup
-import requests
+import http_client
+import instrumentation
+from script_cache import ScriptCache
 
 # The length threshold under which a movie script is discarded because we probably did not
 # successfully retrieve the script from the HTML page
 DISCARD_LENGTH_THRESHOLD = 10000
 
-""" Get the raw script for a given movie. """
-def get_raw_script(movie):
+# Shared HTTP session and script cache, created on first use
+session = None
+cache = None
+
+""" Get the shared script cache. """
+def get_cache():
+    global cache
+    if cache == None:
+        cache = ScriptCache()
+    return cache
+
+# Patterns of the targeted scanner of script pages
+exp_scrtext_td = re.compile(rb"<td\b[^>]*?\bclass\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s>]+))[^>]*>", re.I)
+exp_pre_start = re.compile(rb"<pre\b[^>]*>", re.I)
+exp_pre_end = re.compile(rb"</pre\s*>", re.I)
+exp_td_end = re.compile(rb"</td\s*>", re.I)
+# Encoding declarations, searched like BeautifulSoup does
+exp_xml_encoding = re.compile(rb"^\s*<\?.*encoding=['\"](.*?)['\"].*\?>", re.I)
+exp_meta_charset = re.compile(rb"<\s*meta[^>]+charset\s*=\s*[\"']?([^>]*?)[ /;'\">]", re.I)
+# Markup of script contents that the scanner can serialize like BeautifulSoup
+exp_tag = re.compile(r"<[^<>]*>")
+exp_ampersand = re.compile(r"&(?:(amp|lt|gt|quot|apos|nbsp);|(?=[A-Za-z#]))")
+CANONICAL_TAGS = {"<b>": "<b>", "</b>": "</b>", "<br>": "<br/>", "<br/>": "<br/>", "<br />": "<br/>"}
+ENTITIES = {"amp": "&amp;", "lt": "&lt;", "gt": "&gt;", "quot": "\"", "apos": "'", "nbsp": "\xa0"}
+
+""" Get the encoding BeautifulSoup would decode a page with: its byte order mark or declared encoding.
+    The encoding of other pages is detected like BeautifulSoup does (with charset_normalizer or chardet,
+    if installed), unless they are pure ASCII. """
+def get_page_encoding(page):
+    if page.startswith(b"\xef\xbb\xbf"):
+        return "utf-8"
+    if page.startswith((b"\xfe\xff", b"\xff\xfe")):
+        return None
+    match = exp_xml_encoding.search(page, 0, 1024) or exp_meta_charset.search(page, 0, max(2048, int(len(page) * 0.05)))
+    if match != None and len(match.group(1)) > 0:
+        return match.group(1).decode("ascii", "replace").lower()
+    if page.isascii():
+        return "utf-8"
+    from bs4.dammit import UnicodeDammit
+    return UnicodeDammit(page, is_html=True).original_encoding
+
+""" Serialize the markup of script contents like BeautifulSoup's decode_contents: lowercase <b> and <br/> tags,
+    entities other than &amp;, &lt; and &gt; decoded and &, <, > escaped. Returns None for any other markup
+    (other tags, comments, nested or unclosed <b> tags, unknown entities). Contents that are already serialized
+    this way, which is the common case, are returned as is. """
+def normalize_script_markup(text):
+    tags = exp_tag.findall(text)
+    if len(tags) != text.count("<"):
+        return None
+    is_canonical = "&" not in text and text.count(">") == len(tags)
+    bold = False
+    for tag in tags:
+        canonical = CANONICAL_TAGS.get(tag.lower())
+        if canonical == None:
+            return None
+        if canonical == "<b>" or canonical == "</b>":
+            if bold == (canonical == "<b>"):
+                return None
+            bold = not bold
+        is_canonical = is_canonical and canonical == tag
+    if bold:
+        return None
+    if is_canonical:
+        return text
+
+    # Serialize every tag and text segment
+    parts = []
+    pos = 0
+    for match in exp_tag.finditer(text):
+        parts.append(match.string[pos:match.start()])
+        parts.append(CANONICAL_TAGS[match.group().lower()])
+        pos = match.end()
+    parts.append(text[pos:])
+    for i in range(0, len(parts), 2):
+        segment = parts[i]
+        if "&" in segment:
+            segments = []
+            pos = 0
+            for match in exp_ampersand.finditer(segment):
+                if match.group(1) == None:
+                    return None # BeautifulSoup handles other entities in ways that are not all reproduced here
+                segments.append(segment[pos:match.start()].replace("&", "&amp;").replace(">", "&gt;"))
+                segments.append(ENTITIES[match.group(1)])
+                pos = match.end()
+            segments.append(segment[pos:].replace("&", "&amp;").replace(">", "&gt;"))
+            segment = "".join(segments)
+        else:
+            segment = segment.replace(">", "&gt;")
+        parts[i] = segment
+    return "".join(parts)
+
+""" Extract the script contents from a script page (bytes) with a targeted scanner: the contents of the first <pre>
+    of a td.scrtext cell are located in the raw bytes and only they are decoded. The result is what
+    extract_script_soup returns; None is returned for pages the scanner cannot handle exactly like BeautifulSoup. """
+def scan_script(page):
+    if isinstance(page, str):
+        page = page.encode("utf-8")
+    encoding = get_page_encoding(page)
+    if encoding == None:
+        return None
+
+    for td in exp_scrtext_td.finditer(page):
+        classes = next(c for c in td.groups() if c != None)
+        if not b"scrtext" in classes.split():
+            continue
+        pre = exp_pre_start.search(page, td.end())
+        td_end = exp_td_end.search(page, td.end())
+        if pre == None or (td_end != None and td_end.start() < pre.start()):
+            return None # The script is not in a <pre> tag
+        pre_end = exp_pre_end.search(page, pre.end())
+        if pre_end == None:
+            return None
+        try:
+            text = page[pre.end():pre_end.start()].decode(encoding)
+        except (LookupError, UnicodeDecodeError):
+            return None
+        return normalize_script_markup(text)
+    return None
+
+""" Extract the script contents from the HTML of a script page with BeautifulSoup. """
+def extract_script_soup(html):
+    # BeautifulSoup is only imported for the pages the scanner cannot handle
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "html.parser")
+
+    # Get the <pre> tag which contains the script
+    pre_tag = soup.select("td.scrtext pre")
+
+    container = pre_tag[0] if len(pre_tag) > 0 else soup.select("td.scrtext")[0]
+
+    return str(container.decode_contents())
+
+""" Extract the script contents from the HTML of a script page, with the targeted scanner when possible,
+    or BeautifulSoup. """
+def extract_script(html):
+    script = scan_script(html)
+    if script == None:
+        instrumentation.count("extract_soup")
+        script = extract_script_soup(html)
+    return script
+
+""" Download the script contents for a given movie, revalidating the cached version if there is one.
+    Returns (content, from_cache), with no content if the page could not be downloaded. """
+def fetch_script(movie, url, script_cache):
+    global session
+    if session == None:
+        session = http_client.create_session(1)
+
+    # Conditional request: the server answers 304 if the cached script is still valid
+    entry = script_cache.get_entry(movie["script_page"]) if script_cache != None else None
+    headers = dict()
+    if entry != None:
+        if entry["etag"] != None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] != None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    page = http_client.get(session, url, headers=headers)
+    if page.status_code == 304 and entry != None:
+        cached = script_cache.get(movie["script_page"])
+        if cached != None:
+            return cached, True
+        # The cached script was evicted meanwhile: request the full page
+        page = http_client.get(session, url)
+
+    if page.status_code != 200:
+        print("Error while accessing the script page (HTTP " + str(page.status_code) + ").")
+        return None, False
+
+    raw_content = extract_script(page.content)
+    if script_cache != None:
+        script_cache.put(movie["script_page"], raw_content, page.headers.get("ETag"), page.headers.get("Last-Modified"))
+    return raw_content, False
+
+""" Get the raw script for a given movie.
+    Cached scripts are returned without accessing the network, unless refresh is set: cached scripts are then
+    revalidated with the server. In offline mode, the network is never accessed and only cached scripts are returned. """
+@instrumentation.timed("fetch")
+def get_raw_script(movie, use_cache=True, offline=False, refresh=False):
     url = config.URL_IMSDB + movie["script_page"]
 
     # Only HTML movie scripts are supported
     if url[-5:].lower() == ".html":
-        page = requests.get(url)
-        soup = BeautifulSoup(page.content, "html.parser")
-
-        # Get the <pre> tag which contains the script
-        pre_tag = soup.select("td.scrtext pre")
-
-        container = pre_tag[0] if len(pre_tag) > 0 else soup.select("td.scrtext")[0]
+        script_cache = get_cache() if use_cache or offline else None
 
-        raw_content = str(container.decode_contents())
+        # Cached scripts are only revalidated with the server on refresh
+        raw_content, from_cache = None, True
+        if script_cache != None and (offline or not refresh):
+            raw_content = script_cache.get(movie["script_page"])
+        if raw_content == None:
+            if offline:
+                print("Script is not cached (offline mode).")
+                return None
+            raw_content, from_cache = fetch_script(movie, url, script_cache)
+            if raw_content == None:
+                return None
+        instrumentation.count("scripts_from_cache" if from_cache else "scripts_downloaded")
         
         if len(raw_content) < DISCARD_LENGTH_THRESHOLD:
             print("HTML content is too short to be a movie script.")
@@ -1,10 +1,14 @@
+import argparse
 import csv
 import re
 import json
+import sys
+import time
 
 import config
 import utils
 import script_fetcher
+import instrumentation
 
 # Entry types
 TYPE_META = "META"
@@ -13,22 +17,88 @@ TYPE_SPEECH = "SPEECH"
 TYPE_DIRECTION = "DIRECTION"
 TYPE_LOCATION = "LOCATION"
 
-# Pre-compiled regular expressions
+""" An entry of a script: its type (one of the TYPE_* constants), its content and its compound sentiment score
+    (None until the script is analyzed). Entries use __slots__, which takes about a third of the memory of a dict
+    per entry and speeds up the passes over entries. Hot loops use attributes (e.type); dict-style access (e["type"],
+    e.get("cs"), "cs" in e) is kept for code written against plain dict entries, and to_dict gives the dict
+    that is serialized. """
+class Entry:
+    __slots__ = ("type", "content", "cs")
 
-exp_location = re.compile("INT\.|EXT\.|INT |EXT |INT:|EXT:|INTERIOR|EXTERIOR|EXT/INT|INT/EXT|I/E|INSIDE|OUTSIDE| ROOM")
+    def __init__(self, type, content, cs=None):
+        self.type = type
+        self.content = content
+        self.cs = cs
+
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in Entry.__slots__ else None
+        if value == None:
+            raise KeyError(key)
+        return value
+
+
+    def __setitem__(self, key, value):
+        if not(key in Entry.__slots__):
+            raise KeyError(key)
+        setattr(self, key, value)
+
+
+    def __contains__(self, key):
+        return key in Entry.__slots__ and getattr(self, key) != None
+
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in Entry.__slots__ else None
+        return default if value == None else value
+
+
+    def to_dict(self):
+        obj = {"type": self.type, "content": self.content}
+        if self.cs != None:
+            obj["cs"] = self.cs
+        return obj
+
+
+    """ Entries are equal to entries and dicts with the same values. """
+    def __eq__(self, other):
+        if isinstance(other, Entry):
+            return self.type == other.type and self.content == other.content and self.cs == other.cs
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+
+    def __repr__(self):
+        return "Entry(" + repr(self.to_dict()) + ")"
+
+
+""" Build entries from dicts, e.g. the entries of an analyzed movie file. """
+def entries_from_dicts(dicts):
+    return [Entry(e["type"], e["content"], e.get("cs")) for e in dicts]
+
+
+# Pre-compiled regular expressions. Patterns starting with ^ are only used with match()
+
+# Literal keywords of LOCATION entries, e.g. "INT. HOUSE - NIGHT"
+LOCATION_TOKENS = ["INT.", "EXT.", "INT ", "EXT ", "INT:", "EXT:", "INTERIOR", "EXTERIOR", "EXT/INT", "INT/EXT", "I/E", "INSIDE", "OUTSIDE", " ROOM"]
+exp_location = re.compile("|".join(re.escape(token) for token in LOCATION_TOKENS))
 exp_location_2 = re.compile("^\s*[0-9]+[A-Z]{0,1}\s*[A-Z]+")
-exp_direction = re.compile("FADE |FADES |THE END|- END |- THE END |CREDITS|END CREDITS|CUT TO|CUT BACK TO|(\()*CONTINUED|\(MORE\)|TITLE |\(INTERCUT\)|ANGLE|CLOSE ON |CLOSE UP| SHOT|THEIR POV|\'S POV|WIDER ON|WIDE ON|CLOSER ON|CLOSE ON|RESUME ON|^\s*ON | VIEW|LATER| SHOTS|DISSOLVE|SUPER:|IN THE |UNDER THE |OVER THE |BACK ON |UP ON |FROM |CLOSEUP|CAMERA|IMAGE:")
+
+# Literal keywords of DIRECTION entries, e.g. "CUT TO:", and "ON ..." at the start of an entry.
+# Keywords are merged into a single pattern without groups or anchors, which is faster to search
+DIRECTION_TOKENS = ["FADE ", "FADES ", "THE END", "- END ", "CREDITS", "CUT TO", "CUT BACK TO", "CONTINUED", "(MORE)", "TITLE ", "(INTERCUT)", "ANGLE",
+    "CLOSE ON", "CLOSE UP", " SHOT", "THEIR POV", "'S POV", "WIDER ON", "WIDE ON", "CLOSER ON", "RESUME ON", " VIEW", "LATER", "DISSOLVE", "SUPER:",
+    "IN THE ", "UNDER THE ", "OVER THE ", "BACK ON ", "UP ON ", "FROM ", "CLOSEUP", "CAMERA", "IMAGE:"]
+exp_direction = re.compile("|".join(re.escape(token) for token in DIRECTION_TOKENS))
+exp_direction_on = re.compile("^\s*ON ")
 exp_direction_continued = re.compile("^(\s)*[0-9    ]*(\s)*(\()*CONTINUED")
 
 exp_number_period = re.compile("^(\s|\n)*[0-9]+\.(\s|\n)*$")
 exp_character_colon_speech = re.compile("^[\t ]*[0-9A-Z\- l]+(?=\: [a-zA-Z!() ]+)")
 
-# Example match: "FADE TO:"
-exp_direction_colon_ending = re.compile("\:\s*$")
-
-# Example match: "SUDDENLY."
-exp_direction_period_ending = re.compile("\.\s*$")
-
 # Example match: "  45 \n "
 exp_numeric_only = re.compile("^\s*[0-9]+\s*$")
 
@@ -37,23 +107,150 @@ exp_parenthesis_caps = re.compile("^(\s|\n)*\([A-Z 0-9`]+\)(\s|\n)*$")
 
 exp_has_alphanumeric = re.compile(r"[0-9A-Za-z]")
 
-character_cleanup_pattern_1 = r"\s*(\(V\.O\.\)|\(VO\)|\(V/O\)|\(O.S.\)|\(OS\)|\(O/S\)|\(O\.C\.\)|\(OC\)|\(CONT'D\)|\(CONT\)|\(CONT\.\)|\(CONT'D.\)|\(CONT 'D.\)|(OFF))"
-character_cleanup_pattern_2 = r" --"
+# Example match: " (beat)"
+exp_parenthesis_any = re.compile(r"\s*\(([a-zA-Z]|\s)+\)")
+
+exp_multi_spaces = re.compile(r"[\t ]+")
+exp_blank_line = re.compile(r"\n( *)\n")
+# Leading line breaks of whitespace-only bold contents, moved out of the tag by preprocess_script
+exp_bold_line_breaks = re.compile(r"(?: *\n){0,4}")
+
+# Tokens deleted from entries
+DELETE_TOKENS = ["<b>", "</b>", "<pre>", "</pre>", "<html>", "</html>"]
+
+exp_character_extension = re.compile(r"\s*(\(V\.O\.\)|\(VO\)|\(V/O\)|\(O.S.\)|\(OS\)|\(O/S\)|\(O\.C\.\)|\(OC\)|\(CONT'D\)|\(CONT\)|\(CONT\.\)|\(CONT'D.\)|\(CONT 'D.\)|(OFF))")
 
 
 """ Clean-up a raw entry before classification. """
 def basic_cleanup(l):
     # Delete some tokens
-    delete_tokens = ["<b>", "</b>", "<pre>", "</pre>", "<html>", "</html>"]
-    for x in delete_tokens:
-        l = l.replace(x, "")
+    if "<" in l:
+        for x in DELETE_TOKENS:
+            l = l.replace(x, "")
     # Strip
     l = l.strip()
     # Remove multi-spaces
-    l = re.sub(r"[\t ]+", " ", l)
+    if "  " in l or "\t" in l:
+        l = exp_multi_spaces.sub(" ", l)
     return l
 
 
+# Classification rules. Each rule returns (entry type, raw entry) if it applies to a raw entry, or None.
+
+""" Lines like "64." or "12". """
+def rule_numeric(script, raw):
+    if exp_number_period.match(raw) != None or exp_numeric_only.match(raw) != None:
+        return TYPE_DIRECTION, raw
+
+""" Lines that are for sure a LOCATION. """
+def rule_location_bold(script, raw):
+    if exp_location.search(raw) != None or exp_location_2.match(raw) != None:
+        script.meta_finished = True
+        return TYPE_LOCATION, raw
+
+""" Lines that are for sure a DIRECTION. """
+def rule_direction_keyword(script, raw):
+    if exp_direction.search(raw) != None or exp_direction_on.match(raw) != None:
+        script.meta_finished = True
+        return TYPE_DIRECTION, raw
+
+""" Movies where dialogue is written as CHARACTER: Speech. """
+def rule_character_colon_speech(script, raw):
+    match = exp_character_colon_speech.match(raw)
+    if match != None:
+        character_name = match.group().strip()
+        character_name = character_name.replace("l", "I") # fix a scan error that often occurs
+        script.entries.append(Entry(TYPE_CHARACTER, character_name))
+        return TYPE_SPEECH, raw[match.end()+1:]
+
+""" Bold lines like "FADE TO:", "SUDDENLY." or "CONTINUED". """
+def rule_direction_ending(script, raw):
+    stripped = raw.rstrip()
+    if stripped.endswith(":") or stripped.endswith(".") or ("CONTINUED" in raw and exp_direction_continued.match(raw) != None):
+        return TYPE_DIRECTION, raw
+
+""" After a CHARACTER entry, there should be a SPEECH entry. However, the entry has always been kept as a DIRECTION
+    here, which add_entry then also applies to the CHARACTER entry. """
+def rule_after_character(script, raw):
+    if len(script.entries) > 0 and script.entries[-1].type == TYPE_CHARACTER:
+        return TYPE_DIRECTION, raw
+
+""" Very likely to be a speech. """
+def rule_speech_bold(script, raw):
+    if "!" in raw or raw.strip().count(" ") >= 4:
+        return TYPE_SPEECH, raw
+
+""" Lines like "(PEEKS INSIDE)". """
+def rule_parenthesis(script, raw):
+    if exp_parenthesis_caps.match(raw) != None:
+        if len(script.entries) > 0 and script.entries[-1].type in [TYPE_CHARACTER, TYPE_SPEECH]:
+            return TYPE_SPEECH, raw # action like "(SCANS FILE)"
+        return TYPE_DIRECTION, raw # direction like "(INTO COMM)" or "(TO <name>)"
+
+""" Other bold lines are character names. """
+def rule_character(script, raw):
+    return TYPE_CHARACTER, raw
+
+""" Check again for LOCATION, this time on non-bold. """
+def rule_location(script, raw):
+    if exp_location.search(raw) != None:
+        script.meta_finished = True
+        return TYPE_LOCATION, raw
+
+""" Flag instructions such as "PAN TO:" as DIRECTION. """
+def rule_direction_colon(script, raw):
+    if raw.rstrip().endswith(":"):
+        return TYPE_DIRECTION, raw
+
+""" Non-bold lines after a character name or speech. """
+def rule_speech_after_character(script, raw):
+    if len(script.entries) > 0 and script.entries[-1].type in [TYPE_CHARACTER, TYPE_SPEECH]:
+        return TYPE_SPEECH, raw
+
+""" Necessary condition of the numeric and location patterns: the first non-space character is a digit. """
+def starts_with_digit(raw):
+    return raw.lstrip()[:1].isdigit()
+
+# Classification rules, evaluated in order until one applies: (name, bold, pre-check, rule).
+# bold is True or False for rules that only apply to bold or non-bold entries, or None. The pre-check is a cheap
+# necessary condition for the rule to apply, tested before running its regular expressions (None to always run it).
+# Entries to which no rule applies are DIRECTION.
+CLASSIFIER_RULES = [
+    ("numeric", None, starts_with_digit, rule_numeric),
+    ("location_bold", True, None, rule_location_bold),
+    ("direction_keyword", None, None, rule_direction_keyword),
+    ("character_colon_speech", None, lambda raw: ": " in raw, rule_character_colon_speech),
+    ("direction_ending", True, None, rule_direction_ending),
+    ("after_character", True, None, rule_after_character),
+    ("speech_bold", True, None, rule_speech_bold),
+    ("parenthesis", True, lambda raw: raw.lstrip().startswith("("), rule_parenthesis),
+    ("character", True, None, rule_character),
+    ("location", False, None, rule_location),
+    ("direction_colon", False, None, rule_direction_colon),
+    ("speech_after_character", False, None, rule_speech_after_character),
+]
+
+# Rules that apply to bold and non-bold entries
+BOLD_RULES = [(name, precheck, rule) for name, bold, precheck, rule in CLASSIFIER_RULES if bold != False]
+NON_BOLD_RULES = [(name, precheck, rule) for name, bold, precheck, rule in CLASSIFIER_RULES if bold != True]
+
+# Per-rule statistics of the classifier, only collected when enabled
+rule_stats = None
+
+""" Start counting the evaluations, pre-check rejections, hits and time of every classification rule. """
+def enable_rule_stats():
+    global rule_stats
+    rule_stats = {name: {"evaluations": 0, "prechecked": 0, "hits": 0, "time": 0} for name, _, _, _ in CLASSIFIER_RULES}
+
+def disable_rule_stats():
+    global rule_stats
+    rule_stats = None
+
+""" Get the per-rule statistics of the classifier since they were enabled, or None. """
+def get_rule_stats():
+    return rule_stats
+
+
 class MovieScript:
     def __init__(self, movie_info):
         self.entries = []
@@ -62,107 +259,103 @@ class MovieScript:
         self.meta_finished =  False
 
 
+    """ Classify a raw entry with the first classification rule that applies to it. Returns (entry type, raw entry). """
     def classify_entry_type(self, raw, is_bold):
-        is_first = len(self.entries) == 0
-
-        entry_type = TYPE_DIRECTION
-
-        # Handle lines like "64." or "12"
-        if exp_number_period.search(raw) != None or exp_numeric_only.search(raw) != None:
-            entry_type = TYPE_DIRECTION
+        rules = BOLD_RULES if is_bold else NON_BOLD_RULES
+        result = None
+        if rule_stats == None:
+            for _, precheck, rule in rules:
+                if precheck == None or precheck(raw):
+                    result = rule(self, raw)
+                    if result != None:
+                        break
         else:
-            # Lines that are for sure a LOCATION
-            if is_bold and (exp_location.search(raw) != None or exp_location_2.search(raw) != None):
-                entry_type = TYPE_LOCATION
-                self.meta_finished = True
-            # Lines that are for sure a DIRECTION
-            elif exp_direction.search(raw) != None:
-                entry_type = TYPE_DIRECTION
-                self.meta_finished = True
-            # Handle movies where dialogue is written as CHARACTER: Speech
-            elif exp_character_colon_speech.search(raw) != None:
-                match = exp_character_colon_speech.search(raw)
-                character_name = match.group().strip()
-                character_name = character_name.replace("l", "I") # fix a scan error that often occurs
-                self.entries.append({"type": TYPE_CHARACTER, "content": character_name})
-                entry_type = TYPE_SPEECH
-                raw = raw[match.end()+1:]
-            elif is_bold:
-                if exp_direction_continued.search(raw) != None or exp_direction_colon_ending.search(raw) != None or exp_direction_period_ending.search(raw) != None:
-                    entry_type = TYPE_DIRECTION
-                # After a CHARACTER entry, there should be a SPEECH entry
-                elif (not is_first) and self.entries[-1]["type"] == TYPE_CHARACTER:
-                    entry_type == TYPE_SPEECH
-                # Very likely to be a speech
-                elif "!" in raw or raw.strip().count(" ") >= 4:
-                    entry_type = TYPE_SPEECH
-                elif exp_parenthesis_caps.search(raw) != None:
-                    if (not is_first) and self.entries[-1]["type"] in [TYPE_CHARACTER, TYPE_SPEECH]:
-                        entry_type = TYPE_SPEECH # action like "(SCANS FILE)"
-                    else:
-                        entry_type = TYPE_DIRECTION # direction like "(INTO COMM)" or "(TO <name>)"
-                else:
-                    entry_type = TYPE_CHARACTER
-            else:
-                # Check again for LOCATION, this time on non-bold
-                if exp_location.search(raw) != None:
-                    entry_type = TYPE_LOCATION
-                    self.meta_finished = True
-                # Flag instructions such as "PAN TO:" as DIRECTION
-                elif exp_direction_colon_ending.search(raw) != None:
-                    entry_type = TYPE_DIRECTION
-                elif (not is_first) and self.entries[-1]["type"] in [TYPE_CHARACTER, TYPE_SPEECH]:
-                    entry_type = TYPE_SPEECH
+            result = self.classify_instrumented(raw, rules)
 
+        entry_type, raw = result if result != None else (TYPE_DIRECTION, raw)
         if not self.meta_finished:
             entry_type = TYPE_META                
 
         return entry_type, raw
 
 
+    def classify_instrumented(self, raw, rules):
+        for name, precheck, rule in rules:
+            stats = rule_stats[name]
+            stats["evaluations"] += 1
+            start = time.perf_counter()
+            result = None
+            if precheck != None and not precheck(raw):
+                stats["prechecked"] += 1
+            else:
+                result = rule(self, raw)
+            stats["time"] += time.perf_counter() - start
+            if result != None:
+                stats["hits"] += 1
+                return result
+        return None
+
+
     def add_entry(self, raw, is_bold):
-        entry = dict()
         entry_type, raw = self.classify_entry_type(raw, is_bold)
 
         # Correct the previous entry
         if len(self.entries) > 0:
-            if self.entries[-1]["type"] == TYPE_CHARACTER and entry_type != TYPE_SPEECH:
-                self.entries[-1]["type"] = TYPE_DIRECTION
+            if self.entries[-1].type == TYPE_CHARACTER and entry_type != TYPE_SPEECH:
+                self.entries[-1].type = TYPE_DIRECTION
 
-        entry["type"] = entry_type
-        entry["content"] = basic_cleanup(raw)
+        content = basic_cleanup(raw)
 
         if entry_type == TYPE_CHARACTER:
-            entry["content"] = self.cleanup_character_name(entry["content"])            
+            content = self.cleanup_character_name(content)
 
-        if len(entry["content"]) > 0 and exp_has_alphanumeric.search(entry["content"]) != None:
-            self.entries.append(entry)
+        if len(content) > 0 and exp_has_alphanumeric.search(content) != None:
+            self.entries.append(Entry(entry_type, content))
 
 
     def cleanup_character_name(self, name):
-        name = re.sub(character_cleanup_pattern_1, "", name)
-        name = re.sub(character_cleanup_pattern_2, "", name)
+        name = exp_character_extension.sub("", name)
+        name = name.replace(" --", "")
         name = name.strip()
         return name
 
 
     def fix_character_scan_errors(self, character_dict):
+        corrector = utils.ScanErrorCorrector(character_dict)
         for e in self.entries:
-            if e["type"] == TYPE_CHARACTER:
-                e["content"] = utils.fix_scan_errors(e["content"], character_dict)
+            if e.type == TYPE_CHARACTER:
+                e.content = corrector.fix(e.content)
 
 
     def create_character_occurrence_dict(self):
         character_dict = dict()
         for e in self.entries:
-            if e["type"] == TYPE_CHARACTER:
-                name = e["content"]
+            if e.type == TYPE_CHARACTER:
+                name = e.content
                 if not(name in character_dict):
                     character_dict[name] = 0
                 character_dict[name] += 1  
         return character_dict
 
 
+    """ Detect a character name written as non-bold at the start of a SPEECH or DIRECTION entry, e.g. "HAN\nWhat?".
+        The entry is turned into a CHARACTER entry and the new SPEECH entry with the rest of its content is returned, if any. """
+    def fix_character_false_negative(self, e, character_dict):
+        # TODO re-insert in speech
+        text = exp_parenthesis_any.sub("", e.content, count=1)
+        
+        lines = text.split("\n")
+
+        if lines[0] in character_dict:
+            e.type = TYPE_CHARACTER
+            e.content = lines[0]
+            
+            if len(lines) > 1:
+                return Entry(TYPE_SPEECH, " ".join(lines[1:]))
+        return None
+
+
+    @instrumentation.timed("finalize")
     def finalize(self):
         # Create a dictionary of name:occurrences for characters
         character_dict = self.create_character_occurrence_dict()
@@ -170,26 +363,15 @@ class MovieScript:
         # Clean-up characters
 
         # Fix false negatives: non-bold character names
-        for i,e in enumerate(self.entries):
-            if e["type"] in [TYPE_SPEECH, TYPE_DIRECTION]:
-                text = e["content"]
-                
-                # TODO re-insert in speech
-                text = re.sub("\s*\(([a-zA-Z]|\s)+\)", "", text, count=1)
-                
-                lines = text.split("\n")
-
-                for name in character_dict:
-                    if name == lines[0]:
-                        e["type"] = TYPE_CHARACTER
-                        e["content"] = name
-                        
-                        if len(lines) > 1:
-                            speech_entry = dict()
-                            speech_entry["type"] = TYPE_SPEECH
-                            speech_entry["content"] = " ".join(lines[1:])
-                            self.entries.insert(i+1, speech_entry)
-                        break
+        entries = []
+        for e in self.entries:
+            entries.append(e)
+            # A SPEECH entry split from a DIRECTION is itself checked for a character name
+            while e != None and e.type in [TYPE_SPEECH, TYPE_DIRECTION]:
+                e = self.fix_character_false_negative(e, character_dict)
+                if e != None:
+                    entries.append(e)
+        self.entries = entries
 
         self.fix_character_scan_errors(character_dict)
 
@@ -197,87 +379,152 @@ class MovieScript:
         character_dict = self.create_character_occurrence_dict()
         print("Cleaned-up character occurrences:", character_dict, sep="\n")
         
-        # If a SPEECH entry does not follow a CHARACTER, it is actually a DIRECTION.
-        for i in range(1, len(self.entries)):
-            if self.entries[i]["type"] == TYPE_SPEECH and self.entries[i-1]["type"] != TYPE_CHARACTER:
-                self.entries[i]["type"] = TYPE_DIRECTION
-        
-        # Get rid of \n within entries
+        character_names = set()
+        previous_type = None
         for e in self.entries:
-            e["content"] = e["content"].replace("\n", "")
+            # If a SPEECH entry does not follow a CHARACTER, it is actually a DIRECTION.
+            if e.type == TYPE_SPEECH and previous_type != TYPE_CHARACTER and previous_type != None:
+                e.type = TYPE_DIRECTION
+            previous_type = e.type
 
-        # Store character names
-        for e in self.entries:
-            if e["type"] == TYPE_CHARACTER:
-                name = e["content"]
-                if not(name in self.character_names):
-                    self.character_names.append(name)
+            # Get rid of \n within entries
+            e.content = e.content.replace("\n", "")
+
+            # Store character names. Names are interned: every CHARACTER entry of a character shares the same string
+            if e.type == TYPE_CHARACTER:
+                e.content = sys.intern(e.content)
+                if not(e.content in character_names):
+                    character_names.add(e.content)
+                    self.character_names.append(e.content)
 
     def print(self):
         #print(*self.entries, sep="\n")
         print("(" + str(len(self.entries)) + " entries).")
         num_entries = dict()
         for e in self.entries:
-            if not(e["type"] in num_entries):
-                num_entries[e["type"]] = 0
-            num_entries[e["type"]] += 1
+            if not(e.type in num_entries):
+                num_entries[e.type] = 0
+            num_entries[e.type] += 1
         print("Entry breakdown:", num_entries)
  
 
-""" Computes parsed data for the given movie. """
-def parse_movie(movie):
-    raw_script = script_fetcher.get_raw_script(movie)
-
-    if raw_script == None:
-        return None
+""" Split a preprocessed script into (segment, is_bold) tokens in a single pass.
+    Bold segments are the contents of <b></b> tags, non-bold segments are the text between them.
+    Text after an unclosed <b> tag and a single trailing line break are dropped. """
+def tokenize_script(text):
+    pos = 0
+    length = len(text)
+    # Non-bold segments never include a trailing line break at the very end of the script
+    end = length - 1 if text.endswith("\n") else length
+
+    while pos < end:
+        bold_start = text.find("<b>", pos, end)
+
+        if bold_start == -1:
+            yield text[pos:end], False
+            break
+        if bold_start > pos:
+            yield text[pos:bold_start], False
+
+        # Match the contents of the <b></b>
+        bold_end = text.find("</b>", bold_start + 3)
+        if bold_end == -1:
+            break
+        yield text[bold_start + 3:bold_end], True
+        pos = bold_end + 4
+
+
+""" Normalize the bold tags of a script in one pass over its </b> tags:
+    - spaces before a </b> are removed (unless only spaces come before it),
+    - <b> tags with only whitespace inside are removed, and their leading line breaks (up to 4) are moved before them. """
+def normalize_bold_tags(text):
+    parts = text.split("</b>")
+    normalized = []
+    for i in range(len(parts) - 1):
+        part = parts[i]
+        stripped = part.rstrip(" ")
+        if i > 0 or len(stripped) > 0:
+            part = stripped
+
+        bold_start = part.rfind("<b>")
+        if bold_start != -1 and (bold_start + 3 == len(part) or part[bold_start+3:].isspace()):
+            line_breaks = exp_bold_line_breaks.match(part, bold_start + 3).group().count("\n")
+            normalized.append(part[:bold_start] + "\n" * line_breaks)
+        else:
+            normalized.append(part)
+            normalized.append("</b>")
+    normalized.append(parts[-1])
+    return "".join(normalized)
 
-    movie_script = MovieScript(movie)
-    text = raw_script
-    text = re.sub("\r", "", text)
-    text = re.sub("<br>", "\n", text)
-    text = re.sub("<br/>", "\n", text)
-    
-    # Remove spaces before a </b>
-    text = re.sub("(?<=[^ ])( +)(?=</b>)", "", text)
 
-    # Extract \n from <b> tags when there is no other content inside
-    text = re.sub("<b>( *)\n(?=(\s|\n)*</b>)", "\n<b>", text)
-    text = re.sub("<b>( *)\n(?=(\s|\n)*</b>)", "\n<b>", text)
-    text = re.sub("<b>( *)\n(?=(\s|\n)*</b>)", "\n<b>", text)
-    text = re.sub("<b>( *)\n(?=(\s|\n)*</b>)", "\n<b>", text)
+""" Normalize the raw HTML of a script before tokenizing it. """
+def preprocess_script(raw_script):
+    text = raw_script.replace("\r", "").replace("<br>", "\n").replace("<br/>", "\n")
+    text = normalize_bold_tags(text)
 
-    # Remove empty <b> tags
-    text = re.sub("<b>(\s)*</b>", "", text)
-    
     # Remove spaces between consecutive line breaks
-    text = re.sub(r"\n( *)\n", r"\n\n", text)
+    return exp_blank_line.sub("\n\n", text)
 
-    exp_bold = re.compile(r"(?<=(<b>))(.|\n|\s)*?(?=(</b>))")
-    exp_until_bold = re.compile(r"(.|\n|\s)*?(?=<b>|$)")
-    
-    # Parse content line by line
-    while True:
-        # Match all text until the next <b> tag
-        match = exp_until_bold.search(text)
-        
-        if len(match.group()) > 0:
-            # Split on \n\n since that usually indicates a different entry
-            raw_entries = match.group().split("\n\n")
-            for raw_e in raw_entries:
-                movie_script.add_entry(raw_e, False)
-            text = text[match.end():]
-        else:
-            # If we have no text left before the next <b> tag, match the contents of the <b></b>
-            bold_match = exp_bold.search(text)
-            
-            # Stop parsing when we have nothing left to parse
-            if bold_match == None and len(match.group()) == 0:
-                break
 
-            if bold_match != None:
-                text = text[bold_match.end() + 4:]
-                movie_script.add_entry(bold_match.group(), True)
+""" Split a raw script into classified entries, without finalizing them. """
+def parse_entries(movie, raw_script):
+    movie_script = MovieScript(movie)
+    with instrumentation.timer("preprocess"):
+        text = preprocess_script(raw_script)
+
+    # Parse content segment by segment (tokenizing and classifying entries)
+    with instrumentation.timer("tokenize"):
+        for segment, is_bold in tokenize_script(text):
+            if is_bold:
+                movie_script.add_entry(segment, True)
+            else:
+                # Split on \n\n since that usually indicates a different entry
+                for raw_e in segment.split("\n\n"):
+                    movie_script.add_entry(raw_e, False)
+    instrumentation.count("entries", len(movie_script.entries))
+
+    return movie_script
 
+
+""" Computes parsed data for the given movie from its raw script. """
+def parse_raw_script(movie, raw_script):
+    movie_script = parse_entries(movie, raw_script)
     movie_script.finalize()    
     
     return movie_script
+
+
+""" Computes parsed data for the given movie. Cached scripts are revalidated with the server if refresh is set, and
+    in offline mode, only locally cached scripts are parsed. """
+def parse_movie(movie, offline=False, refresh=False):
+    raw_script = script_fetcher.get_raw_script(movie, offline=offline, refresh=refresh)
+
+    if raw_script == None:
+        return None
+
+    return parse_raw_script(movie, raw_script)
+
+
+""" Add the command-line arguments of script parsing to a parser. """
+def add_arguments(parser):
+    parser.add_argument("titles", nargs="+", metavar="TITLE", help="titles of the movies to parse")
+    parser.add_argument("--offline", action="store_true", help="only use locally cached scripts, never access the network")
+    parser.add_argument("--refresh", action="store_true", help="revalidate cached scripts with the server")
+
+
+def main(args):
+    for title in args.titles:
+        movie = utils.get_movie_metadata_by_name(title)
+        if movie == None:
+            print("Movie not found in metadata:", title)
+            continue
+        print("Parsing", "'" + movie["title"] + "'")
+        parsed_script = parse_movie(movie, args.offline, args.refresh and not args.offline)
+        if parsed_script != None:
+            parsed_script.print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parse movie scripts and print a breakdown of their entries.")
+    add_arguments(parser)
+    main(parser.parse_args())
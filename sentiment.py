@@ -0,0 +1,134 @@
+import itertools
+import json
+import os
+import time
+from collections import OrderedDict
+
+import config
+import utils
+
+""" Normalize text before scoring. VADER splits text on whitespace, so collapsing it does not change scores. """
+def normalize_text(text):
+    return " ".join(text.split())
+
+""" Compound sentiment scoring with VADER, memoized on normalized text.
+    Scores are kept in a bounded in-memory LRU memo and, optionally, in a persistent cache file shared
+    across runs and processes, which keeps the most recently added scores up to a maximum size. The VADER lexicon is only loaded when a text actually needs to be scored. """
+class SentimentScorer:
+    def __init__(self, memo_size=None, cache_file=None, cache_size=None):
+        memo_size = config.SENTIMENT_MEMO_SIZE if memo_size == None else memo_size
+        cache_size = config.SENTIMENT_CACHE_MAX_SIZE if cache_size == None else cache_size
+        self.analyzer = None
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+        self.cache_file = cache_file
+        self.cache_size = cache_size
+        self.persistent = dict()
+        # Scores added to the persistent cache since it was last saved
+        self.new_scores = dict()
+        self.stats = {"requests": 0, "memo_hits": 0, "persistent_hits": 0, "scored": 0, "time": 0}
+
+        if cache_file != None:
+            self.load_persistent()
+
+
+    def get_analyzer(self):
+        if self.analyzer == None:
+            from nltk.sentiment.vader import SentimentIntensityAnalyzer
+            self.analyzer = SentimentIntensityAnalyzer()
+        return self.analyzer
+
+
+    def load_persistent(self):
+        try:
+            with open(self.cache_file) as f:
+                self.persistent = json.load(f)
+        except (OSError, ValueError):
+            self.persistent = dict()
+
+
+    """ Write new scores to the persistent cache file, merged with scores saved by other processes meanwhile.
+        The file is locked while it is merged, and the oldest scores are dropped when it exceeds its maximum size. """
+    def save_persistent(self):
+        if self.cache_file == None or len(self.new_scores) == 0:
+            return
+        with utils.file_lock(self.cache_file):
+            self.load_persistent()
+            # New scores are moved to the end, so that the oldest ones come first
+            for key, score in self.new_scores.items():
+                self.persistent.pop(key, None)
+                self.persistent[key] = score
+            for key in list(itertools.islice(self.persistent, max(0, len(self.persistent) - self.cache_size))):
+                del self.persistent[key]
+
+            with utils.write_atomic(self.cache_file) as f:
+                json.dump(self.persistent, f)
+        self.new_scores = dict()
+
+
+    """ Get the compound sentiment score for a given utterance. """
+    def score(self, text):
+        return self.score_batch([text])[0]
+
+
+    """ Get the compound sentiment scores for a list of utterances. """
+    def score_batch(self, texts):
+        start = time.perf_counter()
+        keys = [normalize_text(t) for t in texts]
+        scores = dict()
+        missing = []
+
+        for key in keys:
+            if key in scores:
+                self.stats["memo_hits"] += 1
+            elif key in self.memo:
+                scores[key] = self.memo[key]
+                self.memo.move_to_end(key)
+                self.stats["memo_hits"] += 1
+            elif key in self.persistent:
+                scores[key] = self.persistent[key]
+                self.stats["persistent_hits"] += 1
+            else:
+                # Reserve the key so duplicates within the batch are only scored once
+                scores[key] = None
+                missing.append(key)
+
+        if len(missing) > 0:
+            analyzer = self.get_analyzer()
+            for key in missing:
+                scores[key] = analyzer.polarity_scores(key)["compound"]
+                if self.cache_file != None:
+                    self.persistent[key] = scores[key]
+                    self.new_scores[key] = scores[key]
+            self.stats["scored"] += len(missing)
+
+        # Update the LRU memo
+        for key in keys:
+            self.memo[key] = scores[key]
+            self.memo.move_to_end(key)
+        while len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+
+        self.stats["requests"] += len(texts)
+        self.stats["time"] += time.perf_counter() - start
+        return [scores[key] for key in keys]
+
+
+    """ Get a copy of the scoring statistics, with the hit rate and throughput. """
+    def get_stats(self):
+        stats = dict(self.stats)
+        hits = stats["memo_hits"] + stats["persistent_hits"]
+        stats["hit_rate"] = hits / stats["requests"] if stats["requests"] > 0 else 0
+        stats["entries_per_second"] = stats["requests"] / stats["time"] if stats["time"] > 0 else 0
+        return stats
+
+
+# Shared scorer, created on first use
+scorer = None
+
+""" Get the shared sentiment scorer. """
+def get_scorer():
+    global scorer
+    if scorer == None:
+        scorer = SentimentScorer()
+    return scorer
@@ -0,0 +1,179 @@
+import json
+import re
+
+import utils
+
+# Every ENTRY_CHECKPOINT_INTERVAL entries, the offset of the entry is stored in the index
+ENTRY_CHECKPOINT_INTERVAL = 256
+
+# Width of the offset of the index, written at the end of the file
+INDEX_OFFSET_WIDTH = 20
+
+# Keys written by write_movie in addition to the ones of the analyzed movie
+INDEX_KEYS = ["index", "index_offset"]
+
+exp_index_offset = re.compile(rb'"index_offset":\s*([0-9]+)\s*\}\s*$')
+
+""" Write an analyzed movie as JSON, one entry and one co-occurrence row at a time. Entries and co-occurrence rows
+    can be iterators, so the whole movie never needs to be serialized (or built) in memory.
+    The file is a regular JSON object with the keys of AnalyzedMovieScript.to_dict, with each entry and each
+    co-occurrence row on its own line. It ends with an index of the byte offsets of its values, followed by the
+    offset of the index itself, so that StreamingMovieReader can read any part of the file without parsing the rest.
+    The file is written atomically, so that an interrupted write never leaves a truncated movie behind. """
+def write_movie(path, info, entries, characters, cooccurrence_rows, extra=dict()):
+    index = {"values": dict(), "entries": {"length": 0, "checkpoints": []}, "cooccurrences": dict()}
+    with utils.write_atomic(path, "wb") as f:
+        def write(s):
+            f.write(s.encode("utf-8"))
+
+        # Write a value and return its [offset, length]
+        def write_value(value):
+            data = json.dumps(value).encode("utf-8")
+            offset = f.tell()
+            f.write(data)
+            return [offset, len(data)]
+
+        write("{\"info\": ")
+        index["values"]["info"] = write_value(info)
+
+        write(",\n\"entries\": [")
+        for i, e in enumerate(entries):
+            write(",\n" if i > 0 else "\n")
+            if i % ENTRY_CHECKPOINT_INTERVAL == 0:
+                index["entries"]["checkpoints"].append(f.tell())
+            write_value(e)
+            index["entries"]["length"] += 1
+        write("\n],\n\"characters\": ")
+        index["values"]["characters"] = write_value(characters)
+
+        write(",\n\"cooccurrences\": {")
+        for i, (name, row) in enumerate(cooccurrence_rows):
+            write(",\n" if i > 0 else "\n")
+            write(json.dumps(name) + ": ")
+            index["cooccurrences"][name] = write_value(row)
+        write("\n}")
+
+        for key, value in extra.items():
+            write(",\n" + json.dumps(key) + ": ")
+            index["values"][key] = write_value(value)
+
+        write(",\n\"index\": ")
+        index_offset = f.tell()
+        f.write(json.dumps(index).encode("utf-8"))
+        write(",\n\"index_offset\": " + str(index_offset).rjust(INDEX_OFFSET_WIDTH) + "}\n")
+
+
+""" Read the index at the end of a file written by write_movie, or return None if the file has no index. """
+def read_index(f):
+    f.seek(0, 2)
+    size = f.tell()
+    tail_length = min(size, INDEX_OFFSET_WIDTH + 32)
+    f.seek(size - tail_length)
+    match = exp_index_offset.search(f.read(tail_length))
+    if match == None:
+        return None
+    f.seek(int(match.group(1)))
+    return json.JSONDecoder().raw_decode(f.read(size - int(match.group(1))).decode("utf-8"))[0]
+
+
+""" Remove the index keys from an analyzed movie dict loaded from a file written by write_movie. """
+def strip_index(obj):
+    for key in INDEX_KEYS:
+        obj.pop(key, None)
+    return obj
+
+
+""" Lazy reader of analyzed movie files. Entries are read one at a time and values (info, characters,
+    co-occurrence rows, ...) are only read and parsed when requested, using the index of files written by
+    write_movie. Files without an index (written with json.dump) are loaded in memory at once. """
+class StreamingMovieReader:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.index = read_index(self.file)
+        self.obj = None
+        if self.index == None:
+            self.file.seek(0)
+            self.obj = json.load(self.file)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        self.file.close()
+
+
+    def read_value(self, offset, length):
+        self.file.seek(offset)
+        return json.loads(self.file.read(length))
+
+
+    """ Get a top-level value other than entries and co-occurrences: "info", "characters", "scenes", ... """
+    def get(self, key):
+        if self.obj != None:
+            return self.obj[key]
+        return self.read_value(*self.index["values"][key])
+
+
+    def keys(self):
+        if self.obj != None:
+            return [key for key in self.obj if key not in INDEX_KEYS]
+        return ["info", "entries", "characters", "cooccurrences"] + [key for key in self.index["values"] if key not in ["info", "characters"]]
+
+
+    def num_entries(self):
+        if self.obj != None:
+            return len(self.obj["entries"])
+        return self.index["entries"]["length"]
+
+
+    """ Iterate over the entries from the given entry index, reading one entry at a time. """
+    def iter_entries(self, start=0):
+        if self.obj != None:
+            yield from self.obj["entries"][start:]
+            return
+
+        num_entries = self.index["entries"]["length"]
+        if start >= num_entries:
+            return
+        checkpoint = start // ENTRY_CHECKPOINT_INTERVAL
+        i = checkpoint * ENTRY_CHECKPOINT_INTERVAL
+        self.file.seek(self.index["entries"]["checkpoints"][checkpoint])
+        while i < num_entries:
+            # Each entry is on its own line, followed by a comma except for the last one
+            line = self.file.readline().rstrip()
+            if i >= start:
+                # The file position may move between two entries if the caller reads other values
+                position = self.file.tell()
+                yield json.loads(line[:-1] if line.endswith(b",") else line)
+                self.file.seek(position)
+            i += 1
+
+
+    def get_entry(self, i):
+        if i < 0 or i >= self.num_entries():
+            raise IndexError("Entry index out of range: " + str(i))
+        return next(self.iter_entries(i))
+
+
+    """ Get the co-occurrences of a character with all other characters, or None for an unknown character. """
+    def get_cooccurrence_row(self, name):
+        if self.obj != None:
+            return self.obj["cooccurrences"].get(name)
+        if name not in self.index["cooccurrences"]:
+            return None
+        return self.read_value(*self.index["cooccurrences"][name])
+
+
+    """ Iterate over the co-occurrence rows of all characters, as (name, row). """
+    def iter_cooccurrence_rows(self):
+        if self.obj != None:
+            yield from self.obj["cooccurrences"].items()
+            return
+        for name, (offset, length) in self.index["cooccurrences"].items():
+            yield name, self.read_value(offset, length)
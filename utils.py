@@ -1,4 +1,11 @@
+import contextlib
 import csv
+import io
+import os
+import re
+import stat
+import tempfile
+
 import config
 
 """ Converts movie metadata into an array for CSV storage. """
@@ -19,55 +26,197 @@ def array_to_movie(arr):
     movie["script_page"] = arr[3]
     return movie
 
-""" Get metadata for a given movie from file storage, by index. """
-def get_movie_metadata(movie_index):
-    # Read metadata CSV file
-    with open(config.MOVIES_METADATA_FILE, newline="") as f:
-        reader = csv.reader(f, delimiter=";", quotechar="|")
+""" Open a file for writing atomically: data is written to a temporary file in the same directory, which replaces the
+    file once closed, or is removed on error. The file keeps the permissions of the file it replaces, or gets the
+    default permissions of new files (from the umask). """
+@contextlib.contextmanager
+def write_atomic(path, mode="w", **kwargs):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with open(fd, mode, **kwargs) as f:
+            yield f
+        os.chmod(tmp_path, get_file_mode(path))
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
 
-        # Find the correct row and return associated metadata
-        for i, row in enumerate(reader):
-            if i == 1 + movie_index:
-                return array_to_movie(row)
+""" Hold an exclusive lock on a file (a separate lock file, next to it) for the duration of a block, so that
+    processes reading and rewriting the file do not lose each other's writes. """
+@contextlib.contextmanager
+def file_lock(path):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    with open(path + ".lock", "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            # Retries for about 10 seconds, then raises OSError
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
-    return None
+""" Get the permissions of a file, or the default permissions of new files if it does not exist. """
+def get_file_mode(path):
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        # The umask can only be read by setting it
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
 
-""" Get metadata for a given movie from file storage, by name. """
-def get_movie_metadata_by_name(movie_name):
-    # Read metadata CSV file
-    with open(config.MOVIES_METADATA_FILE, newline="") as f:
-        reader = csv.reader(f, delimiter=";", quotechar="|")
+""" Get the file-name-safe identifier of a movie title, as used for analyzed script files. """
+def get_safe_name(title):
+    return title.lower().replace(" ", "-").replace(":", "")
+
+""" Decode the content of the metadata file. Metadata files are UTF-8, but files written by previous versions are in
+    the legacy encoding: they are decoded as such, and migrated to UTF-8 by the next crawl that rewrites them. """
+def decode_metadata(data):
+    try:
+        return data.decode(config.MOVIES_METADATA_ENCODING)
+    except UnicodeDecodeError:
+        return data.decode(config.MOVIES_METADATA_LEGACY_ENCODING)
+
+""" Normalize a movie title for lenient lookups: lowercase, only letters and digits. """
+def normalize_title(title):
+    return re.sub(r"[^0-9a-z]+", "", title.lower())
+
+""" Normalize a character name for lenient lookups: case-folded, only letters and digits (of any alphabet). """
+def normalize_name(name):
+    return re.sub(r"[\W_]+", "", name.casefold())
+
+""" In-memory index of the movie metadata file.
+    The CSV file is read once and indexed by row, exact title, normalized title, safe name and author.
+    It is reloaded automatically when the file changes on disk. """
+class MetadataStore:
+    def __init__(self, path=None):
+        path = config.MOVIES_METADATA_FILE if path == None else path
+        self.path = path
+        self.file_signature = None
+        self.rows = []
+        self.by_title = dict()
+        self.by_normalized_title = dict()
+        self.by_safe_name = dict()
+        self.by_author = dict()
+
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            reader = csv.reader(io.StringIO(decode_metadata(f.read()), newline=""), delimiter=";", quotechar="|")
+        next(reader, None) # skip header
+        rows = [tuple(row) for row in reader]
+
+        by_title, by_normalized_title, by_safe_name, by_author = dict(), dict(), dict(), dict()
+        for i, row in enumerate(rows):
+            # When several movies share a title, the first one wins
+            by_title.setdefault(row[0], i)
+            by_normalized_title.setdefault(normalize_title(row[0]), i)
+            by_safe_name.setdefault(get_safe_name(row[0]), i)
+            for author in row[1].split(","):
+                by_author.setdefault(author.strip().lower(), []).append(i)
+
+        self.rows = rows
+        self.by_title = by_title
+        self.by_normalized_title = by_normalized_title
+        self.by_safe_name = by_safe_name
+        self.by_author = by_author
+
+
+    """ Reload the metadata if the file changed since it was last read. """
+    def refresh(self):
+        stat = os.stat(self.path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self.file_signature:
+            self.load()
+            self.file_signature = signature
+
+
+    def get(self, movie_index):
+        self.refresh()
+        if 0 <= movie_index < len(self.rows):
+            return array_to_movie(self.rows[movie_index])
+        return None
+
+
+    def get_by_title(self, title):
+        self.refresh()
+        i = self.by_title.get(title)
+        return array_to_movie(self.rows[i]) if i != None else None
+
+
+    """ Get a movie by title, ignoring case, spacing and punctuation. """
+    def get_by_normalized_title(self, title):
+        self.refresh()
+        i = self.by_normalized_title.get(normalize_title(title))
+        return array_to_movie(self.rows[i]) if i != None else None
 
-        # Find the correct row and return associated metadata
-        for i, row in enumerate(reader):
-            if row[0] == movie_name:
-                return array_to_movie(row)
 
-    return None
+    """ Get a movie by the safe name used for its analyzed script file (e.g. "star-wars-a-new-hope"). """
+    def get_by_safe_name(self, safe_name):
+        self.refresh()
+        i = self.by_safe_name.get(safe_name)
+        return array_to_movie(self.rows[i]) if i != None else None
 
 
+    """ Get all movies written by the given author (case-insensitive). """
+    def get_by_author(self, author):
+        self.refresh()
+        return [array_to_movie(self.rows[i]) for i in self.by_author.get(author.strip().lower(), [])]
+
+
+    def get_all(self):
+        self.refresh()
+        return [array_to_movie(row) for row in self.rows]
+
+
+# Shared metadata store, created on first use
+metadata_store = None
+
+""" Get the shared metadata store. """
+def get_metadata_store():
+    global metadata_store
+    if metadata_store == None or metadata_store.path != config.MOVIES_METADATA_FILE:
+        metadata_store = MetadataStore(config.MOVIES_METADATA_FILE)
+    return metadata_store
+
+""" Get metadata for a given movie from file storage, by index. """
+def get_movie_metadata(movie_index):
+    return get_metadata_store().get(movie_index)
+
+""" Get metadata for a given movie from file storage, by name. """
+def get_movie_metadata_by_name(movie_name):
+    return get_metadata_store().get_by_title(movie_name)
+
 """ Get metadata for all movies. """
 def get_all_movies_metadata():
-    # Read metadata CSV file
-    with open(config.MOVIES_METADATA_FILE, newline="") as f:
-        reader = csv.reader(f, delimiter=";", quotechar="|")
+    return get_metadata_store().get_all()
 
-        # Parse CSV data for all movies
-        movies = [array_to_movie(row) for i, row in enumerate(reader) if i > 0]
-        
-        return movies
-    
-    return None
+# Letters that are often misread when scanning scripts, and the letter they should be
+SCAN_ERRORS = {
+    "B": "R",
+    "G": "C",
+    "l": "I",
+    "R": "K"
+}
 
 """ Look for scanning mistakes (misread letters) in the given character name,
     checking against the dictionary of character occurrences. """
 def fix_scan_errors(character_name, character_dict):
-    scan_errors = {
-        "B": "R",
-        "G": "C",
-        "l": "I",
-        "R": "K"
-    }
+    scan_errors = SCAN_ERRORS
     for name in character_dict:
         if name != character_name and len(name) == len(character_name) and character_dict[name] > character_dict[character_name]:
             diff_idx = [i for i in range(len(name)) if name[i] != character_name[i]]
@@ -77,4 +226,51 @@ def fix_scan_errors(character_name, character_dict):
                     if character_name[i] in scan_errors and name[i] == scan_errors[character_name[i]]:
                         character_name = character_name[:i] + scan_errors[character_name[i]] + character_name[i+1:]
                 return character_name
-    return character_name
\ No newline at end of file
+    return character_name
+
+""" Split a name in 3 segments. Two names of the same length that differ by at most 2 letters
+    necessarily have at least one identical segment. """
+def split_name_segments(name):
+    length = len(name)
+    bounds = [0, length // 3, 2 * length // 3, length]
+    return [name[bounds[k]:bounds[k+1]] for k in range(3)]
+
+""" Fixes scanning mistakes in character names like fix_scan_errors, for all names of a movie.
+    Names are indexed by length and by segment, so only names that can be within 2 letters of a given
+    name are compared with it, and each distinct name is only resolved once. """
+class ScanErrorCorrector:
+    def __init__(self, character_dict):
+        self.character_dict = character_dict
+        self.order = {name: i for i, name in enumerate(character_dict)}
+        self.memo = dict()
+
+        # (length, segment number, segment) -> names
+        self.index = dict()
+        for name in character_dict:
+            for k, segment in enumerate(split_name_segments(name)):
+                self.index.setdefault((len(name), k, segment), []).append(name)
+
+
+    def fix(self, character_name):
+        if character_name in self.memo:
+            return self.memo[character_name]
+
+        candidates = set()
+        for k, segment in enumerate(split_name_segments(character_name)):
+            candidates.update(self.index.get((len(character_name), k, segment), []))
+
+        # Like fix_scan_errors, the first close enough and more frequent name (in dict order) wins
+        fixed_name = character_name
+        count = self.character_dict[character_name]
+        for name in sorted(candidates, key=self.order.__getitem__):
+            if name != character_name and self.character_dict[name] > count:
+                diff_idx = [i for i in range(len(name)) if name[i] != character_name[i]]
+                if len(diff_idx) <= 2: # allow for max 2 scanning errors
+                    for i in diff_idx:
+                        # Detect if there is indeed a scan error and fix it
+                        if character_name[i] in SCAN_ERRORS and name[i] == SCAN_ERRORS[character_name[i]]:
+                            fixed_name = fixed_name[:i] + SCAN_ERRORS[character_name[i]] + fixed_name[i+1:]
+                    break
+
+        self.memo[character_name] = fixed_name
+        return fixed_name